@@ -1,7 +1,12 @@
 import os
+import atexit
 import logging
+import threading
+from collections import Counter
 from confluent_kafka import avro
 from confluent_kafka.avro import AvroProducer
+from prometheus_client import Gauge, Histogram
+from metrics import LATENCY_BUCKETS_S
 
 
 key_schema_str = """
@@ -21,11 +26,29 @@ value_schema_str = """
    "name": "value",
    "type": "record",
    "fields" : [
-     { "name" : "phrase", "type" : "string" }
+     { "name" : "phrase", "type" : "string" },
+     { "name" : "count", "type" : "long", "default" : 1 }
    ]
 }
 """
 
+PRODUCER_MODE = os.getenv("PRODUCER_MODE", "sync") # "sync" flushes after each request, "async" delivers in the background
+PRODUCER_LINGER_MS = int(os.getenv("PRODUCER_LINGER_MS", 50))
+PRODUCER_BATCH_SIZE = int(os.getenv("PRODUCER_BATCH_SIZE", 1000))
+PRODUCER_QUEUE_MAX_MESSAGES = int(os.getenv("PRODUCER_QUEUE_MAX_MESSAGES", 100000))
+PRODUCER_QUEUE_FULL_TIMEOUT_S = float(os.getenv("PRODUCER_QUEUE_FULL_TIMEOUT_S", 1))
+PRODUCER_DRAIN_TIMEOUT_S = float(os.getenv("PRODUCER_DRAIN_TIMEOUT_S", 10))
+AGGREGATION_WINDOW_S = float(os.getenv("AGGREGATION_WINDOW_S", 0)) # When > 0, one (phrase, count) record is sent per phrase and window
+AGGREGATION_MAX_PHRASES = int(os.getenv("AGGREGATION_MAX_PHRASES", 100000)) # Sends the window early once it holds this many phrases
+AGGREGATION_REJECT_PHRASES = int(os.getenv("AGGREGATION_REJECT_PHRASES", 2 * AGGREGATION_MAX_PHRASES)) # Rejects phrases, without counting them, while the window holds this many (it cannot be sent)
+
+PRODUCER_QUEUE_MESSAGES = Gauge('collector_producer_queue_messages', 'Messages waiting in the producer queue to be delivered', multiprocess_mode='livesum')
+PRODUCER_FLUSH_DURATION = Histogram('collector_producer_flush_duration_seconds', 'Duration of the producer flushes', buckets=LATENCY_BUCKETS_S)
+
+
+class CollectorQueueFullError(Exception):
+	pass
+
 class Collector:
 
 	def __init__(self):
@@ -34,16 +57,126 @@ class Collector:
 		value_schema = avro.loads(value_schema_str)
 		key_schema = avro.loads(key_schema_str)
 
-		self._producer = AvroProducer({
+		self._async = (PRODUCER_MODE == 'async')
+		config = {
 			'bootstrap.servers': f'{os.getenv("BROKER_HOST")}:9092',
 			'schema.registry.url': f'http://{os.getenv("SCHEMA_REGISTRY_HOST")}:8081',
 			'on_delivery': self._delivery_report
-			}, default_key_schema=key_schema, default_value_schema=value_schema)
+			}
+		if (self._async):
+			# librdkafka batches the messages in its own bounded queue, sending a batch when it is full or after the linger time
+			config.update({
+				'linger.ms': PRODUCER_LINGER_MS,
+				'batch.num.messages': PRODUCER_BATCH_SIZE,
+				'queue.buffering.max.messages': PRODUCER_QUEUE_MAX_MESSAGES,
+			})
+		self._producer = AvroProducer(config, default_key_schema=key_schema, default_value_schema=value_schema)
+
+		self._aggregated = (AGGREGATION_WINDOW_S > 0)
+		self._phrase_counts = Counter()
+		self._phrase_counts_lock = threading.Lock()
+		self._window_full = threading.Event() # Wakes the aggregation thread up, to send the window before it is due
+
+		self._stopped = threading.Event()
+		if (self._async):
+			# Serves the delivery reports, which are only triggered by poll() or flush()
+			self._poll_thread = threading.Thread(target=self._poll_loop, daemon=True)
+			self._poll_thread.start()
+		if (self._aggregated):
+			self._aggregation_thread = threading.Thread(target=self._aggregation_loop, daemon=True)
+			self._aggregation_thread.start()
+		if (self._async or self._aggregated):
+			atexit.register(self.stop)
 
 	def collect_phrase(self, phrase):
-		phrase = phrase.lower().translate({ord(i): None for i in '|'}) # Remove pipe characther, which is treated as a special character in this system 
-		self._producer.produce(topic='phrases', value={"phrase": phrase}, key={"phrase": phrase})
-		self._producer.flush()
+		self.collect_phrases([phrase])
+
+	def collect_phrases(self, phrases):
+		phrases = [phrase.lower().translate({ord(i): None for i in '|'}) for phrase in phrases] # Remove pipe characther, which is treated as a special character in this system 
+
+		if (self._aggregated):
+			# The window is sent by the aggregation thread, so that once counted, the phrases are never rejected (and then counted again on retry)
+			with self._phrase_counts_lock:
+				if (len(self._phrase_counts) >= AGGREGATION_REJECT_PHRASES):
+					raise CollectorQueueFullError("The aggregation window is full")
+				self._phrase_counts.update(phrases)
+				window_full = len(self._phrase_counts) >= AGGREGATION_MAX_PHRASES
+			if (window_full):
+				self._window_full.set()
+			return
+
+		for phrase in phrases:
+			self._produce(phrase, 1)
+		if (not self._async):
+			self._flush()
+
+	def stop(self):
+		""" Stops the background threads, sends the current aggregation window and waits for the queued messages to be delivered """
+		if (self._stopped.is_set()):
+			return
+		self._stopped.set()
+		if (self._aggregated):
+			self._window_full.set()
+			self._aggregation_thread.join()
+			self._send_phrase_counts()
+		if (self._async):
+			self._poll_thread.join()
+		remaining = self._flush(PRODUCER_DRAIN_TIMEOUT_S)
+		if (remaining):
+			self._logger.error(f'{remaining} messages were not delivered to the broker before shutting down')
+
+	def _send_phrase_counts(self):
+		""" Sends the current window. If the producer queue fills up, the phrases not sent yet are put back in the window, to be sent with the next one """
+		with self._phrase_counts_lock:
+			phrase_counts, self._phrase_counts = self._phrase_counts, Counter()
+		self._logger.debug(f'Sending {len(phrase_counts)} aggregated phrases')
+		phrase_counts = list(phrase_counts.items())
+		for i, (phrase, count) in enumerate(phrase_counts):
+			try:
+				self._produce(phrase, count)
+			except CollectorQueueFullError:
+				with self._phrase_counts_lock:
+					self._phrase_counts.update(dict(phrase_counts[i:]))
+				raise
+		if (not self._async):
+			self._flush()
+		PRODUCER_QUEUE_MESSAGES.set(len(self._producer))
+
+	def _aggregation_loop(self):
+		""" Sends the window every AGGREGATION_WINDOW_S, or as soon as it holds AGGREGATION_MAX_PHRASES phrases """
+		while (True):
+			self._window_full.wait(AGGREGATION_WINDOW_S)
+			self._window_full.clear()
+			if (self._stopped.is_set()):
+				return
+			try:
+				self._send_phrase_counts()
+			except Exception as e:
+				self._logger.error('Could not send the aggregated phrases', exc_info=e)
+
+	def _produce(self, phrase, count):
+		value = {"phrase": phrase, "count": count}
+		try:
+			self._producer.produce(topic='phrases', value=value, key={"phrase": phrase})
+		except BufferError:
+			# Backpressure: the producer queue is full, so wait for some deliveries before giving up
+			self._producer.poll(PRODUCER_QUEUE_FULL_TIMEOUT_S)
+			try:
+				self._producer.produce(topic='phrases', value=value, key={"phrase": phrase})
+			except BufferError:
+				raise CollectorQueueFullError("The producer queue is full")
+
+	def _flush(self, timeout=-1):
+		""" Waits for the queued messages to be delivered, returning the number of messages still queued after the timeout """
+		with PRODUCER_FLUSH_DURATION.time():
+			remaining = self._producer.flush(timeout)
+		PRODUCER_QUEUE_MESSAGES.set(remaining)
+		return remaining
+
+	def _poll_loop(self):
+		while (not self._stopped.is_set()):
+			self._producer.poll(0.1)
+			PRODUCER_QUEUE_MESSAGES.set(len(self._producer))
 
 	def _delivery_report(self, err, msg):
 		""" Called once for each message produced to indicate delivery result. Triggered by poll() or flush(). """
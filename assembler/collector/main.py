@@ -1,7 +1,12 @@
 import falcon
 import json
 import logging
-from collector import Collector
+import os
+from collector import Collector, CollectorQueueFullError
+from metrics import MetricsResource
+
+
+MAX_BULK_PHRASES = int(os.getenv('MAX_BULK_PHRASES', 1000))
 
 
 class MainResource(object):
@@ -21,6 +26,15 @@ class MainResource(object):
 				 })
 			resp.status = falcon.HTTP_200
 			resp.body = response_body
+
+		except CollectorQueueFullError as err:
+			response_body = json.dumps(
+				{
+					"status": "error",
+					"message": "The collector is overloaded, please retry later"
+				 })
+			resp.status = falcon.HTTP_503
+			resp.body = response_body
 			
 		except Exception as e:
 			self._logger.error('An error occurred when processing the request', exc_info=e)
@@ -32,7 +46,53 @@ class MainResource(object):
 			resp.status = falcon.HTTP_500
 			resp.body = response_body
 
+	def on_post_bulk(self, req, resp):
+		""" Collects the phrases of a JSON body like {"phrases": ["phrase 1", "phrase 2"]} """
+		self._logger.debug(f'Handling bulk request {req.url}')
+
+		try:
+			phrases = req.media['phrases']
+			if (not isinstance(phrases, list) or len(phrases) > MAX_BULK_PHRASES or not all(isinstance(phrase, str) for phrase in phrases)):
+				response_body = json.dumps(
+					{
+						"status": "error",
+						"message": f'Expected a list of at most {MAX_BULK_PHRASES} phrases'
+					 })
+				resp.status = falcon.HTTP_400
+				resp.body = response_body
+				return
+
+			self._collector.collect_phrases(phrases)
+			response_body = json.dumps(
+				{
+					"status": "success",
+					"message": f'{len(phrases)} phrases sent for collection'
+				 })
+			resp.status = falcon.HTTP_200
+			resp.body = response_body
+
+		except CollectorQueueFullError as err:
+			response_body = json.dumps(
+				{
+					"status": "error",
+					"message": "The collector is overloaded, please retry later"
+				 })
+			resp.status = falcon.HTTP_503
+			resp.body = response_body
+
+		except Exception as e:
+			self._logger.error('An error occurred when processing the request', exc_info=e)
+			response_body = json.dumps(
+				{
+					"status": "error",
+					"message": "An error occurred when processing the request"
+				 })
+			resp.status = falcon.HTTP_500
+			resp.body = response_body
+
 
 app = falcon.API()
 main_resource = MainResource()
 app.add_route('/collect-phrase', main_resource)
+app.add_route('/collect-phrases', main_resource, suffix='bulk')
+app.add_route('/metrics', MetricsResource())
@@ -34,15 +34,19 @@ public class PhrasesWithWeight extends Configured implements Tool{
   private static final String BASE_WEIGHT_KEY = "baseweight";
 
   public static class PhraseMapper extends Mapper<AvroKey<io.github.lopespm.autocomplete.phrases.value>, NullWritable, Text, LongWritable>{
-    private LongWritable baseWeight;
+    private long baseWeight;
+    private LongWritable weight = new LongWritable();
 
     @Override
     public void setup(Context context) throws IOException, InterruptedException {
-      baseWeight = new LongWritable(context.getConfiguration().getInt(BASE_WEIGHT_KEY, 1));
+      baseWeight = context.getConfiguration().getInt(BASE_WEIGHT_KEY, 1);
     }
 
+    // Each record holds the number of times its phrase was searched, which is 1 unless the collector aggregated them.
+    // Records written before the count field existed get its default value of 1 through schema resolution
     public void map(AvroKey<io.github.lopespm.autocomplete.phrases.value> key, NullWritable value, Context context) throws IOException, InterruptedException {
-      context.write(new Text(key.datum().getPhrase().toString()), baseWeight);
+      weight.set(baseWeight * key.datum().getCount());
+      context.write(new Text(key.datum().getPhrase().toString()), weight);
     }
   }
 
@@ -70,14 +70,14 @@ public class PhrasesWithWeightOrdered extends Configured implements Tool{
   public int run(String[] args) throws Exception {
 
     if (args.length != 3) {
-      System.err.printf("Usage: %s [generic options] <input> <output> <unused>\n", getClass().getName());
+      System.err.printf("Usage: %s [generic options] <input> <output> <numReduceTasks>\n", getClass().getName());
       ToolRunner.printGenericCommandUsage(System.err);
       System.exit(2);
     }
 
     Path inPath = new Path(args[0]);
     Path outPath = new Path(args[1]);
-    Integer baseWeight = Integer.valueOf(args[2]);
+    Integer numReduceTasks = Integer.valueOf(args[2]);
     
     Job job = Job.getInstance(getConf(), "Phrases With Weight Ordered");
     job.setJarByClass(PhrasesWithWeightOrdered.class);
@@ -99,7 +99,9 @@ public class PhrasesWithWeightOrdered extends Configured implements Tool{
     job.setOutputKeyClass(LongWritable.class);
     job.setOutputValueClass(Text.class);
 
-    job.setNumReduceTasks(1); // Make sure to output to a single file
+    // 1 outputs a single file totally ordered by weight. The trie builder keeps the top phrases by weight itself,
+    // so 0 (map only, one unordered file per input split) skips the shuffle and the single reducer sort altogether
+    job.setNumReduceTasks(numReduceTasks);
 
     FileInputFormat.setInputPaths(job, inPath);
     FileOutputFormat.setOutputPath(job, outPath);
@@ -16,6 +16,9 @@ hadoop fs -mkdir -p /phrases/2_with_weight/${TARGET_ID}/
 
 INPUT_FOLDERS=`hadoop fs -ls /phrases/1_sink/phrases/ | sed 1,1d | sort -r -k8 | awk '{print \$8}' | head -${MAX_NUMBER_OF_INPUT_FOLDERS} | sort`
 echo "${INPUT_FOLDERS}"
+# The sink files read for this target, which the trie builder leaves out of the target's weight deltas
+INPUT_FILES_LOCAL_PATH=$(mktemp)
+hadoop fs -ls -R ${INPUT_FOLDERS} | awk '{print $8}' | grep '\.avro$' > ${INPUT_FILES_LOCAL_PATH}
 TASKNAME="PhrasesWithWeight"
 CLASS_TO_RUN="${TASKNAME}"
 JAR_FILEPATH="/opt/hadoop/applications/${TASKNAME}/${TASKNAME}.jar"
@@ -44,12 +47,15 @@ hdfs dfs -cat /phrases/3_with_weight_merged/${TARGET_ID}/*
 
 
 # PhrasesWithWeightOrdered
+# Runs map only (0 reduce tasks): the trie builder selects the top phrases by weight, so no global sort is needed
 TASKNAME="PhrasesWithWeightOrdered"
 CLASS_TO_RUN="${TASKNAME}"
 JAR_FILEPATH="/opt/hadoop/applications/${TASKNAME}/${TASKNAME}.jar"
 cd "/opt/hadoop/applications/${TASKNAME}"
 HADOOP_CLASSPATH="${AVROLIB_PATH}" $HADOOP_HOME/bin/hadoop jar ${JAR_FILEPATH} ${CLASS_TO_RUN} -libjars ${LIBJARS} /phrases/3_with_weight_merged/${TARGET_ID} /phrases/4_with_weight_ordered/${TARGET_ID} 0
 hdfs dfs -cat /phrases/4_with_weight_ordered/${TARGET_ID}/*
+hadoop fs -put -f ${INPUT_FILES_LOCAL_PATH} /phrases/4_with_weight_ordered/${TARGET_ID}/_input_files
+rm ${INPUT_FILES_LOCAL_PATH}
 
 
 # Register in zookeeper
@@ -0,0 +1,215 @@
+"""
+Single machine alternative to the PhrasesWithWeight, PhrasesWithWeightMerged and PhrasesWithWeightOrdered MapReduce jobs
+run by do_tasks.sh, for deployments whose phrases fit on one machine's disk.
+
+Reads the sink's Avro files from a local copy of /phrases/1_sink/phrases, weights the searches of its most recent folders
+with the same 1/10/100 base weights, and writes the "weight\tphrase" lines of the merged weights, ordered by descending
+weight, in the 4_with_weight_ordered layout the trie builder reads:
+
+	$ python localaggregator.py /data/1_sink/phrases /data/4_with_weight_ordered
+	$ hdfs dfs -put /data/4_with_weight_ordered/<target id> /phrases/4_with_weight_ordered/
+
+The searches are counted by a pool of processes, each spilling its counts to disk, split by phrase hash, once it holds
+MAX_PHRASES_IN_MEMORY phrases. Each hash partition is then merged on its own, and ordered by an external sort.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+from itertools import groupby
+import multiprocessing
+import argparse
+import fastavro
+import logging
+import tempfile
+import heapq
+import time
+import zlib
+import os
+
+MAX_NUMBER_OF_INPUT_FOLDERS = int(os.getenv("MAX_NUMBER_OF_INPUT_FOLDERS", 3)) # As in do_tasks.sh
+BASE_WEIGHT_FACTOR = 10 # Each folder's searches weigh this many times those of the folder before it, as in do_tasks.sh
+AGGREGATOR_WORKERS = int(os.getenv("AGGREGATOR_WORKERS", os.cpu_count()))
+NUMBER_HASH_PARTITIONS = int(os.getenv("NUMBER_HASH_PARTITIONS", 16))
+MAX_PHRASES_IN_MEMORY = int(os.getenv("MAX_PHRASES_IN_MEMORY", 1000000)) # Per process, before spilling them to disk
+PART_FILE_NAME = 'part-r-00000' # A single file totally ordered by weight, as the ordered job with one reduce task
+
+logger = logging.getLogger(__name__)
+
+
+class NoInputFoldersError(Exception):
+	pass
+
+
+def list_input_folders(sink_dir, max_number_folders=MAX_NUMBER_OF_INPUT_FOLDERS):
+	"""
+	Returns the (folder path, base weight) pairs of the sink's most recent folders, oldest first. The sink names its folders
+	after their time (YYYYMMdd_HHmm), so the most recent ones are the last by name. The oldest gets a base weight of 1,
+	and each of the following ones BASE_WEIGHT_FACTOR times the one before it.
+	"""
+	folder_names = sorted(name for name in os.listdir(sink_dir) if os.path.isdir(os.path.join(sink_dir, name)) and not name.startswith('+'))
+	folder_names = folder_names[-max_number_folders:] if (max_number_folders > 0) else []
+	return [(os.path.join(sink_dir, name), BASE_WEIGHT_FACTOR ** i) for i, name in enumerate(folder_names)]
+
+
+def list_input_files(input_folders):
+	""" Returns the (file path, base weight) pairs of the Avro files of the input folders """
+	return [(os.path.join(folder_path, file_name), base_weight)
+		for folder_path, base_weight in input_folders
+		for file_name in sorted(os.listdir(folder_path)) if file_name.endswith('.avro')]
+
+
+def hash_partition(phrase, number_partitions):
+	# Unlike hash(), stable across processes
+	return zlib.crc32(phrase.encode('utf-8')) % number_partitions
+
+
+def count_phrases(input_files, spill_dir, task_index, number_partitions=NUMBER_HASH_PARTITIONS, max_phrases=MAX_PHRASES_IN_MEMORY):
+	"""
+	Sums the weighted searches of each phrase in the (Avro file path, base weight) pairs, as PhrasesWithWeight and its
+	combiner do. Records written before the count field existed count as one search. The sums are spilled to one file per
+	hash partition, sorted by phrase, whenever max_phrases distinct phrases are held, and at the end.
+	Returns the spill file paths of each partition. Runs in the aggregator's process pool.
+	"""
+	spill_paths = [[] for _ in range(number_partitions)]
+	phrase_weights = Counter()
+	for avro_path, base_weight in input_files:
+		with open(avro_path, 'rb') as f:
+			for record in fastavro.reader(f):
+				phrase_weights[record['phrase']] += base_weight * record.get('count', 1)
+				if (len(phrase_weights) >= max_phrases):
+					spill(phrase_weights, spill_dir, f'{task_index}-{len(spill_paths[0])}', spill_paths)
+					phrase_weights = Counter()
+	if (phrase_weights):
+		spill(phrase_weights, spill_dir, f'{task_index}-{len(spill_paths[0])}', spill_paths)
+	return spill_paths
+
+
+def spill(phrase_weights, spill_dir, spill_name, spill_paths):
+	""" Writes the phrase weights as "weight\tphrase" lines to one file per hash partition, sorted by phrase """
+	number_partitions = len(spill_paths)
+	phrases_by_partition = [[] for _ in range(number_partitions)]
+	for phrase in phrase_weights:
+		phrases_by_partition[hash_partition(phrase, number_partitions)].append(phrase)
+
+	for partition, phrases in enumerate(phrases_by_partition):
+		spill_path = os.path.join(spill_dir, f'spill-{spill_name}-{partition}.tsv')
+		with open(spill_path, 'w', encoding='utf-8') as f:
+			for phrase in sorted(phrases):
+				f.write(f'{phrase_weights[phrase]}\t{phrase}\n')
+		spill_paths[partition].append(spill_path)
+
+
+def read_weighted_phrases(path):
+	""" Yields the (phrase, weight) pairs of a file of "weight\tphrase" lines """
+	with open(path, 'r', encoding='utf-8') as f:
+		for line in f:
+			weight, phrase = line.rstrip('\n').split('\t', maxsplit=1)
+			yield phrase, int(weight)
+
+
+def merge_partition(spill_paths, run_dir, partition, max_phrases=MAX_PHRASES_IN_MEMORY):
+	"""
+	Merges the sorted spills of a hash partition, summing the weights of each phrase as PhrasesWithWeightMerged does,
+	and sorts the sums by descending weight, in runs of at most max_phrases phrases. Returns the paths of the sorted runs.
+	Runs in the aggregator's process pool.
+	"""
+	run_paths = []
+	run = []
+	merged_spills = heapq.merge(*[read_weighted_phrases(path) for path in spill_paths])
+	for phrase, weighted_phrases in groupby(merged_spills, key=lambda weighted_phrase: weighted_phrase[0]):
+		run.append((-sum(weight for _, weight in weighted_phrases), phrase))
+		if (len(run) >= max_phrases):
+			run_paths.append(write_run(run, run_dir, f'{partition}-{len(run_paths)}'))
+			run = []
+	if (run):
+		run_paths.append(write_run(run, run_dir, f'{partition}-{len(run_paths)}'))
+
+	for path in spill_paths:
+		os.remove(path)
+	return run_paths
+
+
+def write_run(run, run_dir, run_name):
+	run.sort()
+	run_path = os.path.join(run_dir, f'run-{run_name}.tsv')
+	with open(run_path, 'w', encoding='utf-8') as f:
+		for negative_weight, phrase in run:
+			f.write(f'{-negative_weight}\t{phrase}\n')
+	return run_path
+
+
+def merge_runs(run_paths, output_path):
+	""" Merges the runs into a single file of "weight\tphrase" lines, ordered by descending weight and then by phrase """
+	runs = [((-weight, phrase) for phrase, weight in read_weighted_phrases(path)) for path in run_paths]
+	number_phrases = 0
+	with open(output_path, 'w', encoding='utf-8') as f:
+		for negative_weight, phrase in heapq.merge(*runs):
+			f.write(f'{-negative_weight}\t{phrase}\n')
+			number_phrases += 1
+	return number_phrases
+
+
+def aggregate(sink_dir, output_dir, target_id, max_number_folders=MAX_NUMBER_OF_INPUT_FOLDERS, workers=AGGREGATOR_WORKERS,
+		number_partitions=NUMBER_HASH_PARTITIONS, max_phrases=MAX_PHRASES_IN_MEMORY, work_dir=None):
+	"""
+	Writes the weighted phrases of the sink's most recent folders to output_dir/target_id/part-r-00000, followed by an
+	empty _SUCCESS file as Hadoop does. The target directory only appears once it is complete.
+	Returns the number of phrases written.
+	"""
+	input_folders = list_input_folders(sink_dir, max_number_folders)
+	if (not input_folders):
+		raise NoInputFoldersError(f'No sink folders found in {sink_dir}')
+	for folder_path, base_weight in input_folders:
+		logger.info(f'Processing input {folder_path} with base weight {base_weight}')
+	input_files = list_input_files(input_folders)
+
+	target_dir = os.path.join(output_dir, target_id)
+	if (os.path.exists(target_dir)):
+		raise FileExistsError(f'The target directory {target_dir} already exists')
+	os.makedirs(output_dir, exist_ok=True)
+	with tempfile.TemporaryDirectory(dir=work_dir) as temp_dir:
+		# Spawn instead of fork, as in the trie builder
+		with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+			# Each task gets every workers-th file, so that the tasks read about the same amount of the most recent folders
+			count_futures = [
+				executor.submit(count_phrases, input_files[task_index::workers], temp_dir, task_index, number_partitions, max_phrases)
+				for task_index in range(min(workers, len(input_files)))]
+			spill_paths_by_partition = [[] for _ in range(number_partitions)]
+			for future in count_futures:
+				for partition, spill_paths in enumerate(future.result()):
+					spill_paths_by_partition[partition].extend(spill_paths)
+
+			merge_futures = [executor.submit(merge_partition, spill_paths, temp_dir, partition, max_phrases)
+				for partition, spill_paths in enumerate(spill_paths_by_partition) if spill_paths]
+			run_paths = [run_path for future in merge_futures for run_path in future.result()]
+
+		# Written next to the target directory, so that it can be renamed into place
+		partial_target_dir = os.path.join(output_dir, f'_temporary_{target_id}')
+		os.makedirs(partial_target_dir, exist_ok=True)
+		number_phrases = merge_runs(run_paths, os.path.join(partial_target_dir, PART_FILE_NAME))
+		open(os.path.join(partial_target_dir, '_SUCCESS'), 'w').close()
+		os.rename(partial_target_dir, target_dir)
+
+	return number_phrases
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Weights, merges and orders the phrases of the sink, as the MapReduce jobs of do_tasks.sh do')
+	parser.add_argument('sink_dir', help='Local copy of the sink folders, as /phrases/1_sink/phrases')
+	parser.add_argument('output_dir', help='Directory to create the target directory in, as /phrases/4_with_weight_ordered')
+	parser.add_argument('--target-id', default=time.strftime('%Y%m%d_%H%M', time.gmtime()), help='Defaults to the current UTC time, as in do_tasks.sh')
+	parser.add_argument('--max-input-folders', type=int, default=MAX_NUMBER_OF_INPUT_FOLDERS)
+	parser.add_argument('--workers', type=int, default=AGGREGATOR_WORKERS)
+	parser.add_argument('--partitions', type=int, default=NUMBER_HASH_PARTITIONS, help='Number of hash partitions the phrases are merged in')
+	parser.add_argument('--max-phrases-in-memory', type=int, default=MAX_PHRASES_IN_MEMORY, help='Per process, before spilling to disk')
+	parser.add_argument('--work-dir', help='Directory for the spills and sorted runs, defaults to the system temporary directory')
+	arguments = parser.parse_args()
+
+	start_time = time.monotonic()
+	number_phrases = aggregate(arguments.sink_dir, arguments.output_dir, arguments.target_id, arguments.max_input_folders, arguments.workers,
+		arguments.partitions, arguments.max_phrases_in_memory, arguments.work_dir)
+	logger.info(f'Wrote {number_phrases} phrases to {os.path.join(arguments.output_dir, arguments.target_id)} in {time.monotonic() - start_time:.1f}s')
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.getLevelName(os.getenv("LOG_LEVEL", "INFO")), format='%(message)s')
+	main()
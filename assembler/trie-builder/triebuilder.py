@@ -1,16 +1,51 @@
 from hdfs import InsecureClient
 from kazoo.client import KazooClient, DataWatch
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from distutils.util import strtobool
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
 import requests
+import fastavro
+import calendar
 import pickle
+import random
+import tempfile
 import time
+import io
+import json
 import logging
 import os
 
-from trie import Trie
+from trie import TRIE_IMPLEMENTATIONS, token_starts
+from trie_file import write_trie_file, write_sorted_trie_file, sorted_on_disk
 
 PARTITIONS = ((None, 'mod'), ('mod', None))
 ZK_ASSEMBLER_LAST_BUILT_TARGET = '/phrases/assembler/last_built_target'
 ZK_NEXT_TARGET = '/phrases/distributor/next_target'
+ZK_CURRENT_TARGET = '/phrases/distributor/current_target'
+TRIE_IMPLEMENTATION = os.getenv("TRIE_IMPLEMENTATION", "node")
+TRIE_FILE_FORMAT = os.getenv("TRIE_FILE_FORMAT", "pickle")
+TRIE_BUILD_MODE = os.getenv("TRIE_BUILD_MODE", "memory") # "streaming" writes binary trie files from the phrases sorted on disk, in bounded memory
+TRIE_BUILD_SORT_BUFFER_ITEMS = int(os.getenv("TRIE_BUILD_SORT_BUFFER_ITEMS", 1000000)) # Phrases sorted in memory at once in streaming mode
+TRIE_BUILDER_WORKERS = int(os.getenv("TRIE_BUILDER_WORKERS", os.cpu_count()))
+NUMBER_PARTITIONS = int(os.getenv("NUMBER_PARTITIONS", 0)) # When 0, PARTITIONS is used as is
+PARTITION_BALANCE = os.getenv("PARTITION_BALANCE", "count") # One of PARTITION_BALANCE_COSTS
+PARTITION_SAMPLE_SIZE = int(os.getenv("PARTITION_SAMPLE_SIZE", 100000))
+PARTITION_BALANCE_COSTS = {
+	'count': lambda phrase, weight: 1, # Same number of phrases per partition
+	'weight': lambda phrase, weight: weight, # Same query weight per partition, a proxy for the traffic each partition serves
+	'size': lambda phrase, weight: len(phrase), # Same number of characters per partition, an upper bound of its trie nodes
+}
+DELTA_INTERVAL_S = int(os.getenv("DELTA_INTERVAL_S", 0)) # When > 0, weight deltas for the served targets are published this often
+DELTA_BASE_WEIGHT = int(os.getenv("DELTA_BASE_WEIGHT", 100)) # Weight of each search, matching the base weight of the most recent sink folder in do_tasks.sh
+DELTA_SETTLE_S = int(os.getenv("DELTA_SETTLE_S", 600)) # Sink files can appear this long after their modification time, as Kafka Connect renames them into place
+TARGET_INPUT_FILES_NAME = '_input_files' # Lists the sink files of a target's map reduce input, written by do_tasks.sh
+INFIX_INDEX_ENABLED = bool(strtobool(os.getenv("INFIX_INDEX_ENABLED", "false"))) # Also index the phrases by the start of their other words
+
+
+class TrieBuildModeError(Exception):
+	pass
 
 
 class HdfsClient:
@@ -24,8 +59,19 @@ class HdfsClient:
 		ch.setLevel(logging.getLevelName(os.getenv("LOG_LEVEL", "INFO")))
 		self._logger.addHandler(ch)
 
-	def list(self, path):
-		return self._client.list(path) 
+	def list(self, path, status=False):
+		return self._client.list(path, status=status) 
+
+	def read_avro_records(self, hdfs_path):
+		with self._client.read(hdfs_path) as reader:
+			return list(fastavro.reader(io.BytesIO(reader.read())))
+
+	def read_lines(self, hdfs_path):
+		""" Returns the lines of the file, or None if it does not exist """
+		if (self._client.status(hdfs_path, strict=False) is None):
+			return None
+		with self._client.read(hdfs_path, encoding='utf-8') as reader:
+			return reader.read().splitlines()
 
 	def get_stream(self, hdfs_path):
 		request_path = f'http://{self._datanode_host}:9864/webhdfs/v1{hdfs_path}?op=OPEN&namenoderpcaddress={self._namenode_host}:9000&offset=0'
@@ -57,6 +103,9 @@ class HdfsClientGetStream:
 
 class TrieBuilder:
 	def __init__(self):
+		# Checked upfront, as streaming builds would otherwise write binary trie files while pickles are configured
+		if (TRIE_BUILD_MODE == 'streaming' and TRIE_FILE_FORMAT != 'binary'):
+			raise TrieBuildModeError(f'TRIE_BUILD_MODE=streaming only writes binary trie files, but TRIE_FILE_FORMAT is {TRIE_FILE_FORMAT}')
 		self._zk = KazooClient(hosts=f'{os.getenv("ZOOKEEPER_HOST")}:2181')
 		self._hdfsClient = HdfsClient(os.getenv("HADOOP_NAMENODE_HOST"), os.getenv("HADOOP_DATANODE_HOST"))
 		self._logger = logging.getLogger(__name__)
@@ -106,34 +155,151 @@ class TrieBuilder:
 
 		self._logger.info(self._hdfsClient.list("/phrases/4_with_weight_ordered/" + target_id))
 
-		for start, end in PARTITIONS:
-			self._logger.debug(f'start: {start}; end: {end}')
+		with tempfile.TemporaryDirectory() as work_dir:
+			phrases_local_path, sample = self._download_phrases(target_id, work_dir)
+			partitions = self._get_partitions(sample)
+			self._logger.info(f'Partitions for target {target_id}: {partitions}')
+			phrases_local_paths, infixes_local_paths = route_phrases(phrases_local_path, partitions, work_dir)
 
-			trie = self._create_trie(target_id, start, end)
+			# Spawn instead of fork, as this process is running the zookeeper client threads
+			with ProcessPoolExecutor(max_workers=TRIE_BUILDER_WORKERS, mp_context=multiprocessing.get_context('spawn')) as executor:
+				futures = dict()
+				for (start, end), partition_phrases_local_path, infixes_local_path in zip(partitions, phrases_local_paths, infixes_local_paths):
+					trie_local_path = f'{partition_phrases_local_path}.trie'
+					futures[executor.submit(build_trie_file, partition_phrases_local_path, infixes_local_path, trie_local_path)] = (start, end, trie_local_path)
 
-			trie_local_file_name = "trie.dat"
-			pickle.dump(trie, open(trie_local_file_name, "wb"))
+				for future in as_completed(futures):
+					start, end, trie_local_path = futures[future]
+					future.result()
+					self._logger.debug(f'Built trie for start: {start}; end: {end}')
 
-			trie_remote_hdfs_path = self._get_trie_remote_hdfs_path(target_id, start, end)
-			self._hdfsClient.upload_to_hdfs(trie_local_file_name, trie_remote_hdfs_path)
-			self._register_trie_zookeeper(target_id, start, end, trie_remote_hdfs_path)
+					trie_remote_hdfs_path = self._get_trie_remote_hdfs_path(target_id, start, end)
+					self._hdfsClient.upload_to_hdfs(trie_local_path, trie_remote_hdfs_path)
+					self._register_trie_zookeeper(target_id, start, end, trie_remote_hdfs_path)
 
 		self._register_next_target_zookeeper(target_id)
 
 		return True
 
 
-	def _create_trie(self, target_id, start, end):
-		trie = Trie()
-		with self._hdfsClient.get_stream(f'/phrases/4_with_weight_ordered/{target_id}/part-r-00000') as stream:
-			for line_bytes in stream.iter_lines():
-				if (not line_bytes):
+	def build_deltas(self):
+		""" Publishes the weight deltas of the phrases searched since the last deltas of the current and next targets """
+		target_ids = set()
+		for zk_path in (ZK_CURRENT_TARGET, ZK_NEXT_TARGET):
+			if (self._zk.exists(zk_path) is not None):
+				target_ids.add(self._zk.get(zk_path)[0].decode())
+
+		for target_id in sorted(target_id for target_id in target_ids if target_id):
+			try:
+				self._build_target_deltas(target_id)
+			except Exception as e:
+				self._logger.error(f'Could not build deltas for target {target_id}', exc_info=e)
+
+	def _build_target_deltas(self, target_id):
+		"""
+		Sums the weights of the sink records the target does not include yet, uploads them as a file of "weight delta\tphrase"
+		lines and registers it as the next of the target's sequential delta nodes. Backends apply these deltas on top of their
+		trie until the next full build replaces it.
+
+		Kafka Connect renames its sink files into place, which keeps their modification time, so a file can appear after files
+		modified later than it. The deltas node then keeps a watermark, the latest modification time of the included files,
+		along with the names of the included files modified less than DELTA_SETTLE_S before it; older files are all included.
+		"""
+		deltas_zk_path = f'/phrases/distributor/{target_id}/deltas'
+		if (self._zk.exists(f'/phrases/distributor/{target_id}') is None):
+			return
+		self._zk.ensure_path(deltas_zk_path)
+		watermark_ms, settled_ms, included_file_paths = self._get_deltas_state(target_id, self._zk.get(deltas_zk_path)[0])
+
+		phrase_weight_deltas = Counter()
+		modification_times_ms = dict()
+		for folder_name in sorted(self._hdfsClient.list('/phrases/1_sink/phrases')):
+			folder_path = f'/phrases/1_sink/phrases/{folder_name}'
+			for file_name, status in self._hdfsClient.list(folder_path, status=True):
+				if (not file_name.endswith('.avro')):
 					continue
-				phrase = line_bytes.decode("utf-8").split('\t', maxsplit=1)[1]
-				if ((not start or phrase >= start) and (not end or phrase < end)):
-					self._logger.debug(f'Adding phrase: {phrase} for partition {start}|{end}')
-					trie.add_phrase(phrase)
-		return trie
+				file_path = f'{folder_path}/{file_name}'
+				modification_times_ms[file_path] = status['modificationTime']
+				if (status['modificationTime'] <= settled_ms or file_path in included_file_paths):
+					continue
+				for record in self._hdfsClient.read_avro_records(file_path):
+					phrase_weight_deltas[record['phrase']] += record.get('count', 1) * DELTA_BASE_WEIGHT
+
+		if (phrase_weight_deltas):
+			with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.tsv') as deltas_local_file:
+				for phrase, weight_delta in phrase_weight_deltas.items():
+					deltas_local_file.write(f'{weight_delta}\t{phrase}\n')
+				deltas_local_file.flush()
+				# Named by creation time, as files appearing late can leave the watermark where it was
+				deltas_remote_hdfs_path = f'/phrases/6_deltas/{target_id}/{int(time.time() * 1000)}'
+				self._hdfsClient.upload_to_hdfs(deltas_local_file.name, deltas_remote_hdfs_path)
+			self._zk.create(f'{deltas_zk_path}/delta-', value=deltas_remote_hdfs_path.encode(), sequence=True)
+			self._logger.info(f'Published {len(phrase_weight_deltas)} phrase weight deltas for target {target_id}')
+
+		# Every listed file is now included, either before or by these deltas
+		next_watermark_ms = max([watermark_ms] + list(modification_times_ms.values()))
+		included_file_paths = sorted(path for path, modification_time_ms in modification_times_ms.items() if (modification_time_ms > next_watermark_ms - DELTA_SETTLE_S * 1000))
+		self._zk.set(deltas_zk_path, json.dumps({'watermark_ms': next_watermark_ms, 'included_files': included_file_paths}).encode())
+
+	def _get_deltas_state(self, target_id, state_data):
+		"""
+		Returns the watermark of the target's deltas, the modification time up to which sink files are all included, and the
+		paths of the files included after it. Before the first deltas, these are the files the target's map reduce input
+		listed, or, for targets built without that list, all the files modified before the target was created.
+		"""
+		if (state_data):
+			state = json.loads(state_data.decode())
+			if (isinstance(state, int)): # A watermark alone, as written before the included files were kept
+				return state, state, set()
+			return state['watermark_ms'], state['watermark_ms'] - DELTA_SETTLE_S * 1000, set(state['included_files'])
+
+		watermark_ms = calendar.timegm(time.strptime(target_id, '%Y%m%d_%H%M')) * 1000
+		input_file_paths = self._hdfsClient.read_lines(f'/phrases/4_with_weight_ordered/{target_id}/{TARGET_INPUT_FILES_NAME}')
+		if (input_file_paths is None):
+			return watermark_ms, watermark_ms, set()
+		return watermark_ms, watermark_ms - DELTA_SETTLE_S * 1000, set(input_file_paths)
+
+	def _download_phrases(self, target_id, work_dir):
+		"""
+		Reads the target's phrases once from HDFS into a single local file of "weight\tphrase" lines.
+		Returns its path, along with a uniform sample of (phrase, weight) pairs, of at most PARTITION_SAMPLE_SIZE entries.
+		"""
+		phrases_local_path = os.path.join(work_dir, 'phrases.tsv')
+		sample = []
+		number_phrases = 0
+		with open(phrases_local_path, 'wb') as phrases_local_file:
+			# Tries keep the top phrases by weight, so the part files can be read in any order
+			for part_file_name in self._list_part_files(target_id):
+				with self._hdfsClient.get_stream(f'/phrases/4_with_weight_ordered/{target_id}/{part_file_name}') as stream:
+					for line_bytes in stream.iter_lines():
+						if (not line_bytes):
+							continue
+						phrases_local_file.write(line_bytes + b'\n')
+
+						# Reservoir sampling, so the sample does not depend on the order of the input
+						number_phrases += 1
+						i = number_phrases - 1 if (number_phrases <= PARTITION_SAMPLE_SIZE) else random.randrange(number_phrases)
+						if (i < PARTITION_SAMPLE_SIZE):
+							weight, phrase = line_bytes.decode("utf-8").split('\t', maxsplit=1)
+							if (i == len(sample)):
+								sample.append((phrase, int(weight)))
+							else:
+								sample[i] = (phrase, int(weight))
+
+		return phrases_local_path, sample
+
+	def _get_partitions(self, sample):
+		if (not NUMBER_PARTITIONS):
+			return PARTITIONS
+
+		cost = PARTITION_BALANCE_COSTS[PARTITION_BALANCE]
+		boundaries = compute_partition_boundaries([(phrase, cost(phrase, weight)) for phrase, weight in sample], NUMBER_PARTITIONS)
+		starts = [None] + boundaries
+		ends = boundaries + [None]
+		return tuple(zip(starts, ends))
+
+	def _list_part_files(self, target_id):
+		return sorted(file_name for file_name in self._hdfsClient.list(f'/phrases/4_with_weight_ordered/{target_id}') if file_name.startswith('part-'))
 
 	def _start_end_representation(self, start, end):
 		return f'{start if (start) else ""}|{end if (end) else ""}'
@@ -155,10 +321,125 @@ class TrieBuilder:
 
 
 
+def compute_partition_boundaries(sample, number_partitions):
+	"""
+	Splits the phrase space into number_partitions ranges of roughly the same total cost, given a sample of (phrase, cost) pairs.
+	Returns the sorted boundaries between consecutive ranges, each one the shortest prefix that still separates the sample
+	phrases around the split point. Fewer boundaries are returned when the sample cannot be split that many times.
+	"""
+	sample = sorted(sample)
+	total_cost = sum(cost for _, cost in sample)
+	boundaries = []
+	cumulative_cost = 0
+	previous_phrase = ''
+	for phrase, cost in sample:
+		if (len(boundaries) == number_partitions - 1):
+			break
+		if (cumulative_cost >= total_cost * (len(boundaries) + 1) / number_partitions and phrase > previous_phrase):
+			boundary = next(phrase[:length] for length in range(1, len(phrase) + 1) if phrase[:length] > previous_phrase)
+			# Boundaries are part of zookeeper node names, so they cannot contain a slash
+			if ('/' not in boundary and (not boundaries or boundary > boundaries[-1])):
+				boundaries.append(boundary)
+		cumulative_cost += cost
+		previous_phrase = phrase
+
+	return boundaries
+
+
+def route_phrases(phrases_local_path, partitions, work_dir):
+	"""
+	Appends each "weight\tphrase" line to the local file of the partition its phrase belongs to. With the infix index
+	enabled, the phrase is also indexed by the partitions its later words start in: each gets a "weight\toffsets\tphrase"
+	line in its infix file, with the comma separated offsets of the words (in the lowercase phrase) it serves.
+	Returns the local phrases and infix file paths, in the same order as the partitions, which must be sorted and contiguous.
+	"""
+	starts = [start or '' for start, _ in partitions]
+
+	def partition_index(phrase):
+		i = bisect_right(starts, phrase) - 1
+		if (i >= 0 and (not partitions[i][1] or phrase < partitions[i][1])):
+			return i
+		return None
+
+	partition_local_paths = [os.path.join(work_dir, f'partition-{i}.tsv') for i in range(len(partitions))]
+	infixes_local_paths = [os.path.join(work_dir, f'partition-{i}.infix.tsv') for i in range(len(partitions))]
+	partition_local_files = [open(path, 'wb') for path in partition_local_paths]
+	infixes_local_files = [open(path, 'wb') for path in infixes_local_paths]
+	try:
+		with open(phrases_local_path, 'rb') as phrases_local_file:
+			for line_bytes in phrases_local_file:
+				weight, phrase = line_bytes.decode("utf-8").rstrip('\n').split('\t', maxsplit=1)
+				i = partition_index(phrase)
+				if (i is not None):
+					partition_local_files[i].write(line_bytes)
+
+				if (INFIX_INDEX_ENABLED):
+					lowercase_phrase = phrase.lower()
+					offsets_by_partition = defaultdict(list)
+					for offset in token_starts(lowercase_phrase):
+						i = partition_index(lowercase_phrase[offset:])
+						if (i is not None):
+							offsets_by_partition[i].append(str(offset))
+					for i, offsets in offsets_by_partition.items():
+						infixes_local_files[i].write(f'{weight}\t{",".join(offsets)}\t{phrase}\n'.encode("utf-8"))
+	finally:
+		for partition_local_file in partition_local_files + infixes_local_files:
+			partition_local_file.close()
+
+	return partition_local_paths, infixes_local_paths
+
+
+def build_trie_file(phrases_local_path, infixes_local_path, trie_local_path):
+	"""
+	Builds the trie for a partition's "weight\tphrase" lines, and its infix index for the "weight\toffsets\tphrase" ones,
+	and serializes it. Runs in the builder's process pool.
+	"""
+	if (TRIE_BUILD_MODE == 'streaming'):
+		# The whole trie is never held in memory, so it can only be written as a binary trie file
+		work_dir = os.path.dirname(trie_local_path)
+		sort_key = lambda entry: entry[0].lower()
+		write_sorted_trie_file(
+			sorted_on_disk(read_phrases(phrases_local_path), work_dir, sort_key, TRIE_BUILD_SORT_BUFFER_ITEMS),
+			sorted_on_disk(read_infix_phrases(infixes_local_path), work_dir, sort_key, TRIE_BUILD_SORT_BUFFER_ITEMS),
+			trie_local_path, work_dir, TRIE_BUILD_SORT_BUFFER_ITEMS)
+		return
+
+	trie = TRIE_IMPLEMENTATIONS[TRIE_IMPLEMENTATION]()
+	for phrase, weight in read_phrases(phrases_local_path):
+		trie.add_phrase(phrase, weight)
+	for phrase, weight, offsets in read_infix_phrases(infixes_local_path):
+		trie.add_infix_phrase(phrase, weight, offsets)
+
+	if (TRIE_FILE_FORMAT == 'binary'):
+		write_trie_file(trie, trie_local_path)
+	else:
+		pickle.dump(trie, open(trie_local_path, "wb"))
+
+
+def read_phrases(phrases_local_path):
+	""" Yields the (phrase, weight) pairs of a file of "weight\tphrase" lines """
+	with open(phrases_local_path, 'rb') as f:
+		for line_bytes in f:
+			weight, phrase = line_bytes.decode("utf-8").rstrip('\n').split('\t', maxsplit=1)
+			yield phrase, int(weight)
+
+
+def read_infix_phrases(infixes_local_path):
+	""" Yields the (phrase, weight, offsets) entries of a file of "weight\toffsets\tphrase" lines """
+	with open(infixes_local_path, 'rb') as f:
+		for line_bytes in f:
+			weight, offsets, phrase = line_bytes.decode("utf-8").rstrip('\n').split('\t', maxsplit=2)
+			yield phrase, int(weight), [int(offset) for offset in offsets.split(',')]
+
+
 if __name__ == '__main__':
 	trie_builder = TrieBuilder()
 	trie_builder.start()
 	trie_builder.build_most_recent()
 
+	last_deltas_time = time.monotonic()
 	while True:
-	    time.sleep(5)
\ No newline at end of file
+		time.sleep(5)
+		if (DELTA_INTERVAL_S > 0 and time.monotonic() - last_deltas_time >= DELTA_INTERVAL_S):
+			trie_builder.build_deltas()
+			last_deltas_time = time.monotonic()
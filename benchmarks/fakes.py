@@ -0,0 +1,421 @@
+"""
+In-memory stand-ins for the external services the autocomplete services talk to: ZooKeeper (through kazoo), Redis,
+WebHDFS (through hdfs' InsecureClient) and the Kafka Avro producer. They implement just the calls the services make,
+so the services' own code can run unchanged against them, see load_test.py.
+"""
+import os
+import queue
+import shutil
+import threading
+import time
+from collections import defaultdict
+from kazoo.exceptions import NoNodeError, NodeExistsError, NotEmptyError
+from kazoo.protocol.states import EventType, KazooState, WatchedEvent, ZnodeStat
+
+
+class FakeZooKeeper:
+	"""
+	Znode tree shared by the FakeKazooClients of a process. Like a kazoo client, watch callbacks are run one at a time
+	by a single event thread, never by the thread that made the change.
+	"""
+
+	def __init__(self):
+		self._lock = threading.RLock()
+		self._nodes = {'/': [b'', 0, None]} # path -> [data, version, ephemeral owner]
+		self._children = defaultdict(set)
+		self._sequences = defaultdict(int)
+		self._data_watches = defaultdict(list) # path -> one-shot watches of its data
+		self._children_watches = defaultdict(list) # path -> one-shot watches of its children
+		self._events = queue.Queue()
+		threading.Thread(target=self._event_loop, daemon=True).start()
+
+	def exists(self, path, watch=None):
+		path = _normalize(path)
+		with self._lock:
+			if (watch is not None):
+				self._data_watches[path].append(watch)
+			return self._stat(path) if (path in self._nodes) else None
+
+	def get(self, path, watch=None):
+		path = _normalize(path)
+		with self._lock:
+			if (path not in self._nodes):
+				raise NoNodeError(path)
+			if (watch is not None):
+				self._data_watches[path].append(watch)
+			return self._nodes[path][0], self._stat(path)
+
+	def get_children(self, path, watch=None):
+		path = _normalize(path)
+		with self._lock:
+			if (path not in self._nodes):
+				raise NoNodeError(path)
+			if (watch is not None):
+				self._children_watches[path].append(watch)
+			return sorted(self._children[path])
+
+	def set(self, path, value):
+		path = _normalize(path)
+		with self._lock:
+			if (path not in self._nodes):
+				raise NoNodeError(path)
+			node = self._nodes[path]
+			node[0] = value
+			node[1] += 1
+			self._fire(self._data_watches, path, EventType.CHANGED)
+			return self._stat(path)
+
+	def create(self, path, value, owner, sequence, makepath):
+		path = _normalize(path) if (not sequence) else path
+		parent, _, name = path.rpartition('/')
+		parent = parent or '/'
+		with self._lock:
+			if (parent not in self._nodes):
+				if (not makepath):
+					raise NoNodeError(parent)
+				self.create(parent, b'', None, False, True)
+			if (sequence):
+				# Like zookeeper, the suffix is a 10 digit counter of the parent's children
+				name = f'{name}{self._sequences[parent]:010d}'
+				path = f'{parent.rstrip("/")}/{name}'
+			if (path in self._nodes):
+				raise NodeExistsError(path)
+			self._sequences[parent] += 1
+			self._nodes[path] = [value, 0, owner]
+			self._children[parent].add(name)
+			self._fire(self._data_watches, path, EventType.CREATED)
+			self._fire(self._children_watches, parent, EventType.CHILD)
+			return path
+
+	def delete(self, path):
+		path = _normalize(path)
+		with self._lock:
+			if (path not in self._nodes):
+				raise NoNodeError(path)
+			if (self._children[path]):
+				raise NotEmptyError(path)
+			del self._nodes[path]
+			parent, _, name = path.rpartition('/')
+			parent = parent or '/'
+			self._children[parent].discard(name)
+			self._fire(self._data_watches, path, EventType.DELETED)
+			self._fire(self._children_watches, path, EventType.DELETED)
+			self._fire(self._children_watches, parent, EventType.CHILD)
+
+	def delete_ephemeral_nodes(self, owner):
+		with self._lock:
+			for path in sorted((path for path, node in self._nodes.items() if node[2] is owner), reverse=True):
+				self.delete(path)
+
+	def spawn(self, func, *args):
+		""" Runs the function in the event thread, after the watches that are already due """
+		self._events.put((func, args))
+
+	def _stat(self, path):
+		data, version, owner = self._nodes[path]
+		return ZnodeStat(czxid=0, mzxid=version, ctime=0, mtime=0, version=version, cversion=self._sequences[path], aversion=0,
+			ephemeralOwner=id(owner) if (owner is not None) else 0, dataLength=len(data or b''), numChildren=len(self._children[path]), pzxid=0)
+
+	def _fire(self, watches, path, event_type):
+		for watch in watches.pop(path, []):
+			self._events.put((watch, (WatchedEvent(event_type, KazooState.CONNECTED, path),)))
+
+	def _event_loop(self):
+		while True:
+			func, args = self._events.get()
+			try:
+				func(*args)
+			except Exception:
+				pass # As in kazoo, an error in one callback does not stop the others
+
+
+class FakeKazooClient:
+	""" Drop-in for kazoo.client.KazooClient, backed by a FakeZooKeeper: KazooClient = partial(FakeKazooClient, zookeeper) """
+
+	def __init__(self, zookeeper, hosts=None, **kwargs):
+		self._zookeeper = zookeeper
+		self._listeners = []
+		self.handler = self
+		self.connected = False
+
+	def start(self, timeout=15):
+		self.connected = True
+		for listener in list(self._listeners):
+			listener(KazooState.CONNECTED)
+
+	def stop(self):
+		# Closing the session removes its ephemeral nodes, as when a real client disconnects
+		self.connected = False
+		self._zookeeper.delete_ephemeral_nodes(self)
+
+	def add_listener(self, listener):
+		self._listeners.append(listener)
+
+	def spawn(self, func, *args):
+		self._zookeeper.spawn(func, *args)
+
+	def exists(self, path, watch=None):
+		return self._zookeeper.exists(path, watch)
+
+	def get(self, path, watch=None):
+		return self._zookeeper.get(path, watch)
+
+	def get_children(self, path, watch=None):
+		return self._zookeeper.get_children(path, watch)
+
+	def set(self, path, value, version=-1):
+		return self._zookeeper.set(path, value)
+
+	def create(self, path, value=b'', acl=None, ephemeral=False, sequence=False, makepath=False):
+		return self._zookeeper.create(path, value, self if (ephemeral) else None, sequence, makepath)
+
+	def delete(self, path, version=-1, recursive=False):
+		self._zookeeper.delete(path)
+
+	def ensure_path(self, path, acl=None):
+		if (self._zookeeper.exists(path) is None):
+			self._zookeeper.create(path, b'', None, False, True)
+		return True
+
+	def sync(self, path):
+		return path
+
+
+def FakeDataWatch(client, path, func):
+	"""
+	Drop-in for kazoo's DataWatch: calls func(data, stat) right away and again after every change of the node,
+	with None for both while it does not exist, until func returns False.
+	"""
+	stopped = False
+	def watch(event=None):
+		nonlocal stopped
+		if (stopped):
+			return
+		stat = client.exists(path, watch=watch)
+		try:
+			data, stat = client.get(path) if (stat is not None) else (None, None)
+		except NoNodeError:
+			data, stat = None, None # Deleted in between, the watch set by exists() fires again
+		stopped = (func(data, stat) is False)
+	watch()
+
+def FakeChildrenWatch(client, path, func):
+	""" Drop-in for kazoo's ChildrenWatch: calls func(children) right away and again after every change, until func returns False """
+	stopped = False
+	def watch(event=None):
+		nonlocal stopped
+		if (not stopped):
+			stopped = (func(client.get_children(path, watch=watch)) is False)
+	watch()
+
+
+class FakeRedis:
+	"""
+	Drop-in for redis.Redis, with the commands the frontend and the applier use. Each command, or each pipeline,
+	sleeps for round_trip_s to stand in for the network.
+	"""
+
+	def __init__(self, host=None, port=6379, db=0, round_trip_s=0, **kwargs):
+		self._round_trip_s = round_trip_s
+		self._values = dict() # key -> (value, expiration time or None)
+		self._sorted_sets = defaultdict(dict)
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		self._round_trip()
+		return self._get(key)
+
+	def set(self, key, value, ex=None):
+		self._round_trip()
+		return self._set(key, value, ex)
+
+	def pttl(self, key):
+		self._round_trip()
+		return self._pttl(key)
+
+	def zincrby(self, name, amount, value):
+		self._round_trip()
+		return self._zincrby(name, amount, value)
+
+	def zremrangebyrank(self, name, start, end):
+		self._round_trip()
+		return self._zremrangebyrank(name, start, end)
+
+	def zrevrange(self, name, start, end):
+		self._round_trip()
+		return self._zrevrange(name, start, end)
+
+	def pipeline(self, transaction=True):
+		return FakeRedisPipeline(self)
+
+	def _get(self, key):
+		with self._lock:
+			entry = self._values.get(_key_bytes(key))
+			if (entry is None or (entry[1] is not None and entry[1] <= time.monotonic())):
+				return None
+			return entry[0]
+
+	def _set(self, key, value, ex=None):
+		if (isinstance(value, str)):
+			value = value.encode('utf-8')
+		with self._lock:
+			self._values[_key_bytes(key)] = (value, time.monotonic() + ex if (ex) else None)
+		return True
+
+	def _pttl(self, key):
+		with self._lock:
+			entry = self._values.get(_key_bytes(key))
+			if (entry is None or (entry[1] is not None and entry[1] <= time.monotonic())):
+				return -2
+			return -1 if (entry[1] is None) else int((entry[1] - time.monotonic()) * 1000)
+
+	def _zincrby(self, name, amount, value):
+		with self._lock:
+			sorted_set = self._sorted_sets[_key_bytes(name)]
+			value = _key_bytes(value)
+			sorted_set[value] = sorted_set.get(value, 0) + amount
+			return sorted_set[value]
+
+	def _zremrangebyrank(self, name, start, end):
+		with self._lock:
+			sorted_set = self._sorted_sets[_key_bytes(name)]
+			ranked = sorted(sorted_set, key=lambda value: (sorted_set[value], value))
+			removed = ranked[start:(end + 1) or None] if (end != -1) else ranked[start:]
+			for value in removed:
+				del sorted_set[value]
+			return len(removed)
+
+	def _zrevrange(self, name, start, end):
+		with self._lock:
+			sorted_set = self._sorted_sets[_key_bytes(name)]
+			ranked = sorted(sorted_set, key=lambda value: (sorted_set[value], value), reverse=True)
+			return ranked[start:(end + 1) or None] if (end != -1) else ranked[start:]
+
+	def _round_trip(self):
+		if (self._round_trip_s > 0):
+			time.sleep(self._round_trip_s)
+
+class FakeRedisPipeline:
+	""" Queues the commands, running them in a single round trip on execute() """
+
+	def __init__(self, fake_redis):
+		self._fake_redis = fake_redis
+		self._commands = []
+
+	def __getattr__(self, name):
+		command = getattr(self._fake_redis, f'_{name}')
+		def queue_command(*args, **kwargs):
+			self._commands.append((command, args, kwargs))
+			return self
+		return queue_command
+
+	def execute(self):
+		self._fake_redis._round_trip()
+		commands, self._commands = self._commands, []
+		return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class FakeInsecureClient:
+	""" Drop-in for hdfs.InsecureClient, keeping the HDFS files under a local directory: InsecureClient = partial(FakeInsecureClient, root_dir=...) """
+
+	def __init__(self, url, root_dir, **kwargs):
+		self._root_dir = root_dir
+
+	def download(self, hdfs_path, local_path, overwrite=False, **kwargs):
+		if (not overwrite and os.path.exists(local_path)):
+			raise FileExistsError(local_path)
+		shutil.copyfile(self._local_path(hdfs_path), local_path)
+		return local_path
+
+	def upload(self, hdfs_path, local_path, overwrite=False, **kwargs):
+		os.makedirs(os.path.dirname(self._local_path(hdfs_path)), exist_ok=True)
+		shutil.copyfile(local_path, self._local_path(hdfs_path))
+		return hdfs_path
+
+	def read(self, hdfs_path, encoding=None, **kwargs):
+		return open(self._local_path(hdfs_path), 'r' if (encoding) else 'rb', encoding=encoding)
+
+	def list(self, hdfs_path, status=False):
+		names = sorted(os.listdir(self._local_path(hdfs_path)))
+		if (status):
+			return [(name, {'length': os.path.getsize(os.path.join(self._local_path(hdfs_path), name))}) for name in names]
+		return names
+
+	def makedirs(self, hdfs_path, **kwargs):
+		os.makedirs(self._local_path(hdfs_path), exist_ok=True)
+
+	def _local_path(self, hdfs_path):
+		return os.path.join(self._root_dir, hdfs_path.lstrip('/'))
+
+
+class FakeAvroProducer:
+	"""
+	Drop-in for confluent_kafka.avro.AvroProducer, keeping the produced records in memory. It honours the config's
+	on_delivery callback and queue.buffering.max.messages bound, and flushing a non empty queue sleeps for round_trip_s
+	to stand in for the broker.
+	"""
+
+	def __init__(self, config, default_key_schema=None, default_value_schema=None, round_trip_s=0):
+		self._on_delivery = config.get('on_delivery')
+		self._max_queued_messages = config.get('queue.buffering.max.messages', 100000)
+		self._round_trip_s = round_trip_s
+		self._queued_messages = []
+		self._lock = threading.Lock()
+		self.produced = 0
+		self.delivered = 0
+
+	def produce(self, topic, value=None, key=None, **kwargs):
+		with self._lock:
+			if (len(self._queued_messages) >= self._max_queued_messages):
+				raise BufferError('Local: Queue full')
+			self._queued_messages.append(FakeMessage(topic, key, value))
+			self.produced += 1
+
+	def poll(self, timeout=None):
+		return self._deliver()
+
+	def flush(self, timeout=None):
+		self._deliver()
+		return 0
+
+	def __len__(self):
+		return len(self._queued_messages)
+
+	def _deliver(self):
+		with self._lock:
+			messages, self._queued_messages = self._queued_messages, []
+		if (messages and self._round_trip_s > 0):
+			time.sleep(self._round_trip_s)
+		for message in messages:
+			if (self._on_delivery):
+				self._on_delivery(None, message)
+		self.delivered += len(messages)
+		return len(messages)
+
+class FakeMessage:
+	def __init__(self, topic, key, value):
+		self._topic = topic
+		self._key = key
+		self._value = value
+
+	def topic(self):
+		return self._topic
+
+	def partition(self):
+		return 0
+
+	def key(self):
+		return self._key
+
+	def value(self):
+		return self._value
+
+	def error(self):
+		return None
+
+
+def _normalize(path):
+	return path.rstrip('/') or '/'
+
+def _key_bytes(key):
+	return key.encode('utf-8') if (isinstance(key, str)) else key
@@ -0,0 +1,464 @@
+"""
+End-to-end load test of the serving and collection paths on a single machine, without docker.
+
+The services' own code runs unchanged, pointed at the in-memory fakes of fakes.py instead of ZooKeeper, Redis, HDFS
+and Kafka: the tries of a synthetic (or given) corpus are built with the trie builder's functions and registered as
+the current target, the backends join it and serve their partitions over HTTP on 127.0.0.2, 127.0.0.3, ..., port 8001,
+and the frontend's and the collector's WSGI apps are called in-process, the frontend sending its requests to the
+backends as it does in production, over kept-alive HTTP/1.1 connections. Backends run as threads of this process, or as
+local processes with --processes. The frontend stages are measured in this process, whose threads compete for its GIL,
+so they include that wait, which grows with --concurrency.
+
+Traffic is a list of sessions, each run by one of --concurrency threads with no pause in between: by default every
+session types the start of a phrase picked with a Zipf distribution, looking up each prefix, and sometimes submits it.
+It can be saved with --save-traffic and replayed with --traffic, so two commits can be compared on the same requests.
+The latency of each stage, the calls per second and their p50/p99/p999 are printed, and written as JSON with --output.
+
+	python benchmarks/load_test.py --phrases 100000 --sessions 5000 --concurrency 8 --output results.json
+"""
+import argparse
+import importlib.util
+import json
+import math
+import multiprocessing
+import os
+import random
+import redis
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from functools import partial, wraps
+from itertools import accumulate
+from socketserver import ThreadingMixIn
+from types import SimpleNamespace
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer, make_server
+
+import falcon.testing
+
+from fakes import FakeAvroProducer, FakeChildrenWatch, FakeDataWatch, FakeInsecureClient, FakeKazooClient, FakeRedis, FakeZooKeeper
+
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICE_DIRS = [os.path.join(REPOSITORY_DIR, path) for path in ('shared', 'distributor/backend', 'distributor/frontend', 'assembler/collector', 'assembler/trie-builder')]
+TARGET_ID = 'load-test'
+BACKEND_PORT = 8001 # The port the frontend sends its requests to
+ZIPF_WEIGHT_SCALE = 1000000 # Weight of the most popular phrase of a synthetic corpus
+SYLLABLES = [consonant + vowel for consonant in 'bcdfghjklmnprstvz' for vowel in 'aeiou']
+PERCENTILES = (('p50', 50), ('p99', 99), ('p999', 99.9))
+
+
+class StageLatencies:
+	""" Latencies of each stage in seconds, and their number of errors, recorded only while measuring is set """
+
+	def __init__(self, measuring):
+		self._measuring = measuring
+		self._lock = threading.Lock()
+		self.latencies = defaultdict(list)
+		self.errors = defaultdict(int)
+
+	def record(self, stage, latency_s, error=False):
+		if (not self._measuring.is_set()):
+			return
+		with self._lock:
+			self.latencies[stage].append(latency_s)
+			if (error):
+				self.errors[stage] += 1
+
+	def instrument(self, cls, method_name, stage):
+		""" Records the latency of each call of the method, for all the instances of the class """
+		method = getattr(cls, method_name)
+
+		@wraps(method)
+		def timed_method(*args, **kwargs):
+			start_time = time.perf_counter()
+			error = True
+			try:
+				result = method(*args, **kwargs)
+				error = False
+				return result
+			finally:
+				self.record(stage, time.perf_counter() - start_time, error)
+		setattr(cls, method_name, timed_method)
+
+	def timed_app(self, app, stage):
+		""" Wraps a WSGI app, recording the time to respond to each request and the ones that were not successful """
+		def timed(environ, start_response):
+			start_time = time.perf_counter()
+			statuses = []
+			def recording_start_response(status, headers, exc_info=None):
+				statuses.append(status)
+				return start_response(status, headers, exc_info)
+			body = list(app(environ, recording_start_response))
+			self.record(stage, time.perf_counter() - start_time, not statuses or not statuses[0].startswith('2'))
+			return body
+		return timed
+
+	def merge(self, latencies, errors):
+		with self._lock:
+			for stage, stage_latencies in latencies.items():
+				self.latencies[stage].extend(stage_latencies)
+			for stage, stage_errors in errors.items():
+				self.errors[stage] += stage_errors
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+	daemon_threads = True
+	request_queue_size = 128
+
+class KeepAliveServerHandler(ServerHandler):
+	http_version = '1.1'
+
+class QuietRequestHandler(WSGIRequestHandler):
+	"""
+	Serves the requests of a connection until the client closes it, as the frontend's pooled HTTP/1.1 connections expect,
+	instead of wsgiref's single request per connection, which would add a new connection to each backend request
+	"""
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True # The headers and the body are separate writes, which would wait for the delayed ACK of the previous one
+
+	def handle(self):
+		self.close_connection = True
+		self.handle_one_request()
+		while (not self.close_connection):
+			self.handle_one_request()
+
+	def handle_one_request(self):
+		self.raw_requestline = self.rfile.readline(65537)
+		if (not self.raw_requestline or len(self.raw_requestline) > 65536):
+			self.close_connection = True
+			return
+		if (not self.parse_request()): # An error was sent, and the connection is closed
+			return
+		handler = KeepAliveServerHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ(), multithread=True)
+		handler.request_handler = self
+		handler.run(self.server.get_app())
+
+	def log_message(self, format, *args):
+		pass
+
+class HostnameSocket:
+	""" Stands in for the socket module of backend.py, so that each backend registers its own address as its hostname """
+
+	def __init__(self, hostname):
+		self._hostname = hostname
+
+	def gethostname(self):
+		return self._hostname
+
+	def __getattr__(self, name):
+		return getattr(socket, name)
+
+
+def load_service_modules(zookeeper, hdfs_root_dir, redis_round_trip_s, broker_round_trip_s):
+	""" Imports the services' modules, with their clients of the external services replaced by the fakes """
+	sys.path[:0] = [path for path in SERVICE_DIRS if path not in sys.path]
+	import backend, frontend, collector, triebuilder
+
+	backend.KazooClient = partial(FakeKazooClient, zookeeper)
+	backend.DataWatch = FakeDataWatch
+	backend.ChildrenWatch = FakeChildrenWatch
+	backend.InsecureClient = partial(FakeInsecureClient, root_dir=hdfs_root_dir)
+	frontend.KazooClient = partial(FakeKazooClient, zookeeper)
+	frontend.DataWatch = FakeDataWatch
+	frontend.redis = SimpleNamespace(Redis=partial(FakeRedis, round_trip_s=redis_round_trip_s), RedisError=redis.RedisError)
+	collector.AvroProducer = partial(FakeAvroProducer, round_trip_s=broker_round_trip_s)
+	return SimpleNamespace(backend=backend, frontend=frontend, collector=collector, triebuilder=triebuilder)
+
+def load_app_module(service_dir, name):
+	""" Runs a service's main.py as a new module, which creates its resource and WSGI app """
+	spec = importlib.util.spec_from_file_location(name, os.path.join(REPOSITORY_DIR, service_dir, 'main.py'))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+
+def synthetic_corpus(number_phrases, rng):
+	""" Returns distinct phrases of one to three made up words, in a random order that is taken as their popularity rank """
+	words = list({''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))) for _ in range(max(1000, number_phrases // 5))})
+	words.sort()
+	phrases = dict()
+	while (len(phrases) < number_phrases):
+		phrases[' '.join(rng.choice(words) for _ in range(rng.choice((1, 2, 2, 3))))] = None
+	return list(phrases)
+
+def synthetic_sessions(phrases, number_sessions, zipf_exponent, submit_ratio, rng):
+	"""
+	Each session picks a phrase, the most popular ones first with a Zipf distribution, and types a random number of its
+	characters, looking up the prefix after each one. Some sessions then submit the phrase.
+	"""
+	cumulative_weights = list(accumulate(1 / (rank + 1) ** zipf_exponent for rank in range(len(phrases))))
+	sessions = []
+	for phrase in rng.choices(phrases, cum_weights=cumulative_weights, k=number_sessions):
+		session = [('lookup', phrase[:length]) for length in range(1, rng.randint(1, len(phrase)) + 1)]
+		if (rng.random() < submit_ratio):
+			session.append(('collect', phrase))
+		sessions.append(session)
+	return sessions
+
+def read_traffic(path):
+	""" Reads sessions of "lookup\tprefix" and "collect\tphrase" lines, separated by empty lines """
+	sessions = [[]]
+	with open(path, encoding='utf-8') as f:
+		for line in f:
+			line = line.rstrip('\n')
+			if (not line):
+				if (sessions[-1]):
+					sessions.append([])
+				continue
+			action, text = line.split('\t', maxsplit=1)
+			if (action not in ('lookup', 'collect')):
+				raise ValueError(f'Unknown traffic action {action}')
+			sessions[-1].append((action, text))
+	return [session for session in sessions if session]
+
+def write_traffic(sessions, path):
+	with open(path, 'w', encoding='utf-8') as f:
+		for session in sessions:
+			f.write(''.join(f'{action}\t{text}\n' for action, text in session) + '\n')
+
+
+def build_target(services, phrases, number_partitions, work_dir, hdfs_root_dir):
+	"""
+	Builds the tries of the phrases' partitions like the trie builder does, weighting them by their Zipf popularity,
+	and uploads them to the fake HDFS. Returns the HDFS path of each partition's trie.
+	"""
+	triebuilder = services.triebuilder
+	phrases_local_path = os.path.join(work_dir, 'phrases.tsv')
+	with open(phrases_local_path, 'w', encoding='utf-8') as f:
+		for rank, phrase in enumerate(phrases):
+			f.write(f'{max(1, round(ZIPF_WEIGHT_SCALE / (rank + 1)))}\t{phrase}\n')
+
+	boundaries = triebuilder.compute_partition_boundaries([(phrase, 1) for phrase in phrases], number_partitions)
+	partitions = tuple(zip([None] + boundaries, boundaries + [None]))
+	phrases_local_paths, infixes_local_paths = triebuilder.route_phrases(phrases_local_path, partitions, work_dir)
+
+	hdfs_client = FakeInsecureClient(None, root_dir=hdfs_root_dir)
+	trie_hdfs_paths = dict()
+	for (start, end), partition_phrases_local_path, infixes_local_path in zip(partitions, phrases_local_paths, infixes_local_paths):
+		trie_local_path = f'{partition_phrases_local_path}.trie'
+		triebuilder.build_trie_file(partition_phrases_local_path, infixes_local_path, trie_local_path)
+		partition = f'{start or ""}|{end or ""}'
+		trie_hdfs_paths[partition] = f'/phrases/5_tries/{TARGET_ID}/{partition}'
+		hdfs_client.upload(trie_hdfs_paths[partition], trie_local_path)
+	return trie_hdfs_paths
+
+def register_target(zookeeper, trie_hdfs_paths):
+	""" Registers the partitions' tries as both the current and the next target, as the applier leaves them after a switch """
+	zk = FakeKazooClient(zookeeper)
+	for partition, trie_hdfs_path in trie_hdfs_paths.items():
+		partition_path = f'/phrases/distributor/{TARGET_ID}/partitions/{partition}'
+		zk.ensure_path(f'{partition_path}/nodes')
+		zk.ensure_path(f'{partition_path}/trie_data_hdfs_path')
+		zk.set(f'{partition_path}/trie_data_hdfs_path', trie_hdfs_path.encode())
+	for path in ('/phrases/distributor/current_target', '/phrases/distributor/next_target'):
+		zk.ensure_path(path)
+		zk.set(path, TARGET_ID.encode())
+
+
+def start_backend(services, address, stage_latencies):
+	"""
+	Runs a backend app serving on the address. The backend joins a partition of the target that still needs nodes while
+	its app is created, registering the address as its hostname.
+	"""
+	services.backend.socket = HostnameSocket(address)
+	backend_main = load_app_module('distributor/backend', f'backend_main_{address.replace(".", "_")}')
+	server = make_server(address, BACKEND_PORT, stage_latencies.timed_app(backend_main.app, 'backend.request'),
+		server_class=ThreadingWSGIServer, handler_class=QuietRequestHandler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+def serve_backend_process(address, partition, trie_hdfs_path, hdfs_root_dir, measuring, ready, stop, results):
+	"""
+	Runs a backend in a local process, with a fake zookeeper of its own that only has its partition, so the backend joins
+	it. Sends its stage latencies once stopped.
+	"""
+	zookeeper = FakeZooKeeper()
+	register_target(zookeeper, {partition: trie_hdfs_path})
+	services = load_service_modules(zookeeper, hdfs_root_dir, 0, 0)
+	stage_latencies = StageLatencies(measuring)
+	stage_latencies.instrument(services.backend.Backend, 'top_phrases_for_prefix', 'backend.lookup')
+	server = start_backend(services, address, stage_latencies)
+	ready.put(address)
+	stop.wait()
+	server.shutdown()
+	results.put((dict(stage_latencies.latencies), dict(stage_latencies.errors)))
+
+
+def run_sessions(sessions, concurrency, run_action):
+	""" Runs the sessions on concurrency threads, each one running a session after the other. Returns the elapsed time """
+	sessions_iterator = iter(sessions)
+	lock = threading.Lock()
+
+	def run():
+		while True:
+			with lock:
+				session = next(sessions_iterator, None)
+			if (session is None):
+				return
+			for action, text in session:
+				run_action(action, text)
+
+	threads = [threading.Thread(target=run) for _ in range(concurrency)]
+	start_time = time.perf_counter()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return time.perf_counter() - start_time
+
+def summarize(stage_latencies, elapsed_s):
+	summary = dict()
+	for stage, latencies in sorted(stage_latencies.latencies.items()):
+		latencies = sorted(latencies)
+		stage_summary = {
+			'count': len(latencies),
+			'errors': stage_latencies.errors.get(stage, 0),
+			'per_second': len(latencies) / elapsed_s,
+			'mean_ms': 1000 * sum(latencies) / len(latencies),
+		}
+		for name, percentile in PERCENTILES:
+			stage_summary[f'{name}_ms'] = 1000 * latencies[min(len(latencies) - 1, math.ceil(len(latencies) * percentile / 100) - 1)]
+		stage_summary['max_ms'] = 1000 * latencies[-1]
+		summary[stage] = stage_summary
+	return summary
+
+def print_summary(summary, elapsed_s):
+	columns = ['count', 'errors', 'per_second', 'mean_ms'] + [f'{name}_ms' for name, _ in PERCENTILES] + ['max_ms']
+	print(f'{"stage":<28}' + ''.join(f'{column:>12}' for column in columns))
+	for stage, stage_summary in summary.items():
+		print(f'{stage:<28}' + ''.join(f'{stage_summary[column]:>12.3f}' if (isinstance(stage_summary[column], float)) else f'{stage_summary[column]:>12}' for column in columns))
+	print(f'Elapsed: {elapsed_s:.2f}s')
+	# The frontend runs in this process, whose threads also run the sessions (and the backends, without --processes)
+	print('Note: the frontend.* stages run on the --concurrency threads of this process and include their wait for its GIL, '
+		'so the gap between frontend.backend_request and backend.request is mostly that wait, not backend or network time')
+
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(description='End-to-end load test of the frontend, backend and collector against in-memory fakes')
+	parser.add_argument('--phrases', type=int, default=100000, help='Number of phrases of the synthetic corpus')
+	parser.add_argument('--corpus', help='File with one phrase per line, the most popular first, instead of a synthetic corpus')
+	parser.add_argument('--partitions', type=int, default=4)
+	parser.add_argument('--nodes-per-partition', type=int, default=1)
+	parser.add_argument('--processes', action='store_true', help='Run each backend in a local process instead of a thread of this one')
+	parser.add_argument('--sessions', type=int, default=5000)
+	parser.add_argument('--warmup-sessions', type=int, default=500, help='Sessions run before measuring, the first ones of the traffic')
+	parser.add_argument('--concurrency', type=int, default=8)
+	parser.add_argument('--zipf-exponent', type=float, default=1.0)
+	parser.add_argument('--submit-ratio', type=float, default=0.2, help='Share of the sessions that submit their phrase to the collector')
+	parser.add_argument('--traffic', help='Replays the sessions of a file written by --save-traffic')
+	parser.add_argument('--save-traffic', help='Writes the sessions to a file, to be replayed with --traffic')
+	parser.add_argument('--fuzzy', action='store_true')
+	parser.add_argument('--mode', default='prefix', choices=('prefix', 'infix', 'any'))
+	parser.add_argument('--redis-round-trip-ms', type=float, default=0)
+	parser.add_argument('--broker-round-trip-ms', type=float, default=0)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='Environment variable for the services, such as TRIE_IMPLEMENTATION=compact')
+	parser.add_argument('--output', help='Writes the configuration and the results as JSON')
+	return parser.parse_args()
+
+def main():
+	arguments = parse_arguments()
+	rng = random.Random(arguments.seed)
+	random.seed(arguments.seed) # The frontend picks the backend nodes at random
+
+	work_dir = tempfile.TemporaryDirectory()
+	hdfs_root_dir = os.path.join(work_dir.name, 'hdfs')
+	environment = {
+		'NUMBER_NODES_PER_PARTITION': str(arguments.nodes_per_partition),
+		'TRIE_FILE_FORMAT': 'binary',
+		'TRIE_LOCAL_DIR': work_dir.name,
+		'INFIX_INDEX_ENABLED': str(arguments.mode != 'prefix').lower(),
+		'PRODUCER_MODE': 'sync',
+	}
+	environment.update(setting.split('=', maxsplit=1) for setting in arguments.env)
+	os.environ.update(environment)
+
+	zookeeper = FakeZooKeeper()
+	services = load_service_modules(zookeeper, hdfs_root_dir, arguments.redis_round_trip_ms / 1000, arguments.broker_round_trip_ms / 1000)
+
+	if (arguments.corpus):
+		with open(arguments.corpus, encoding='utf-8') as f:
+			phrases = list(dict.fromkeys(line.rstrip('\n') for line in f if line.strip()))
+	else:
+		phrases = synthetic_corpus(arguments.phrases, rng)
+	if (arguments.traffic):
+		sessions = read_traffic(arguments.traffic)
+	else:
+		sessions = synthetic_sessions(phrases, arguments.warmup_sessions + arguments.sessions, arguments.zipf_exponent, arguments.submit_ratio, rng)
+	if (arguments.save_traffic):
+		write_traffic(sessions, arguments.save_traffic)
+
+	print(f'Building {arguments.partitions} partitions of {len(phrases)} phrases')
+	trie_hdfs_paths = build_target(services, phrases, arguments.partitions, work_dir.name, hdfs_root_dir)
+	register_target(zookeeper, trie_hdfs_paths)
+
+	measuring = multiprocessing.get_context('spawn').Event()
+	stage_latencies = StageLatencies(measuring)
+	stage_latencies.instrument(services.frontend.Frontend, '_top_phrases_for_prefixes_distributed_cache', 'frontend.distributed_cache')
+	stage_latencies.instrument(services.frontend.Frontend, '_top_phrases_backend', 'frontend.backend_request')
+	stage_latencies.instrument(services.collector.Collector, 'collect_phrases', 'collector.collect')
+
+	addresses = [f'127.0.0.{2 + i}' for i in range(len(trie_hdfs_paths) * arguments.nodes_per_partition)]
+	print(f'Starting {len(addresses)} backends')
+	servers = []
+	backend_processes = []
+	if (arguments.processes):
+		context = multiprocessing.get_context('spawn')
+		ready, stop, results = context.Queue(), context.Event(), context.Queue()
+		zk = FakeKazooClient(zookeeper)
+		for address, partition in zip(addresses, list(trie_hdfs_paths) * arguments.nodes_per_partition):
+			process = context.Process(target=serve_backend_process, args=(address, partition, trie_hdfs_paths[partition], hdfs_root_dir, measuring, ready, stop, results), daemon=True)
+			process.start()
+			backend_processes.append(process)
+			ready.get()
+			# The backend joined its own fake zookeeper, so it is registered in this process' one for the frontend
+			zk.create(f'/phrases/distributor/{TARGET_ID}/partitions/{partition}/nodes/', value=address.encode(), sequence=True)
+	else:
+		stage_latencies.instrument(services.backend.Backend, 'top_phrases_for_prefix', 'backend.lookup')
+		for address in addresses:
+			servers.append(start_backend(services, address, stage_latencies))
+
+	frontend_client = falcon.testing.TestClient(load_app_module('distributor/frontend', 'frontend_main').app)
+	collector_client = falcon.testing.TestClient(load_app_module('assembler/collector', 'collector_main').app)
+	lookup_params = {'fuzzy': str(arguments.fuzzy).lower(), 'mode': arguments.mode}
+
+	def run_action(action, text):
+		start_time = time.perf_counter()
+		if (action == 'lookup'):
+			result = frontend_client.simulate_get('/top-phrases', params=dict(lookup_params, prefix=text))
+		else:
+			result = collector_client.simulate_post('/collect-phrase', params={'phrase': text})
+		stage_latencies.record(f'{"frontend" if (action == "lookup") else "collector"}.request', time.perf_counter() - start_time, result.status_code != 200)
+
+	warmup_sessions, sessions = sessions[:arguments.warmup_sessions], sessions[arguments.warmup_sessions:]
+	if (warmup_sessions):
+		print(f'Warming up with {len(warmup_sessions)} sessions')
+		run_sessions(warmup_sessions, arguments.concurrency, run_action)
+
+	print(f'Running {len(sessions)} sessions on {arguments.concurrency} threads')
+	measuring.set()
+	elapsed_s = run_sessions(sessions, arguments.concurrency, run_action)
+	measuring.clear()
+
+	for server in servers:
+		server.shutdown()
+	if (backend_processes):
+		stop.set()
+		for _ in backend_processes:
+			stage_latencies.merge(*results.get())
+		for process in backend_processes:
+			process.join()
+
+	summary = summarize(stage_latencies, elapsed_s)
+	print_summary(summary, elapsed_s)
+	if (arguments.output):
+		with open(arguments.output, 'w') as f:
+			json.dump({'arguments': vars(arguments), 'environment': environment, 'elapsed_s': elapsed_s, 'stages': summary}, f, indent=2)
+	work_dir.cleanup()
+
+
+if __name__ == '__main__':
+	main()
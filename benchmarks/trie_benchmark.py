@@ -0,0 +1,355 @@
+"""
+Micro-benchmark of the trie implementations and their serializers, over synthetic corpora of any size.
+
+For each corpus size, implementation and serializer, a fresh process adds the corpus phrases by descending weight, as
+the trie builder does, and serializes the trie, and another fresh process loads it and looks up a Zipf-distributed
+sample of typed prefixes, as a backend does. Reported are the add_phrase throughput, the time of the first lookup
+(which is when a CompactTrie compacts its phrases), the peak RSS, the serialized size, the load time and RSS, and
+the lookup latencies. The results are written as JSON, and --compare checks them against the results of another
+commit, exiting with an error when a metric got worse by more than --threshold.
+
+Corpora are generated once per size and seed and kept in --corpus-dir, so runs on different commits use the same
+phrases. Other implementations and serializers are benchmarked by passing a --plugin module (or .py file) defining
+IMPLEMENTATIONS, a dict of name -> callable returning an empty trie, and/or SERIALIZERS, a dict of
+name -> (write(trie, path), load(path)) pair.
+
+	python benchmarks/trie_benchmark.py --phrases 10000,1000000 --output trie_results.json
+	python benchmarks/trie_benchmark.py --phrases 10000,1000000 --compare trie_results.json
+"""
+import argparse
+import hashlib
+import importlib
+import importlib.util
+import json
+import math
+import multiprocessing
+import os
+import pickle
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate
+
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_DIR, 'shared'))
+
+from trie import TRIE_IMPLEMENTATIONS
+from trie_file import MappedTrie, write_trie_file
+
+
+CORPUS_VERSION = 1 # Bump when the generator changes, so that corpora of older versions are not reused
+WEIGHT_SCALE = 10 ** 9 # Weight of the most popular phrase, the one of rank r being WEIGHT_SCALE / r
+BATCH_SIZE = 100000 # Phrases read from the corpus between two timed add_phrase loops
+# Letter frequencies of English text, in percent
+LETTER_FREQUENCIES = {
+	'e': 12.7, 't': 9.1, 'a': 8.2, 'o': 7.5, 'i': 7.0, 'n': 6.7, 's': 6.3, 'h': 6.1, 'r': 6.0, 'd': 4.3, 'l': 4.0, 'c': 2.8,
+	'u': 2.8, 'm': 2.4, 'w': 2.4, 'f': 2.2, 'g': 2.0, 'y': 2.0, 'p': 1.9, 'b': 1.5, 'v': 1.0, 'k': 0.8, 'j': 0.15, 'x': 0.15,
+	'q': 0.1, 'z': 0.07,
+}
+ACCENTED_LETTERS = 'éèáàñüöçã' # Some words of the vocabulary have one, so that phrases are not all ASCII
+ACCENTED_WORD_RATIO = 0.01
+NUMBER_WORD_RATIO = 0.03 # Words like years and model numbers
+WORD_LENGTH_WEIGHTS = {1: 3, 2: 15, 3: 20, 4: 17, 5: 13, 6: 10, 7: 8, 8: 6, 9: 4, 10: 2, 11: 1, 12: 1} # Of distinct words
+WORDS_PER_PHRASE_WEIGHTS = {1: 20, 2: 35, 3: 25, 4: 12, 5: 5, 6: 3} # Of search queries
+VOCABULARY_ZIPF_EXPONENT = 1.0 # A few words are in many phrases, so their prefixes are shared
+# Metrics compared by --compare, and whether higher values are better
+COMPARED_METRICS = (
+	('phrases_per_s', True),
+	('first_lookup_s', False),
+	('build_peak_rss_mb', False),
+	('size_bytes', False),
+	('load_s', False),
+	('load_rss_mb', False),
+	('lookup_p50_us', False),
+	('lookup_p99_us', False),
+)
+
+
+Serializer = namedtuple('Serializer', ('write', 'load'))
+
+def write_pickle(trie, path):
+	with open(path, 'wb') as f:
+		pickle.dump(trie, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_pickle(path):
+	with open(path, 'rb') as f:
+		return pickle.load(f)
+
+IMPLEMENTATIONS = dict(TRIE_IMPLEMENTATIONS)
+SERIALIZERS = {
+	'pickle': Serializer(write_pickle, load_pickle),
+	'binary': Serializer(write_trie_file, MappedTrie), # Node tries are converted to compact ones when written
+}
+
+
+def load_plugins(plugins):
+	""" Adds the implementations and serializers of the plugin modules, given by module name or .py file path """
+	for plugin in plugins:
+		if (plugin.endswith('.py')):
+			spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(plugin))[0], plugin)
+			module = importlib.util.module_from_spec(spec)
+			spec.loader.exec_module(module)
+		else:
+			module = importlib.import_module(plugin)
+		IMPLEMENTATIONS.update(getattr(module, 'IMPLEMENTATIONS', dict()))
+		SERIALIZERS.update((name, Serializer(*serializer)) for name, serializer in getattr(module, 'SERIALIZERS', dict()).items())
+
+
+def corpus_path(corpus_dir, number_phrases, seed):
+	return os.path.join(corpus_dir, f'corpus-v{CORPUS_VERSION}-{number_phrases}-{seed}.tsv')
+
+def generate_corpus(path, number_phrases, seed):
+	"""
+	Writes number_phrases distinct "weight\tphrase" lines, by descending weight. Phrases are made of words of a made up
+	vocabulary, with English letter frequencies and word lengths, picked with a Zipf distribution.
+	"""
+	rng = random.Random(seed)
+	letters = list(LETTER_FREQUENCIES)
+	letter_cumulative_weights = list(accumulate(LETTER_FREQUENCIES.values()))
+	word_lengths = list(WORD_LENGTH_WEIGHTS)
+	word_length_cumulative_weights = list(accumulate(WORD_LENGTH_WEIGHTS.values()))
+	words_per_phrase = list(WORDS_PER_PHRASE_WEIGHTS)
+	words_per_phrase_cumulative_weights = list(accumulate(WORDS_PER_PHRASE_WEIGHTS.values()))
+
+	def word():
+		if (rng.random() < NUMBER_WORD_RATIO):
+			return str(rng.randrange(10 ** rng.randint(1, 4)))
+		characters = rng.choices(letters, cum_weights=letter_cumulative_weights, k=rng.choices(word_lengths, cum_weights=word_length_cumulative_weights)[0])
+		if (rng.random() < ACCENTED_WORD_RATIO):
+			characters[rng.randrange(len(characters))] = rng.choice(ACCENTED_LETTERS)
+		return ''.join(characters)
+
+	vocabulary = list(dict.fromkeys(word() for _ in range(min(1000000, max(1000, number_phrases // 4)))))
+	vocabulary_cumulative_weights = list(accumulate(1 / (rank + 1) ** VOCABULARY_ZIPF_EXPONENT for rank in range(len(vocabulary))))
+
+	# Hashes take less memory than the phrases, and a collision only drops a phrase. Unlike hash(), they are the same in every run
+	seen_hashes = set()
+	temporary_path = f'{path}.{os.getpid()}.tmp'
+	with open(temporary_path, 'w', encoding='utf-8') as f:
+		rank = 0
+		while (rank < number_phrases):
+			lengths = rng.choices(words_per_phrase, cum_weights=words_per_phrase_cumulative_weights, k=BATCH_SIZE)
+			words = iter(rng.choices(vocabulary, cum_weights=vocabulary_cumulative_weights, k=sum(lengths)))
+			lines = []
+			for length in lengths:
+				phrase = ' '.join(next(words) for _ in range(length))
+				phrase_hash = int.from_bytes(hashlib.blake2b(phrase.encode('utf-8'), digest_size=8).digest(), 'little')
+				if (phrase_hash in seen_hashes or rank >= number_phrases):
+					continue
+				seen_hashes.add(phrase_hash)
+				rank += 1
+				lines.append(f'{max(1, WEIGHT_SCALE // rank)}\t{phrase}\n')
+			f.write(''.join(lines))
+	os.replace(temporary_path, path)
+
+def read_corpus_batches(path):
+	""" Yields lists of (phrase, weight) pairs, BATCH_SIZE at a time """
+	batch = []
+	with open(path, encoding='utf-8') as f:
+		for line in f:
+			weight, phrase = line.rstrip('\n').split('\t', maxsplit=1)
+			batch.append((phrase, int(weight)))
+			if (len(batch) == BATCH_SIZE):
+				yield batch
+				batch = []
+	if (batch):
+		yield batch
+
+def sample_prefixes(path, number_phrases, number_lookups, seed):
+	"""
+	Returns prefixes of the corpus phrases as they are typed: phrases are picked by a Zipf distribution of their rank,
+	with exponent 1, and cut at a random length.
+	"""
+	rng = random.Random(seed)
+	# With exponent 1, the rank is about log-uniform
+	ranks = [min(number_phrases, int(math.exp(rng.random() * math.log(number_phrases + 1)))) for _ in range(number_lookups)]
+	wanted_ranks = set(ranks)
+	phrases_by_rank = dict()
+	with open(path, encoding='utf-8') as f:
+		for rank, line in enumerate(f, start=1):
+			if (rank in wanted_ranks):
+				phrases_by_rank[rank] = line.rstrip('\n').split('\t', maxsplit=1)[1]
+	prefixes = []
+	for rank in ranks:
+		phrase = phrases_by_rank[rank]
+		prefixes.append(phrase[:rng.randint(1, len(phrase))])
+	return prefixes
+
+
+def rss_mb():
+	""" Current resident set size """
+	with open('/proc/self/statm') as f:
+		return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+def peak_rss_mb():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # In KiB on Linux
+
+def build_and_write(plugins, implementation, serializer, corpus_path, trie_path):
+	""" Runs in a fresh process, so that its peak RSS is the one of this build """
+	load_plugins(plugins)
+	rss_before_mb = rss_mb()
+	trie = IMPLEMENTATIONS[implementation]()
+	number_phrases = 0
+	add_s = 0
+	for batch in read_corpus_batches(corpus_path):
+		add_phrase = trie.add_phrase
+		start_time = time.perf_counter()
+		for phrase, weight in batch:
+			add_phrase(phrase, weight)
+		add_s += time.perf_counter() - start_time
+		number_phrases += len(batch)
+
+	start_time = time.perf_counter()
+	trie.top_phrases_for_prefix('')
+	first_lookup_s = time.perf_counter() - start_time
+
+	start_time = time.perf_counter()
+	SERIALIZERS[serializer].write(trie, trie_path)
+	serialize_s = time.perf_counter() - start_time
+	return {
+		'add_s': add_s,
+		'phrases_per_s': number_phrases / add_s if (add_s) else None,
+		'first_lookup_s': first_lookup_s,
+		'build_rss_mb': rss_mb() - rss_before_mb,
+		'build_peak_rss_mb': peak_rss_mb(),
+		'serialize_s': serialize_s,
+		'serialize_peak_rss_mb': peak_rss_mb(),
+		'size_bytes': os.path.getsize(trie_path),
+	}
+
+def load_and_look_up(plugins, serializer, trie_path, prefixes):
+	""" Runs in a fresh process, like a backend loading the trie """
+	load_plugins(plugins)
+	rss_before_mb = rss_mb()
+	start_time = time.perf_counter()
+	trie = SERIALIZERS[serializer].load(trie_path)
+	load_s = time.perf_counter() - start_time
+	load_rss_mb = rss_mb() - rss_before_mb
+
+	top_phrases_for_prefix = trie.top_phrases_for_prefix
+	top_phrases_for_prefix(prefixes[0])
+	latencies_ns = []
+	for prefix in prefixes:
+		start_time = time.perf_counter_ns()
+		top_phrases_for_prefix(prefix)
+		latencies_ns.append(time.perf_counter_ns() - start_time)
+	latencies_ns.sort()
+
+	result = {
+		'load_s': load_s,
+		'load_rss_mb': load_rss_mb,
+		'lookup_rss_mb': rss_mb() - rss_before_mb,
+		'lookups_per_s': len(latencies_ns) / (sum(latencies_ns) / 1e9),
+		'lookup_mean_us': sum(latencies_ns) / len(latencies_ns) / 1000,
+	}
+	for name, percentile in (('p50', 50), ('p99', 99), ('p999', 99.9)):
+		result[f'lookup_{name}_us'] = latencies_ns[min(len(latencies_ns) - 1, math.ceil(len(latencies_ns) * percentile / 100) - 1)] / 1000
+	return result
+
+def run_in_fresh_process(function, *args):
+	with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+		return executor.submit(function, *args).result()
+
+
+def compare(results, previous_results, threshold):
+	""" Prints each compared metric next to its previous value, and returns whether any of them got worse by more than the threshold """
+	previous_by_key = {(result['implementation'], result['serializer'], result['phrases']): result for result in previous_results}
+	regressed = False
+	print(f'{"benchmark":<32}{"metric":<20}{"previous":>14}{"current":>14}{"change":>10}')
+	for result in results:
+		key = (result['implementation'], result['serializer'], result['phrases'])
+		previous = previous_by_key.get(key)
+		if (previous is None):
+			continue
+		for metric, higher_is_better in COMPARED_METRICS:
+			if (not previous.get(metric) or result.get(metric) is None):
+				continue
+			change = result[metric] / previous[metric] - 1
+			worse = (change < -threshold) if (higher_is_better) else (change > threshold)
+			regressed = regressed or worse
+			print(f'{"/".join(map(str, key)):<32}{metric:<20}{previous[metric]:>14.4g}{result[metric]:>14.4g}{change:>+10.1%}{"  worse" if (worse) else ""}')
+	return regressed
+
+def commit_id():
+	try:
+		return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_DIR, capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(description='Benchmark of the trie implementations and serializers')
+	parser.add_argument('--phrases', default='10000,100000', help='Comma separated corpus sizes, such as 10000,1000000,50000000')
+	parser.add_argument('--implementations', default='node,compact', help='Comma separated names of IMPLEMENTATIONS')
+	parser.add_argument('--serializers', default='pickle,binary', help='Comma separated names of SERIALIZERS')
+	parser.add_argument('--plugin', action='append', default=[], help='Module or .py file with more IMPLEMENTATIONS and SERIALIZERS')
+	parser.add_argument('--lookups', type=int, default=100000)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'autocomplete-trie-benchmark'))
+	parser.add_argument('--output', help='Writes the results as JSON')
+	parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+	parser.add_argument('--threshold', type=float, default=0.1, help='Relative change of a metric that --compare reports as worse')
+	return parser.parse_args()
+
+def main():
+	arguments = parse_arguments()
+	load_plugins(arguments.plugin)
+	implementations = arguments.implementations.split(',')
+	serializers = arguments.serializers.split(',')
+	for name in implementations:
+		if (name not in IMPLEMENTATIONS):
+			sys.exit(f'Unknown implementation {name}, expected one of {", ".join(IMPLEMENTATIONS)}')
+	for name in serializers:
+		if (name not in SERIALIZERS):
+			sys.exit(f'Unknown serializer {name}, expected one of {", ".join(SERIALIZERS)}')
+
+	os.makedirs(arguments.corpus_dir, exist_ok=True)
+	results = []
+	for number_phrases in [int(size) for size in arguments.phrases.split(',')]:
+		path = corpus_path(arguments.corpus_dir, number_phrases, arguments.seed)
+		if (not os.path.exists(path)):
+			print(f'Generating a corpus of {number_phrases} phrases in {path}')
+			generate_corpus(path, number_phrases, arguments.seed)
+		prefixes = sample_prefixes(path, number_phrases, arguments.lookups, arguments.seed)
+
+		for implementation in implementations:
+			for serializer in serializers:
+				print(f'Benchmarking {implementation} tries serialized with {serializer}, {number_phrases} phrases')
+				with tempfile.TemporaryDirectory() as work_dir:
+					trie_path = os.path.join(work_dir, 'trie.dat')
+					result = {'implementation': implementation, 'serializer': serializer, 'phrases': number_phrases}
+					result.update(run_in_fresh_process(build_and_write, arguments.plugin, implementation, serializer, path, trie_path))
+					result.update(run_in_fresh_process(load_and_look_up, arguments.plugin, serializer, trie_path, prefixes))
+				print('  ' + ', '.join(f'{name}: {value:.4g}' for name, value in result.items() if (isinstance(value, float))))
+				results.append(result)
+
+	report = {
+		'commit': commit_id(),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'processor': platform.processor(),
+		'cpus': os.cpu_count(),
+		'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+		'arguments': vars(arguments),
+		'results': results,
+	}
+	if (arguments.output):
+		with open(arguments.output, 'w') as f:
+			json.dump(report, f, indent=2)
+	if (arguments.compare):
+		with open(arguments.compare) as f:
+			previous_report = json.load(f)
+		print(f'Compared with commit {previous_report.get("commit")}')
+		if (compare(results, previous_report['results'], arguments.threshold)):
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
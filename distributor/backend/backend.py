@@ -1,18 +1,47 @@
 from hdfs import InsecureClient
-from kazoo.client import KazooClient, DataWatch
+from kazoo.client import KazooClient, DataWatch, ChildrenWatch
+from confluent_kafka.avro import AvroConsumer
+from distutils.util import strtobool
 
 import os
+import json
+import time
 import pickle
 import socket
 import logging
+import threading
+import multiprocessing
 from apscheduler.schedulers.background import BackgroundScheduler
+from prometheus_client import Histogram
 
-from trie import Trie
+from trie import Trie, CompactTrie, LiveTrie, MODES, MODE_PREFIX, MODE_INFIX, merge_infix_top_phrases
+from trie_file import is_trie_file, MappedTrie
+from trending import TrendingPhrases, merge_top_phrases
+from metrics import LATENCY_BUCKETS_S, LOAD_BUCKETS_S, ZOOKEEPER_CALL_DURATION, time_methods
 
 
 ZK_CURRENT_TARGET = '/phrases/distributor/current_target'
 ZK_NEXT_TARGET = '/phrases/distributor/next_target'
 NUMBER_NODES_PER_PARTITION = int(os.getenv("NUMBER_NODES_PER_PARTITION"))
+TRIE_IMPLEMENTATION = os.getenv("TRIE_IMPLEMENTATION", "node")
+TRIE_LOCAL_DIR = os.getenv("TRIE_LOCAL_DIR", ".")
+DELTAS_ENABLED = bool(strtobool(os.getenv("DELTAS_ENABLED", "false"))) # Apply the trie builder's weight deltas between full builds
+TRENDING_ENABLED = bool(strtobool(os.getenv("TRENDING_ENABLED", "false"))) # Merge the phrases trending in the phrases topic into the results
+TRENDING_CAPACITY = int(os.getenv("TRENDING_CAPACITY", 1000))
+TRENDING_SKETCH_WIDTH = int(os.getenv("TRENDING_SKETCH_WIDTH", 2048))
+TRENDING_SKETCH_DEPTH = int(os.getenv("TRENDING_SKETCH_DEPTH", 4))
+TRENDING_HALF_LIFE_S = float(os.getenv("TRENDING_HALF_LIFE_S", 600))
+TRENDING_MIN_COUNT = float(os.getenv("TRENDING_MIN_COUNT", 5)) # Decayed number of searches for a phrase to be trending
+TRENDING_MAX_PHRASES = int(os.getenv("TRENDING_MAX_PHRASES", 2)) # Result positions that trending phrases can take
+SHARED_TRIE_ENABLED = bool(strtobool(os.getenv("SHARED_TRIE_ENABLED", "false"))) # One host agent process serves its trie to all the workers
+SHARED_TRIE_STATE_PATH = os.getenv("SHARED_TRIE_STATE_PATH", os.path.join(TRIE_LOCAL_DIR, 'backend_state.json'))
+SHARED_TRIE_STATE_CHECK_INTERVAL_S = float(os.getenv("SHARED_TRIE_STATE_CHECK_INTERVAL_S", 1))
+FUZZY_MAX_EDITS = int(os.getenv("FUZZY_MAX_EDITS", 2)) # Edits allowed in fuzzy lookups, further limited for short prefixes
+FUZZY_TIME_BUDGET_S = float(os.getenv("FUZZY_TIME_BUDGET_S", 0.02)) # Per request, after which the best phrases found so far are returned
+
+TRIE_LOOKUP_DURATION = Histogram('backend_trie_lookup_duration_seconds', 'Duration of the trie lookups of each prefix', ['fuzzy', 'mode'], buckets=LATENCY_BUCKETS_S)
+TRIE_LOOKUP_DURATIONS = {(fuzzy, mode): TRIE_LOOKUP_DURATION.labels(str(fuzzy).lower(), mode) for fuzzy in (False, True) for mode in MODES}
+TRIE_LOAD_DURATION = Histogram('backend_trie_load_duration_seconds', 'Duration of downloading and of loading the tries', ['step'], buckets=LOAD_BUCKETS_S)
 
 
 class NodeInactiveError(Exception):
@@ -23,13 +52,55 @@ class HdfsClient:
 		self._client = InsecureClient(f'http://{namenode_host}:9870')
 
 	def download(self, remote_hdfs_path, local_path):
-		self._client.download(remote_hdfs_path, local_path, overwrite=True)
+		# Download next to the destination and rename it, so a file that is already mapped is never rewritten in place
+		temporary_local_path = f'{local_path}.{os.getpid()}.tmp'
+		self._client.download(remote_hdfs_path, temporary_local_path, overwrite=True)
+		os.replace(temporary_local_path, local_path)
+
+	def read_lines(self, remote_hdfs_path):
+		with self._client.read(remote_hdfs_path, encoding='utf-8') as reader:
+			return reader.read().splitlines()
+
+class PhrasesConsumer:
+	""" Consumes the phrases topic from its latest offset in a daemon thread, calling on_phrase(phrase, count) for each record """
+
+	def __init__(self, on_phrase):
+		self._logger = logging.getLogger('gunicorn.error')
+		self._on_phrase = on_phrase
+		self._consumer = AvroConsumer({
+			'bootstrap.servers': f'{os.getenv("BROKER_HOST")}:9092',
+			'schema.registry.url': f'http://{os.getenv("SCHEMA_REGISTRY_HOST")}:8081',
+			# Every process needs all the records, so each one is its own consumer group
+			'group.id': f'backend-trending-{socket.gethostname()}-{os.getpid()}',
+			'auto.offset.reset': 'latest',
+			'enable.auto.commit': False,
+			})
+		self._consumer.subscribe(['phrases'])
+
+	def start(self):
+		threading.Thread(target=self._poll_loop, daemon=True).start()
+
+	def _poll_loop(self):
+		while True:
+			try:
+				message = self._consumer.poll(1)
+				if (message is None):
+					continue
+				if (message.error()):
+					self._logger.error(f'Phrases consumer error: {message.error()}')
+					continue
+				value = message.value()
+				self._on_phrase(value['phrase'], value.get('count', 1))
+			except Exception as e:
+				self._logger.error('Could not consume phrase', exc_info=e)
 
 class Backend:
-	def __init__(self):
+	def __init__(self, state_file_path=None):
 		self._logger = logging.getLogger('gunicorn.error')
+		self._state_file_path = state_file_path
 
-		self._zk = KazooClient(hosts=f'{os.getenv("ZOOKEEPER_HOST")}:2181')
+		self._zk = time_methods(KazooClient(hosts=f'{os.getenv("ZOOKEEPER_HOST")}:2181'), ZOOKEEPER_CALL_DURATION,
+			('get', 'get_children', 'exists', 'create', 'set', 'delete', 'sync', 'ensure_path'))
 		self._hdfsClient = HdfsClient(os.getenv("HADOOP_NAMENODE_HOST"))
 
 		self._active = False
@@ -37,8 +108,15 @@ class Backend:
 		self._zk_node_path = None
 
 		self._range = None
+		self._applied_delta_names = set()
 
 		self._trie = None
+		self._trie_local_path = None
+		self._delta_local_paths = []
+
+		# A host agent only loads the trie for its workers, which serve the requests
+		self._init_trending_phrases(TRENDING_ENABLED and not state_file_path)
+		self._write_state()
 
 		scheduler = BackgroundScheduler(timezone="UTC")
 		scheduler.add_job(self._attempt_to_join_any, 'interval', minutes=1)
@@ -48,15 +126,83 @@ class Backend:
 		self._zk.start()
 		datawatch_next_target = DataWatch(client=self._zk, path=ZK_NEXT_TARGET, func=self._on_next_target_changed)
 		datawatch_current_target = DataWatch(client=self._zk, path=ZK_CURRENT_TARGET, func=self._on_current_target_changed)
+		if (self._trending_phrases is not None):
+			self._phrases_consumer.start()
 
 	def stop(self):
 		self._zk.stop()
 
+	def _init_trending_phrases(self, enabled):
+		self._trending_phrases = None
+		if (enabled):
+			self._trending_phrases = TrendingPhrases(capacity=TRENDING_CAPACITY, width=TRENDING_SKETCH_WIDTH, depth=TRENDING_SKETCH_DEPTH, half_life_s=TRENDING_HALF_LIFE_S)
+			self._phrases_consumer = PhrasesConsumer(self._on_phrase_searched)
+
 
-	def top_phrases_for_prefix(self, prefix):
+	def top_phrases_for_prefix(self, prefix, fuzzy=False, mode=MODE_PREFIX, weighted=False):
+		"""
+		The mode is one of trie.MODES: matching phrases starting with the prefix, phrases with a later word starting with it
+		(from the infix index), or both. Fuzzy lookups allow typos in the prefix, but infix matches are always exact.
+		Weighted lookups return (phrase, weight, edits) triples instead of phrases, so that the top phrases of several
+		partitions can be merged, and leave out the trending phrases.
+		"""
 		if (not self._active):
 			raise NodeInactiveError("This backend node is not active. Consult zookeeper for the most recent active nodes")
-		return self._trie.top_phrases_for_prefix(prefix)
+		deadline = time.monotonic() + FUZZY_TIME_BUDGET_S if (fuzzy) else None
+		return self._top_phrases(self._trie, prefix, fuzzy, mode, weighted, deadline)
+
+	def top_phrases_for_prefixes(self, prefixes, fuzzy=False, mode=MODE_PREFIX, weighted=False):
+		if (not self._active):
+			raise NodeInactiveError("This backend node is not active. Consult zookeeper for the most recent active nodes")
+		trie = self._trie
+		# The whole batch shares the time budget. Fuzzy lookups find the exact prefix matches first, so prefixes looked up
+		# after the deadline still get those
+		deadline = time.monotonic() + FUZZY_TIME_BUDGET_S if (fuzzy) else None
+		return {prefix: self._top_phrases(trie, prefix, fuzzy, mode, weighted, deadline) for prefix in prefixes}
+
+	def _top_phrases(self, trie, prefix, fuzzy, mode, weighted, deadline):
+		start_time = time.perf_counter()
+		if (weighted):
+			top_phrases = self._lookup_top_phrases_with_weights(trie, prefix, fuzzy, mode, deadline)
+		else:
+			top_phrases = self._lookup_top_phrases(trie, prefix, fuzzy, mode, deadline)
+		TRIE_LOOKUP_DURATIONS[(fuzzy, mode)].observe(time.perf_counter() - start_time)
+		return top_phrases if (weighted) else self._with_trending_phrases(prefix, mode, top_phrases)
+
+	def _lookup_top_phrases(self, trie, prefix, fuzzy, mode, deadline):
+		if (mode == MODE_PREFIX):
+			return trie.fuzzy_top_phrases_for_prefix(prefix, FUZZY_MAX_EDITS, deadline) if (fuzzy) else trie.top_phrases_for_prefix(prefix)
+		if (mode == MODE_INFIX):
+			return trie.infix_top_phrases_for_prefix(prefix)
+		return [phrase for phrase, _, _ in self._lookup_top_phrases_with_weights(trie, prefix, fuzzy, mode, deadline)]
+
+	def _lookup_top_phrases_with_weights(self, trie, prefix, fuzzy, mode, deadline):
+		""" Returns (phrase, weight, edits) triples, exact matches having no edits """
+		if (mode == MODE_INFIX):
+			return [(phrase, weight, 0) for phrase, weight in trie.infix_top_phrases_with_weights_for_prefix(prefix)]
+
+		if (fuzzy):
+			top_phrases = trie.fuzzy_top_phrases_with_weights_for_prefix(prefix, FUZZY_MAX_EDITS, deadline)
+		else:
+			top_phrases = [(phrase, weight, 0) for phrase, weight in trie.top_phrases_with_weights_for_prefix(prefix)]
+		if (mode == MODE_PREFIX):
+			return top_phrases
+		return merge_infix_top_phrases(top_phrases, trie.infix_top_phrases_with_weights_for_prefix(prefix))
+
+	def _with_trending_phrases(self, prefix, mode, top_phrases):
+		# Trending phrases are found by their start, so they are left out of infix only lookups
+		if (self._trending_phrases is None or mode == MODE_INFIX):
+			return top_phrases
+		trending_phrases = self._trending_phrases.top_phrases_with_counts_for_prefix(prefix, TRENDING_MAX_PHRASES + len(top_phrases), TRENDING_MIN_COUNT)
+		return merge_top_phrases(top_phrases, [phrase for phrase, _ in trending_phrases], Trie.TOP_PHRASES_PER_PREFIX, TRENDING_MAX_PHRASES)
+
+	def _on_phrase_searched(self, phrase, count):
+		# Only the phrases of this node's partition can be served by it
+		if (self._range is None):
+			return
+		start, end = self._range
+		if ((not start or phrase >= start) and (not end or phrase < end)):
+			self._trending_phrases.add(phrase, count)
 
 	def _on_next_target_changed(self, data, stat, event=None):
 		self._logger.info("_on_next_target_changed Data is %s" % data)
@@ -92,7 +238,10 @@ class Backend:
 			self._active = False
 			self._target_id = None
 			self._trie = None
+			self._range = None
 			self._zk_node_path = None
+			self._remove_trie_local_file()
+			self._write_state()
 
 
 	def _attempt_to_join_any(self):
@@ -162,18 +311,224 @@ class Backend:
 
 	def _load_trie_and_activate(self, target_id, partition):
 		trie_data_hdfs_path = f'/phrases/distributor/{target_id}/partitions/{partition}/trie_data_hdfs_path'
-		trie = self._load_trie(self._zk.get(trie_data_hdfs_path)[0].decode())
+		self._trie_local_path = self._download_trie(self._zk.get(trie_data_hdfs_path)[0].decode())
+		trie = load_trie_file(self._trie_local_path)
 		if (trie):
-			self._trie = trie
+			start, end = partition.split('|')
+			self._range = (start or None, end or None)
+			self._trie = LiveTrie(trie) if (DELTAS_ENABLED) else trie
 			self._active = True
 			self._target_id = target_id
 			self._logger.info(f'Now ACTIVE and loaded trie for partition {partition} and target_id {target_id}')
+			self._write_state()
+			if (DELTAS_ENABLED):
+				self._watch_deltas(target_id)
 			return True
 		else:
 			return False
 
-	def _load_trie(self, trie_hdfs_path):
-		local_path = 'trie.dat'
-		self._hdfsClient.download(trie_hdfs_path, local_path)
+	def _watch_deltas(self, target_id):
+		deltas_zk_path = f'/phrases/distributor/{target_id}/deltas'
+		self._zk.ensure_path(deltas_zk_path)
+		self._applied_delta_names = set()
+		trie = self._trie
+		partition_range = self._range
+
+		def on_deltas_changed(delta_names):
+			if (self._trie is not trie):
+				return False # Stops watching, the trie was replaced or dropped
+			# Sequential node names sort in creation order, so deltas are applied in the order they were built
+			for delta_name in sorted(delta_names):
+				if (delta_name in self._applied_delta_names):
+					continue
+				try:
+					self._apply_deltas(trie, partition_range, delta_name, self._zk.get(f'{deltas_zk_path}/{delta_name}')[0].decode())
+				except Exception as e:
+					self._logger.error(f'Could not apply deltas {delta_name} for target {target_id}', exc_info=e)
+					return
+				self._applied_delta_names.add(delta_name)
+
+		ChildrenWatch(client=self._zk, path=deltas_zk_path, func=on_deltas_changed)
+
+	def _apply_deltas(self, trie, partition_range, delta_name, deltas_hdfs_path):
+		lines = self._hdfsClient.read_lines(deltas_hdfs_path)
+		weight_deltas = parse_weight_deltas(lines, partition_range)
+		trie.apply_weight_deltas(weight_deltas)
+		self._logger.info(f'Applied {len(weight_deltas)} phrase weight deltas from {deltas_hdfs_path}')
+
+		if (self._state_file_path and self._trie is trie):
+			# The workers apply the same deltas from a local copy
+			delta_local_path = f'{self._trie_local_path}.{delta_name}'
+			with open(delta_local_path, 'w', encoding='utf-8') as f:
+				f.write('\n'.join(lines))
+			self._delta_local_paths.append(delta_local_path)
+			self._write_state()
+
+	def _download_trie(self, trie_hdfs_path):
+		# Trie files are immutable once built, so a file already downloaded by another worker on this host can be reused,
+		# which also lets the workers share the same page cache copy of a memory-mapped trie
+		local_path = os.path.join(TRIE_LOCAL_DIR, 'trie' + trie_hdfs_path.replace('/', '_').replace('|', '-') + '.dat')
+		if (not os.path.exists(local_path)):
+			with TRIE_LOAD_DURATION.labels('download').time():
+				self._hdfsClient.download(trie_hdfs_path, local_path)
+		return local_path
+
+	def _remove_trie_local_file(self):
+		# Unlinking is safe even if other workers still have the file mapped, they keep their mapping until they drop it
+		for local_path in [self._trie_local_path] + self._delta_local_paths:
+			if (local_path):
+				try:
+					os.remove(local_path)
+				except FileNotFoundError:
+					pass
+		self._trie_local_path = None
+		self._delta_local_paths = []
+
+	def _write_state(self):
+		""" Publishes what this host agent serves to the workers of the host, see SharedTrieBackend """
+		if (not self._state_file_path):
+			return
+		state = {
+			'active': self._active,
+			'target_id': self._target_id,
+			'range': self._range,
+			'trie_local_path': self._trie_local_path,
+			'delta_local_paths': self._delta_local_paths,
+		}
+		temporary_state_file_path = f'{self._state_file_path}.{os.getpid()}.tmp'
+		with open(temporary_state_file_path, 'w') as f:
+			json.dump(state, f)
+		os.replace(temporary_state_file_path, self._state_file_path)
+
+
+class SharedTrieBackend(Backend):
+	"""
+	Serves the trie of the host agent process started by gunicorn's master (see gunicorn_config.py), which handles
+	the zookeeper membership and trie download once for the host. The worker follows the agent's state file,
+	attaching read-only to the same memory-mapped trie file and applying the same weight deltas.
+	"""
+
+	def __init__(self, state_file_path):
+		self._logger = logging.getLogger('gunicorn.error')
+		self._state_file_path = state_file_path
+		self._state_version = None
+		self._last_state_check_time = 0
+		self._attach_lock = threading.Lock()
+
+		self._active = False
+		self._target_id = None
+		self._range = None
+		self._trie = None
+		self._trie_local_path = None
+		self._number_applied_deltas = 0
+
+		self._init_trending_phrases(TRENDING_ENABLED)
+
+	def start(self):
+		if (self._trending_phrases is not None):
+			self._phrases_consumer.start()
+
+	def stop(self):
+		pass
+
+	def top_phrases_for_prefix(self, prefix, fuzzy=False, mode=MODE_PREFIX, weighted=False):
+		self._attach()
+		return super().top_phrases_for_prefix(prefix, fuzzy, mode, weighted)
+
+	def top_phrases_for_prefixes(self, prefixes, fuzzy=False, mode=MODE_PREFIX, weighted=False):
+		self._attach()
+		return super().top_phrases_for_prefixes(prefixes, fuzzy, mode, weighted)
+
+	def _attach(self):
+		now = time.monotonic()
+		if (now - self._last_state_check_time < SHARED_TRIE_STATE_CHECK_INTERVAL_S or not self._attach_lock.acquire(blocking=False)):
+			return
+		try:
+			self._last_state_check_time = now
+			try:
+				# The state file is replaced on every change, so its inode identifies the version even with coarse modification times
+				state_stat = os.stat(self._state_file_path)
+				state_version = (state_stat.st_ino, state_stat.st_mtime_ns)
+			except FileNotFoundError:
+				state_version = None
+			if (state_version != self._state_version):
+				self._attach_state(state_version is not None)
+				self._state_version = state_version
+		except Exception as e:
+			self._logger.error(f'Could not attach to the host agent state {self._state_file_path}', exc_info=e)
+		finally:
+			self._attach_lock.release()
+
+	def _attach_state(self, state_file_exists):
+		state = {'active': False}
+		if (state_file_exists):
+			with open(self._state_file_path) as f:
+				state = json.load(f)
+
+		if (not state['active']):
+			self._active = False
+			self._target_id = None
+			self._range = None
+			self._trie = None
+			self._trie_local_path = None
+			return
+
+		partition_range = tuple(state['range'])
+		if (state['trie_local_path'] != self._trie_local_path):
+			trie = load_trie_file(state['trie_local_path'])
+			trie = LiveTrie(trie) if (DELTAS_ENABLED) else trie
+			self._number_applied_deltas = 0
+		else:
+			trie = self._trie
+		for delta_local_path in state['delta_local_paths'][self._number_applied_deltas:]:
+			with open(delta_local_path, encoding='utf-8') as f:
+				trie.apply_weight_deltas(parse_weight_deltas(f.read().splitlines(), partition_range))
+			self._number_applied_deltas += 1
+
+		self._trie = trie
+		self._trie_local_path = state['trie_local_path']
+		self._range = partition_range
+		self._target_id = state['target_id']
+		self._active = True
+
+
+def load_trie_file(local_path):
+	with TRIE_LOAD_DURATION.labels('load').time():
+		if (is_trie_file(local_path)):
+			return MappedTrie(local_path)
+
+		# Pickled tries are loaded in full by each process, only binary trie files are shared through the page cache
 		with open(local_path, 'rb') as f:
-		    return pickle.load(f)
+			trie = pickle.load(f)
+		if (TRIE_IMPLEMENTATION == 'compact' and isinstance(trie, Trie)):
+			trie = CompactTrie.from_trie(trie)
+		return trie
+
+
+def parse_weight_deltas(lines, partition_range):
+	""" Parses "weight delta\tphrase" lines, keeping those of the phrases in the partition range """
+	start, end = partition_range
+	weight_deltas = []
+	for line in lines:
+		weight_delta, phrase = line.split('\t', maxsplit=1)
+		if ((not start or phrase >= start) and (not end or phrase < end)):
+			weight_deltas.append((phrase, int(weight_delta)))
+	return weight_deltas
+
+
+def start_host_agent():
+	""" Starts the process that joins zookeeper and loads the trie once for all the workers of this host """
+	# Spawn instead of fork, so the agent does not inherit the state of gunicorn's master
+	host_agent = multiprocessing.get_context('spawn').Process(target=run_host_agent, name='backend-host-agent', daemon=True)
+	host_agent.start()
+	return host_agent
+
+
+def run_host_agent():
+	logger = logging.getLogger('gunicorn.error')
+	logger.setLevel(logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper()))
+	logger.addHandler(logging.StreamHandler())
+
+	backend = Backend(state_file_path=SHARED_TRIE_STATE_PATH)
+	backend.start()
+	threading.Event().wait()
@@ -1,6 +1,7 @@
 """gunicorn WSGI server configuration."""
 from multiprocessing import cpu_count
-from os import environ, getenv
+from os import environ, getenv, path
+import sys
 from distutils.util import strtobool
 
 
@@ -12,3 +13,28 @@ workers = int(getenv('NUM_WORKERS', cpu_count() * 2))
 threads = int(getenv('MAX_THREADS', 1))
 reload = bool(strtobool(getenv('RELOAD', 'false')))
 loglevel = getenv('LOG_LEVEL', 'info')
+
+shared_trie_enabled = bool(strtobool(getenv('SHARED_TRIE_ENABLED', 'false')))
+
+
+def on_starting(server):
+	sys.path.insert(0, path.dirname(path.abspath(__file__)))
+	from metrics import clear_multiprocess_dir
+	clear_multiprocess_dir()
+
+	# With a shared trie, the zookeeper membership and the trie loading happen once per host, in a host agent process,
+	# and the workers attach read-only to the trie it loaded
+	if (shared_trie_enabled):
+		from backend import start_host_agent
+		server.host_agent = start_host_agent()
+
+
+def child_exit(server, worker):
+	from metrics import mark_process_dead
+	mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+	host_agent = getattr(server, 'host_agent', None)
+	if (host_agent is not None):
+		host_agent.terminate()
@@ -1,19 +1,35 @@
 import falcon
 import json
 import logging
-from backend import Backend, NodeInactiveError
+import os
+import top_phrases_codec
+from backend import Backend, SharedTrieBackend, NodeInactiveError, SHARED_TRIE_ENABLED, SHARED_TRIE_STATE_PATH
+from trie import MODES, MODE_PREFIX
+from metrics import MetricsResource
+
+
+MAX_BATCH_PREFIXES = int(os.getenv('MAX_BATCH_PREFIXES', 100))
+
+
+class BatchTooLargeError(Exception):
+	pass
 
 
 class MainResource(object):
 	def __init__(self):
 		self._logger = logging.getLogger('gunicorn.error')
-		self._backend = Backend()
+		self._backend = SharedTrieBackend(SHARED_TRIE_STATE_PATH) if (SHARED_TRIE_ENABLED) else Backend()
 		self._backend.start()
 
 	def on_get(self, req, resp):
 		self._logger.debug(f'Handling {req.method} request {req.url} with params {req.params}')
+		fuzzy, mode, weighted = self._lookup_params(req)
 		try:
-			top_phrases = self._backend.top_phrases_for_prefix(req.params['prefix'])
+			top_phrases = self._backend.top_phrases_for_prefix(req.params['prefix'], fuzzy, mode, weighted)
+			resp.status = falcon.HTTP_200
+			if (self._accepts_binary(req) and not weighted):
+				self._set_binary_body(resp, top_phrases_codec.encode_top_phrases, top_phrases)
+				return
 			response_body = json.dumps(
 				{
 					"status": "success",
@@ -21,7 +37,58 @@ class MainResource(object):
 						"top_phrases": top_phrases 
 					}
 				 })
+			resp.body = response_body
+
+		except NodeInactiveError as err:
+			response_body = json.dumps(
+				{
+					"status": "error",
+					"message": "This backend node is not active. Consult zookeeper for the most recent active nodes"
+				 })
+			resp.status = falcon.HTTP_500
+			resp.body = response_body
+
+		except Exception as e:
+			self._logger.error('An error occurred when processing the request', exc_info=e)
+			response_body = json.dumps(
+				{
+					"status": "error",
+					"message": "An error occurred when processing the request"
+				 })
+			resp.status = falcon.HTTP_500
+			resp.body = response_body
+
+	def on_get_batch(self, req, resp):
+		self._logger.debug(f'Handling {req.method} request {req.url} with params {req.params}')
+		fuzzy, mode, weighted = self._lookup_params(req)
+		try:
+			prefixes = req.params.get('prefix', [])
+			if (isinstance(prefixes, str)):
+				prefixes = [prefixes]
+			if (len(prefixes) > MAX_BATCH_PREFIXES):
+				raise BatchTooLargeError(f'At most {MAX_BATCH_PREFIXES} prefixes can be requested at once')
+
+			top_phrases = self._backend.top_phrases_for_prefixes(prefixes, fuzzy, mode, weighted)
 			resp.status = falcon.HTTP_200
+			if (self._accepts_binary(req) and not weighted):
+				self._set_binary_body(resp, top_phrases_codec.encode_top_phrases_by_prefix, top_phrases)
+				return
+			response_body = json.dumps(
+				{
+					"status": "success",
+					"data": {
+						"top_phrases": top_phrases 
+					}
+				 })
+			resp.body = response_body
+
+		except BatchTooLargeError as err:
+			response_body = json.dumps(
+				{
+					"status": "error",
+					"message": str(err)
+				 })
+			resp.status = falcon.HTTP_400
 			resp.body = response_body
 
 		except NodeInactiveError as err:
@@ -43,10 +110,33 @@ class MainResource(object):
 			resp.status = falcon.HTTP_500
 			resp.body = response_body
 
-		
+	def _lookup_params(self, req):
+		"""
+		Returns the fuzzy, mode and weighted parameters, raising falcon's own 400 response for invalid values.
+		Weighted top phrases are (phrase, weight, edits) triples, which only the JSON format has room for.
+		"""
+		fuzzy = req.get_param_as_bool('fuzzy', default=False)
+		mode = req.get_param('mode', default=MODE_PREFIX)
+		if (mode not in MODES):
+			raise falcon.HTTPInvalidParam(f'The mode must be one of {", ".join(MODES)}', 'mode')
+		return fuzzy, mode, req.get_param_as_bool('weighted', default=False)
+
+	def _accepts_binary(self, req):
+		# Only clients that ask for it explicitly get the binary format, everyone else (including */*) keeps getting JSON
+		return top_phrases_codec.MEDIA_TYPE in (req.get_header('Accept') or '')
+
+	def _set_binary_body(self, resp, encode, top_phrases):
+		""" Encodes the successful response in the binary format, falling back to JSON for phrases it cannot encode """
+		try:
+			resp.data = encode(top_phrases)
+			resp.content_type = top_phrases_codec.MEDIA_TYPE
+		except top_phrases_codec.CodecError:
+			resp.body = json.dumps({"status": "success", "data": {"top_phrases": top_phrases}})
 
 
 app = falcon.API()
 main_resource = MainResource()
 app.add_route('/top-phrases', main_resource)
+app.add_route('/top-phrases/batch', main_resource, suffix='batch')
+app.add_route('/metrics', MetricsResource())
 
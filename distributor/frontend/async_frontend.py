@@ -0,0 +1,317 @@
+import os
+import random
+import logging
+import asyncio
+import time
+import aiohttp
+import aioredis
+from distutils.util import strtobool
+from kazoo.client import KazooClient
+
+from frontend import BackendNodesNotAvailable, LocalCache, RoutingTable, LatencyTracker, EarlyRefresh, HotPrefixes, BACKEND_ACCEPT
+from frontend import HOT_PREFIXES_MAX_ENTRIES, LookupOptions, DEFAULT_LOOKUP_OPTIONS, LOOKUP_MODE_PREFIX
+from frontend import distributed_cache_key, decode_backend_response, group_prefixes_by_request, merge_requests_top_phrases, merge_weighted_top_phrases
+from frontend import LOCAL_CACHE_HITS, LOCAL_CACHE_MISSES, DISTRIBUTED_CACHE_HITS, DISTRIBUTED_CACHE_MISSES, DISTRIBUTED_CACHE_EARLY_REFRESHES
+from frontend import BACKEND_FETCHES_ISSUED, BACKEND_FETCHES_COALESCED
+from frontend import DISTRIBUTED_CACHE_DURATION, BACKEND_REQUEST_DURATION, BACKEND_REQUEST_ERRORS, ZOOKEEPER_TIMED_METHODS
+from distributed_cache import DISTRIBUTED_CACHE_TIME_TO_EXPIRE_S, DISTRIBUTED_CACHE_HOT_PREFIXES_KEY, encode_cached_top_phrases, decode_cached_top_phrases
+from metrics import ZOOKEEPER_CALL_DURATION, time_methods
+
+
+class AsyncSingleFlight:
+	""" asyncio version of frontend.SingleFlight, for coroutine functions """
+
+	def __init__(self):
+		self._in_flight = dict() # key -> Future of the call in flight
+
+	async def do(self, key, coroutine_function, *args):
+		future = self._in_flight.get(key)
+		if (future is not None):
+			BACKEND_FETCHES_COALESCED.inc()
+			# Shielded, so a cancelled follower does not cancel the call the others are waiting for
+			return await asyncio.shield(future)
+
+		future = self._in_flight[key] = asyncio.get_event_loop().create_future()
+		BACKEND_FETCHES_ISSUED.inc()
+		try:
+			result = await coroutine_function(*args)
+			future.set_result(result)
+			return result
+		except asyncio.CancelledError:
+			future.cancel()
+			raise
+		except Exception as e:
+			future.set_exception(e)
+			future.exception() # Marks it as retrieved, in case no other call was waiting for it
+			raise
+		finally:
+			del self._in_flight[key]
+
+
+class AsyncFrontend:
+	"""
+	asyncio version of Frontend, with the same cache aside lookups, routing, retries and hedging, for the aiohttp serving mode.
+	Redis and the backends are called without blocking the event loop, and the routing table is an in-memory lookup
+	kept up to date by the zookeeper client's own threads, so a single process can have thousands of lookups in flight.
+	"""
+
+	def __init__(self):
+		self._logger = logging.getLogger('gunicorn.error')
+		self._zk = time_methods(KazooClient(hosts=f'{os.getenv("ZOOKEEPER_HOST")}:2181'), ZOOKEEPER_CALL_DURATION, ZOOKEEPER_TIMED_METHODS)
+		self._distributed_cache = None
+		self._distributed_cache_enabled = bool(strtobool(os.getenv('DISTRIBUTED_CACHE_ENABLED', 'true')))
+		self._local_cache = LocalCache(int(os.getenv('LOCAL_CACHE_MAX_ENTRIES', 10000)), float(os.getenv('LOCAL_CACHE_TIME_TO_LIVE_S', 60)))
+		self._local_cache_enabled = bool(strtobool(os.getenv('LOCAL_CACHE_ENABLED', 'true')))
+		self._routing_table = RoutingTable(self._zk, on_target_changed=self._on_current_target_changed)
+		# Concurrent misses for a prefix share one fetch, and hot prefixes are refreshed shortly before they expire
+		self._single_flight = AsyncSingleFlight()
+		self._early_refresh = EarlyRefresh(float(os.getenv('DISTRIBUTED_CACHE_EARLY_REFRESH_BETA', 1)))
+		self._hot_prefixes = HotPrefixes(float(os.getenv('HOT_PREFIXES_FLUSH_INTERVAL_S', 10)), int(os.getenv('HOT_PREFIXES_MAX_FLUSHED', 1000)))
+
+		self._backend_session = None
+		self._backend_pool_size = int(os.getenv('BACKEND_POOL_SIZE', 100))
+		self._backend_timeout_s = float(os.getenv('BACKEND_TIMEOUT_S', 1))
+		# Once a backend request takes longer than this percentile of the recent ones, a second request is sent to another node of the partition
+		self._backend_hedging_enabled = bool(strtobool(os.getenv('BACKEND_HEDGING_ENABLED', 'false')))
+		self._backend_latencies = LatencyTracker(float(os.getenv('BACKEND_HEDGING_PERCENTILE', 95)))
+
+	async def start(self):
+		# The zookeeper client connects and fires its first watches from its own threads
+		await asyncio.get_event_loop().run_in_executor(None, self._zk.start)
+		self._routing_table.start()
+		if (self._distributed_cache_enabled):
+			self._distributed_cache = await aioredis.create_redis_pool(f'redis://{os.getenv("DISTRIBUTED_CACHE_HOST")}:6379/0')
+		self._backend_session = aiohttp.ClientSession(
+			connector=aiohttp.TCPConnector(limit=self._backend_pool_size),
+			timeout=aiohttp.ClientTimeout(total=self._backend_timeout_s))
+
+	async def stop(self):
+		await self._backend_session.close()
+		if (self._distributed_cache is not None):
+			self._distributed_cache.close()
+			await self._distributed_cache.wait_closed()
+		self._zk.stop()
+
+	# Using Cache Aside Pattern, first with the worker's local cache and then with the distributed cache
+	async def top_phrases_for_prefix(self, prefix, fuzzy=False, mode=LOOKUP_MODE_PREFIX):
+		options = LookupOptions(fuzzy, mode)
+		if (options == DEFAULT_LOOKUP_OPTIONS):
+			await self._record_hot_prefixes((prefix,))
+		top_phrases_from_local_cache = self._top_phrases_for_prefix_local_cache(prefix, options)
+		if (top_phrases_from_local_cache is not None):
+			return top_phrases_from_local_cache
+
+		return await self._single_flight.do((prefix, options), self._top_phrases_for_prefix_remote, prefix, options, self._local_cache.generation)
+
+	async def _top_phrases_for_prefix_remote(self, prefix, options, local_cache_generation):
+		target_id = self._routing_table.target_id
+		top_phrases_from_distributed_cache = await self._top_phrases_for_prefix_distributed_cache(target_id, prefix, options)
+		if (top_phrases_from_distributed_cache is not None):
+			self._insert_top_phrases_local_cache(prefix, options, top_phrases_from_distributed_cache, local_cache_generation)
+			return top_phrases_from_distributed_cache
+
+		backends = self._backends_for_prefix(prefix, options)
+
+		start_time = time.monotonic()
+		if (len(backends) == 1):
+			partition, backend_hostnames = backends[0]
+			top_phrases = await self._top_phrases_backends(partition, backend_hostnames, '/top-phrases', prefix, options)
+		else:
+			top_phrases = merge_weighted_top_phrases(await asyncio.gather(*[
+				self._top_phrases_backends(partition, backend_hostnames, '/top-phrases', prefix, options, True)
+				for partition, backend_hostnames in backends]))
+		self._early_refresh.record_fetch_time(time.monotonic() - start_time)
+		await self._insert_top_phrases_distributed_cache_many(target_id, {prefix: top_phrases}, options)
+		self._insert_top_phrases_local_cache(prefix, options, top_phrases, local_cache_generation)
+
+		return top_phrases
+
+	async def top_phrases_for_prefixes(self, prefixes, fuzzy=False, mode=LOOKUP_MODE_PREFIX):
+		""" Batched version of top_phrases_for_prefix, see Frontend.top_phrases_for_prefixes """
+		prefixes = list(dict.fromkeys(prefixes))
+		options = LookupOptions(fuzzy, mode)
+		if (options == DEFAULT_LOOKUP_OPTIONS):
+			await self._record_hot_prefixes(prefixes)
+		top_phrases_by_prefix = dict()
+		local_cache_generation = self._local_cache.generation
+		target_id = self._routing_table.target_id
+
+		missing_prefixes = []
+		for prefix in prefixes:
+			top_phrases = self._top_phrases_for_prefix_local_cache(prefix, options)
+			if (top_phrases is not None):
+				top_phrases_by_prefix[prefix] = top_phrases
+			else:
+				missing_prefixes.append(prefix)
+
+		if (missing_prefixes):
+			top_phrases_from_distributed_cache = await self._top_phrases_for_prefixes_distributed_cache(target_id, missing_prefixes, options)
+			missing_prefixes = []
+			for prefix, top_phrases in top_phrases_from_distributed_cache.items():
+				if (top_phrases is not None):
+					top_phrases_by_prefix[prefix] = top_phrases
+					self._insert_top_phrases_local_cache(prefix, options, top_phrases, local_cache_generation)
+				else:
+					missing_prefixes.append(prefix)
+
+		backends_by_prefix = {prefix: self._backends_for_prefix(prefix, options) for prefix in missing_prefixes}
+		prefixes_by_request = group_prefixes_by_request(backends_by_prefix)
+		requests_top_phrases = await asyncio.gather(*[
+			self._top_phrases_backends(partition, hostnames, '/top-phrases/batch', partition_prefixes, options, weighted)
+			for (partition, weighted), (hostnames, partition_prefixes) in prefixes_by_request.items()])
+		top_phrases_from_backends = merge_requests_top_phrases(backends_by_prefix, dict(zip(prefixes_by_request, requests_top_phrases)))
+
+		await self._insert_top_phrases_distributed_cache_many(target_id, top_phrases_from_backends, options)
+		for prefix, top_phrases in top_phrases_from_backends.items():
+			self._insert_top_phrases_local_cache(prefix, options, top_phrases, local_cache_generation)
+		top_phrases_by_prefix.update(top_phrases_from_backends)
+
+		return {prefix: top_phrases_by_prefix[prefix] for prefix in prefixes}
+
+	async def _top_phrases_backends(self, partition, backend_hostnames, path, prefix, options, weighted=False):
+		""" Asks the first backend node, and a second one when the first fails or, with hedging, once it becomes slow """
+		hedge_after_s = self._backend_latencies.value
+		if (not self._backend_hedging_enabled or hedge_after_s is None or len(backend_hostnames) < 2):
+			try:
+				return await self._top_phrases_backend(partition, backend_hostnames[0], path, prefix, options, weighted)
+			except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+				if (len(backend_hostnames) < 2):
+					raise
+				self._logger.warn(f'Request to backend {backend_hostnames[0]} failed ({e!r}), retrying with {backend_hostnames[1]}')
+				return await self._top_phrases_backend(partition, backend_hostnames[1], path, prefix, options, weighted)
+
+		pending = {asyncio.ensure_future(self._top_phrases_backend(partition, backend_hostnames[0], path, prefix, options, weighted))}
+		done, pending = await asyncio.wait(pending, timeout=hedge_after_s)
+		if (done and next(iter(done)).exception() is None):
+			return next(iter(done)).result()
+		self._logger.debug(f'Hedging request for prefix {prefix} to backend {backend_hostnames[1]}')
+		pending.add(asyncio.ensure_future(self._top_phrases_backend(partition, backend_hostnames[1], path, prefix, options, weighted)))
+
+		error = None
+		try:
+			while (pending):
+				done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+				for task in done:
+					if (task.exception() is None):
+						return task.result()
+					error = task.exception()
+		finally:
+			# Unlike threads, the slower request can be abandoned
+			for task in pending:
+				task.cancel()
+		raise error
+
+	async def _top_phrases_backend(self, partition, backend_hostname, path, prefix, options, weighted=False):
+		""" See Frontend._top_phrases_backend """
+		self._logger.debug(f'Getting phrases from host {backend_hostname}')
+		start_time = time.monotonic()
+		params = [('prefix', p) for p in prefix] if (isinstance(prefix, list)) else [('prefix', prefix)]
+		params.extend((('fuzzy', str(options.fuzzy).lower()), ('mode', options.mode), ('weighted', str(weighted).lower())))
+		try:
+			async with self._backend_session.get(f'http://{backend_hostname}:8001{path}', params=params, headers={'Accept': BACKEND_ACCEPT}) as r:
+				r.raise_for_status()
+				content = await r.read()
+		except (aiohttp.ClientError, asyncio.TimeoutError):
+			BACKEND_REQUEST_ERRORS.labels(partition, path).inc()
+			raise
+		latency_s = time.monotonic() - start_time
+		self._backend_latencies.record(latency_s)
+		BACKEND_REQUEST_DURATION.labels(partition, path).observe(latency_s)
+		return decode_backend_response(r.headers.get('Content-Type'), content, isinstance(prefix, list))
+
+	def _on_current_target_changed(self, target_id):
+		# Called from a zookeeper thread; the local cache is thread safe
+		self._logger.info(f'Current target is now {target_id}; clearing local cache')
+		self._local_cache.clear()
+
+	def _top_phrases_for_prefix_local_cache(self, prefix, options):
+		if (not self._local_cache_enabled):
+			return None
+		top_phrases = self._local_cache.get((prefix, options))
+		(LOCAL_CACHE_MISSES if (top_phrases is None) else LOCAL_CACHE_HITS).inc()
+		return top_phrases
+
+	def _insert_top_phrases_local_cache(self, prefix, options, top_phrases, generation):
+		if (not self._local_cache_enabled):
+			return
+		self._local_cache.set((prefix, options), top_phrases, generation)
+
+
+	async def _top_phrases_for_prefix_distributed_cache(self, target_id, prefix, options):
+		return (await self._top_phrases_for_prefixes_distributed_cache(target_id, [prefix], options))[prefix]
+
+	async def _top_phrases_for_prefixes_distributed_cache(self, target_id, prefixes, options):
+		""" See Frontend._top_phrases_for_prefixes_distributed_cache """
+		if (not self._distributed_cache_enabled or not target_id):
+			return dict.fromkeys(prefixes)
+
+		pipeline = self._distributed_cache.pipeline()
+		for prefix in prefixes:
+			key = distributed_cache_key(target_id, prefix, options)
+			pipeline.get(key)
+			pipeline.pttl(key)
+		with DISTRIBUTED_CACHE_DURATION.labels('get').time():
+			results = await pipeline.execute()
+
+		top_phrases_by_prefix = dict()
+		for prefix, value, time_to_live_ms in zip(prefixes, results[0::2], results[1::2]):
+			# Values that cannot be decoded are misses too, so they are fetched again and overwritten
+			top_phrases = decode_cached_top_phrases(value) if (value is not None) else None
+			if (top_phrases is None):
+				top_phrases_by_prefix[prefix] = None
+				DISTRIBUTED_CACHE_MISSES.inc()
+			elif (self._early_refresh.should_refresh(time_to_live_ms / 1000 if (time_to_live_ms >= 0) else None)):
+				top_phrases_by_prefix[prefix] = None
+				DISTRIBUTED_CACHE_EARLY_REFRESHES.inc()
+			else:
+				top_phrases_by_prefix[prefix] = top_phrases
+				DISTRIBUTED_CACHE_HITS.inc()
+		return top_phrases_by_prefix
+
+	async def _insert_top_phrases_distributed_cache_many(self, target_id, top_phrases_by_prefix, options):
+		if (not self._distributed_cache_enabled or not target_id or not top_phrases_by_prefix):
+			return
+
+		pipeline = self._distributed_cache.pipeline()
+		for prefix, top_phrases in top_phrases_by_prefix.items():
+			value = encode_cached_top_phrases(top_phrases)
+			if (value is not None):
+				pipeline.set(distributed_cache_key(target_id, prefix, options), value, expire=DISTRIBUTED_CACHE_TIME_TO_EXPIRE_S)
+		with DISTRIBUTED_CACHE_DURATION.labels('set').time():
+			await pipeline.execute()
+
+	async def _record_hot_prefixes(self, prefixes):
+		""" See Frontend._record_hot_prefixes """
+		if (not self._distributed_cache_enabled):
+			return
+		self._hot_prefixes.record(prefixes)
+		prefix_counts = self._hot_prefixes.take_if_due()
+		if (not prefix_counts):
+			return
+
+		try:
+			pipeline = self._distributed_cache.pipeline()
+			for prefix, count in prefix_counts:
+				pipeline.zincrby(DISTRIBUTED_CACHE_HOT_PREFIXES_KEY, count, prefix)
+			pipeline.zremrangebyrank(DISTRIBUTED_CACHE_HOT_PREFIXES_KEY, 0, -HOT_PREFIXES_MAX_ENTRIES - 1)
+			with DISTRIBUTED_CACHE_DURATION.labels('record_hot_prefixes').time():
+				await pipeline.execute()
+		except aioredis.RedisError as e:
+			self._logger.warn(f'Could not record hot prefixes ({e!r})')
+
+
+	def _backends_for_prefix(self, prefix, options):
+		""" See Frontend._backends_for_prefix """
+		if (options.fuzzy and prefix):
+			partitions = self._routing_table.partitions_for_first_character(prefix.lower()[0])
+		else:
+			partition_and_hostnames = self._routing_table.partition_for_prefix(prefix)
+			partitions = [partition_and_hostnames] if (partition_and_hostnames is not None) else []
+
+		if (not partitions):
+			raise BackendNodesNotAvailable("No backend nodes available to complete the request")
+		for partition, hostnames in partitions:
+			if (not hostnames):
+				self._logger.warn(f'The partition {partition} does not have any active nodes')
+				raise BackendNodesNotAvailable("No backend nodes available to complete the request")
+		return [(partition, random.sample(hostnames, len(hostnames))) for partition, hostnames in partitions]
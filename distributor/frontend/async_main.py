@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST
+from distutils.util import strtobool
+from async_frontend import AsyncFrontend
+from frontend import BackendNodesNotAvailable, LOOKUP_MODES, LOOKUP_MODE_PREFIX
+from metrics import latest_metrics
+
+
+MAX_BATCH_PREFIXES = int(os.getenv('MAX_BATCH_PREFIXES', 100))
+
+
+class BatchTooLargeError(Exception):
+	pass
+
+class InvalidParameterError(Exception):
+	pass
+
+
+class MainResource(object):
+	""" aiohttp counterpart of main.MainResource, with the same routes and responses """
+
+	def __init__(self):
+		self._logger = logging.getLogger('gunicorn.error')
+		self._frontend = AsyncFrontend()
+
+	async def on_startup(self, app):
+		await self._frontend.start()
+
+	async def on_cleanup(self, app):
+		await self._frontend.stop()
+
+	async def on_get(self, request):
+		self._logger.debug(f'Handling {request.method} request {request.url}')
+		try:
+			top_phrases = await self._frontend.top_phrases_for_prefix(request.query['prefix'], *self._lookup_params(request))
+			return self._response(web.HTTPOk.status_code, {"status": "success", "data": {"top_phrases": top_phrases}})
+
+		except InvalidParameterError as err:
+			return self._response(web.HTTPBadRequest.status_code, {"status": "error", "message": str(err)})
+
+		except BackendNodesNotAvailable as err:
+			return self._response(web.HTTPInternalServerError.status_code, {"status": "error", "message": "No backend nodes available to complete the request"})
+
+		except Exception as e:
+			self._logger.error('An error occurred when processing the request', exc_info=e)
+			return self._response(web.HTTPInternalServerError.status_code, {"status": "error", "message": "An error occurred when processing the request"})
+
+	async def on_get_batch(self, request):
+		self._logger.debug(f'Handling {request.method} request {request.url}')
+		try:
+			prefixes = request.query.getall('prefix', [])
+			if (len(prefixes) > MAX_BATCH_PREFIXES):
+				raise BatchTooLargeError(f'At most {MAX_BATCH_PREFIXES} prefixes can be requested at once')
+
+			top_phrases = await self._frontend.top_phrases_for_prefixes(prefixes, *self._lookup_params(request))
+			return self._response(web.HTTPOk.status_code, {"status": "success", "data": {"top_phrases": top_phrases}})
+
+		except (BatchTooLargeError, InvalidParameterError) as err:
+			return self._response(web.HTTPBadRequest.status_code, {"status": "error", "message": str(err)})
+
+		except BackendNodesNotAvailable as err:
+			return self._response(web.HTTPInternalServerError.status_code, {"status": "error", "message": "No backend nodes available to complete the request"})
+
+		except Exception as e:
+			self._logger.error('An error occurred when processing the request', exc_info=e)
+			return self._response(web.HTTPInternalServerError.status_code, {"status": "error", "message": "An error occurred when processing the request"})
+
+	async def on_get_metrics(self, request):
+		return web.Response(body=latest_metrics(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+	def _lookup_params(self, request):
+		""" Returns the fuzzy and mode parameters """
+		try:
+			fuzzy = bool(strtobool(request.query.get('fuzzy', 'false')))
+		except ValueError:
+			raise InvalidParameterError(f'Invalid value for the fuzzy parameter: {request.query["fuzzy"]}')
+		mode = request.query.get('mode', LOOKUP_MODE_PREFIX)
+		if (mode not in LOOKUP_MODES):
+			raise InvalidParameterError(f'The mode must be one of {", ".join(LOOKUP_MODES)}')
+		return fuzzy, mode
+
+	def _response(self, status, body):
+		return web.Response(status=status, text=json.dumps(body), content_type='application/json')
+
+
+app = web.Application()
+main_resource = MainResource()
+app.on_startup.append(main_resource.on_startup)
+app.on_cleanup.append(main_resource.on_cleanup)
+app.router.add_get('/top-phrases', main_resource.on_get)
+app.router.add_get('/top-phrases/batch', main_resource.on_get_batch)
+app.router.add_get('/metrics', main_resource.on_get_metrics)
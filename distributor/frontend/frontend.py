@@ -1,100 +1,618 @@
 import os
+import json
 import requests
 import random
+import math
 import logging
 import redis
-import pickle
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from distutils.util import strtobool
-from kazoo.client import KazooClient, DataWatch
+from kazoo.client import KazooClient, KazooState, DataWatch
+from kazoo.exceptions import NoNodeError
+import prometheus_client
+
+import top_phrases_codec
+from distributed_cache import DISTRIBUTED_CACHE_TIME_TO_EXPIRE_S, DISTRIBUTED_CACHE_HOT_PREFIXES_KEY
+from distributed_cache import top_phrases_cache_key, encode_cached_top_phrases, decode_cached_top_phrases
+from metrics import LATENCY_BUCKETS_S, ZOOKEEPER_CALL_DURATION, time_methods
 
 ZK_CURRENT_TARGET = '/phrases/distributor/current_target'
-DISTRIBUTED_CACHE_TOP_PHRASES_KEY = 'top-phrases:'
+HOT_PREFIXES_MAX_ENTRIES = int(os.getenv('HOT_PREFIXES_MAX_ENTRIES', 10000))
+# The binary format is preferred, but the JSON one of older backends is still understood
+BACKEND_ACCEPT = f'{top_phrases_codec.MEDIA_TYPE}, application/json;q=0.9'
+LOOKUP_MODE_PREFIX = 'prefix'
+LOOKUP_MODES = (LOOKUP_MODE_PREFIX, 'infix', 'any') # The backends' trie.MODES
+TOP_PHRASES_PER_PREFIX = 5 # The backends' Trie.TOP_PHRASES_PER_PREFIX
+ZOOKEEPER_TIMED_METHODS = ('get', 'get_children', 'exists')
+
+CACHE_LOOKUPS = prometheus_client.Counter('frontend_cache_lookups_total', 'Prefixes looked up in each cache, by result', ['cache', 'result'])
+LOCAL_CACHE_HITS = CACHE_LOOKUPS.labels('local', 'hit')
+LOCAL_CACHE_MISSES = CACHE_LOOKUPS.labels('local', 'miss')
+DISTRIBUTED_CACHE_HITS = CACHE_LOOKUPS.labels('distributed', 'hit')
+DISTRIBUTED_CACHE_MISSES = CACHE_LOOKUPS.labels('distributed', 'miss')
+DISTRIBUTED_CACHE_EARLY_REFRESHES = CACHE_LOOKUPS.labels('distributed', 'early_refresh')
+# Local cache misses either issue a fetch from the distributed cache or the backends, or wait for the one already in flight
+BACKEND_FETCHES = prometheus_client.Counter('frontend_backend_fetches_total', 'Fetches of local cache misses, by whether they were issued or coalesced', ['result'])
+BACKEND_FETCHES_ISSUED = BACKEND_FETCHES.labels('issued')
+BACKEND_FETCHES_COALESCED = BACKEND_FETCHES.labels('coalesced')
+DISTRIBUTED_CACHE_DURATION = prometheus_client.Histogram('frontend_distributed_cache_duration_seconds', 'Duration of the distributed cache round trips',
+	['operation'], buckets=LATENCY_BUCKETS_S)
+BACKEND_REQUEST_DURATION = prometheus_client.Histogram('frontend_backend_request_duration_seconds', 'Duration of the successful backend requests',
+	['partition', 'path'], buckets=LATENCY_BUCKETS_S)
+BACKEND_REQUEST_ERRORS = prometheus_client.Counter('frontend_backend_request_errors_total', 'Backend requests that failed', ['partition', 'path'])
+
+
+# How phrases are matched: fuzzy ones allow typos in the prefix, and the mode picks the phrases starting with the prefix,
+# those with a later word starting with it, or both
+LookupOptions = namedtuple('LookupOptions', ('fuzzy', 'mode'), defaults=(False, LOOKUP_MODE_PREFIX))
+DEFAULT_LOOKUP_OPTIONS = LookupOptions()
 
 
 class BackendNodesNotAvailable(Exception):
 	pass
 
+class LocalCache:
+	"""
+	Bounded LRU cache, where each entry expires after a time to live. Shared by all the threads of a worker.
+	Clearing the cache starts a new generation, and values fetched during a previous generation are not stored.
+	"""
+
+	def __init__(self, max_entries, time_to_live_s):
+		self._max_entries = max_entries
+		self._time_to_live_s = time_to_live_s
+		self._entries = OrderedDict() # key -> (expiration time, value), from least to most recently used
+		self._lock = threading.Lock()
+		self.generation = 0
+
+	def get(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+			if (entry is None or entry[0] < time.monotonic()):
+				if (entry is not None):
+					del self._entries[key]
+				return None
+			self._entries.move_to_end(key)
+			return entry[1]
+
+	def set(self, key, value, generation):
+		with self._lock:
+			if (generation != self.generation):
+				return
+			self._entries[key] = (time.monotonic() + self._time_to_live_s, value)
+			self._entries.move_to_end(key)
+			while (len(self._entries) > self._max_entries):
+				self._entries.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self.generation += 1
+
+	def __len__(self):
+		return len(self._entries)
+
+class RoutingTable:
+	"""
+	Local copy of the current target's partitions and the hostnames of their active backend nodes.
+	It is rebuilt whenever a zookeeper watch on the current target, its partitions, their nodes or the nodes' hostnames fires,
+	so routing a request does not need any zookeeper round trip.
+	"""
+
+	def __init__(self, zk, on_target_changed=None):
+		self._logger = logging.getLogger('gunicorn.error')
+		self._zk = zk
+		self._on_target_changed = on_target_changed
+		self._refresh_lock = threading.Lock()
+		self.target_id = None
+		# (sorted partition starts, [(partition, end, hostnames)] in the same order), replaced as a whole on each refresh
+		self._table = ([], [])
+
+	def start(self):
+		self._zk.add_listener(self._on_connection_state_changed)
+		datawatch_current_target = DataWatch(client=self._zk, path=ZK_CURRENT_TARGET, func=self._on_current_target_changed)
+
+	def partition_for_prefix(self, prefix):
+		""" Returns the (partition, hostnames) serving the prefix, or None if no partition does """
+		starts, partitions = self._table
+		i = bisect_right(starts, prefix) - 1
+		if (i < 0):
+			return None
+		partition, end, hostnames = partitions[i]
+		if (end and prefix >= end):
+			return None
+		return partition, hostnames
+
+	def partitions_for_first_character(self, character):
+		""" Returns the (partition, hostnames) of every partition serving some of the prefixes starting with the character """
+		starts, partitions = self._table
+		first = max(bisect_right(starts, character) - 1, 0)
+		last = bisect_left(starts, chr(ord(character) + 1))
+		return [(partition, hostnames) for partition, end, hostnames in partitions[first:last] if (not end or end > character)]
+
+	def _on_current_target_changed(self, data, stat):
+		self._logger.info(f'_on_current_target_changed Data is {data}')
+		with self._refresh_lock:
+			self.target_id = data.decode() if (data) else None
+		self._refresh()
+		if (self._on_target_changed):
+			self._on_target_changed(self.target_id)
+
+	def _on_connection_state_changed(self, state):
+		# Watches are lost along with the session, so rebuild (and re-arm) them once connected again
+		if (state == KazooState.CONNECTED):
+			self._zk.handler.spawn(self._refresh)
+
+	def _on_watch_event(self, event):
+		self._refresh()
+
+	def _refresh(self):
+		with self._refresh_lock:
+			target_id = self.target_id
+
+			starts = []
+			partitions = []
+			if (target_id):
+				partitions_path = f'/phrases/distributor/{target_id}/partitions'
+				try:
+					partition_names = self._zk.get_children(partitions_path, watch=self._on_watch_event)
+				except NoNodeError:
+					partition_names = []
+
+				for partition in sorted(partition_names, key=lambda partition: partition.split('|')[0]):
+					start, end = partition.split('|')
+					nodes_path = f'{partitions_path}/{partition}/nodes'
+					hostnames = []
+					try:
+						for node in self._zk.get_children(nodes_path, watch=self._on_watch_event):
+							hostname = self._zk.get(f'{nodes_path}/{node}', watch=self._on_watch_event)[0].decode()
+							if (hostname):
+								hostnames.append(hostname)
+					except NoNodeError:
+						pass # A node left while the table was being built, its watch will trigger another refresh
+
+					starts.append(start)
+					partitions.append((partition, end, tuple(hostnames)))
+
+			self._table = (starts, partitions)
+			self._logger.info(f'Routing table for target {target_id}: {partitions}')
+
+
+class SingleFlight:
+	"""
+	Lets concurrent calls for the same key share the result of the first one, instead of each making its own call.
+	The calls made, and the ones that were coalesced into a call already in flight, are counted in BACKEND_FETCHES.
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._in_flight = dict() # key -> Future of the call in flight
+
+	def do(self, key, function, *args):
+		with self._lock:
+			future = self._in_flight.get(key)
+			leader = (future is None)
+			if (leader):
+				future = self._in_flight[key] = Future()
+		if (not leader):
+			BACKEND_FETCHES_COALESCED.inc()
+			return future.result()
+
+		BACKEND_FETCHES_ISSUED.inc()
+
+		try:
+			result = function(*args)
+			future.set_result(result)
+			return result
+		except BaseException as e:
+			future.set_exception(e)
+			raise
+		finally:
+			with self._lock:
+				del self._in_flight[key]
+
+
+class EarlyRefresh:
+	"""
+	Probabilistic early expiration (XFetch): a cached value is refreshed before it expires, with a probability that grows
+	as its remaining time to live gets closer to the time a refresh takes, scaled by beta. Refreshes of a hot key are
+	then made by a single reader ahead of time, instead of by every reader at once when it expires.
+	"""
+
+	def __init__(self, beta, smoothing=0.1):
+		self._beta = beta
+		self._smoothing = smoothing
+		self.fetch_time_s = None # Exponential moving average of the refresh times
+
+	def record_fetch_time(self, fetch_time_s):
+		if (self.fetch_time_s is None):
+			self.fetch_time_s = fetch_time_s
+		else:
+			self.fetch_time_s += self._smoothing * (fetch_time_s - self.fetch_time_s)
+
+	def should_refresh(self, remaining_time_to_live_s):
+		if (self._beta <= 0 or self.fetch_time_s is None or remaining_time_to_live_s is None):
+			return False
+		if (self.fetch_time_s * self._beta * -math.log(1.0 - random.random()) < remaining_time_to_live_s):
+			return False
+		return True
+
+
+class HotPrefixes:
+	"""
+	Counts the prefixes looked up by a worker, including local cache hits, handing them over every flush_interval_s
+	so that the most looked up ones can be added to the distributed cache's hot prefixes.
+	"""
+
+	def __init__(self, flush_interval_s, max_flushed_prefixes):
+		self._flush_interval_s = flush_interval_s
+		self._max_flushed_prefixes = max_flushed_prefixes
+		self._counts = Counter()
+		self._lock = threading.Lock()
+		self._last_flush_time = time.monotonic()
+
+	def record(self, prefixes):
+		with self._lock:
+			self._counts.update(prefixes)
+
+	def take_if_due(self):
+		""" Returns the (prefix, count) pairs to flush, or None if it is not time to flush yet """
+		with self._lock:
+			if (time.monotonic() - self._last_flush_time < self._flush_interval_s):
+				return None
+			counts, self._counts = self._counts, Counter()
+			self._last_flush_time = time.monotonic()
+		return counts.most_common(self._max_flushed_prefixes)
+
+
+class LatencyTracker:
+	""" Keeps the most recent latencies, and a percentile of them that is recomputed every few samples """
+
+	def __init__(self, percentile, window_size=1000, recompute_every=100):
+		self._percentile = percentile
+		self._latencies = deque(maxlen=window_size)
+		self._recompute_every = recompute_every
+		self._samples_since_recompute = 0
+		self.value = None
+
+	def record(self, latency_s):
+		self._latencies.append(latency_s)
+		self._samples_since_recompute += 1
+		if (self._samples_since_recompute >= self._recompute_every):
+			self._samples_since_recompute = 0
+			latencies = sorted(self._latencies)
+			self.value = latencies[min(len(latencies) - 1, math.ceil(len(latencies) * self._percentile / 100) - 1)]
+
+
 class Frontend:
 
 	def __init__(self):
 		self._logger = logging.getLogger('gunicorn.error')
-		self._zk = KazooClient(hosts=f'{os.getenv("ZOOKEEPER_HOST")}:2181')
+		self._zk = time_methods(KazooClient(hosts=f'{os.getenv("ZOOKEEPER_HOST")}:2181'), ZOOKEEPER_CALL_DURATION, ZOOKEEPER_TIMED_METHODS)
 		self._distributed_cache = redis.Redis(host=os.getenv("DISTRIBUTED_CACHE_HOST"), port=6379, db=0)
 		self._distributed_cache_enabled = bool(strtobool(os.getenv('DISTRIBUTED_CACHE_ENABLED', 'true')))
+		self._local_cache = LocalCache(int(os.getenv('LOCAL_CACHE_MAX_ENTRIES', 10000)), float(os.getenv('LOCAL_CACHE_TIME_TO_LIVE_S', 60)))
+		self._local_cache_enabled = bool(strtobool(os.getenv('LOCAL_CACHE_ENABLED', 'true')))
+		self._routing_table = RoutingTable(self._zk, on_target_changed=self._on_current_target_changed)
+		# Concurrent misses for a prefix share one fetch, and hot prefixes are refreshed shortly before they expire
+		self._single_flight = SingleFlight()
+		self._early_refresh = EarlyRefresh(float(os.getenv('DISTRIBUTED_CACHE_EARLY_REFRESH_BETA', 1)))
+		self._hot_prefixes = HotPrefixes(float(os.getenv('HOT_PREFIXES_FLUSH_INTERVAL_S', 10)), int(os.getenv('HOT_PREFIXES_MAX_FLUSHED', 1000)))
+
+		# Keep-alive connections to the backends, shared by the worker's threads
+		self._backend_session = requests.Session()
+		backend_pool_size = int(os.getenv('BACKEND_POOL_SIZE', 10))
+		self._backend_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=backend_pool_size, pool_maxsize=backend_pool_size))
+		self._backend_timeout_s = float(os.getenv('BACKEND_TIMEOUT_S', 1))
+		# Once a backend request takes longer than this percentile of the recent ones, a second request is sent to another node of the partition
+		self._backend_hedging_enabled = bool(strtobool(os.getenv('BACKEND_HEDGING_ENABLED', 'false')))
+		self._backend_latencies = LatencyTracker(float(os.getenv('BACKEND_HEDGING_PERCENTILE', 95)))
+		self._backend_executor = ThreadPoolExecutor(max_workers=int(os.getenv('BACKEND_HEDGING_MAX_THREADS', 2 * backend_pool_size)))
+		# Separate from the one above, as its tasks wait for the (possibly hedged) requests submitted to it
+		self._partitions_executor = ThreadPoolExecutor(max_workers=int(os.getenv('BATCH_MAX_THREADS', backend_pool_size)))
 
 	def start(self):
 		self._zk.start()
+		self._routing_table.start()
 
 	def stop(self):
-		self._zk.stop()		
+		self._zk.stop()
+		self._backend_executor.shutdown(wait=False)
+		self._partitions_executor.shutdown(wait=False)
+		self._backend_session.close()
+
+	# Using Cache Aside Pattern, first with the worker's local cache and then with the distributed cache.
+	# Each of the LookupOptions is cached separately, and only the default lookups count towards the hot prefixes
+	def top_phrases_for_prefix(self, prefix, fuzzy=False, mode=LOOKUP_MODE_PREFIX):
+		options = LookupOptions(fuzzy, mode)
+		if (options == DEFAULT_LOOKUP_OPTIONS):
+			self._record_hot_prefixes((prefix,))
+		top_phrases_from_local_cache = self._top_phrases_for_prefix_local_cache(prefix, options)
+		if (top_phrases_from_local_cache is not None):
+			return top_phrases_from_local_cache
 
-	# Using Cache Aside Pattern
-	def top_phrases_for_prefix(self, prefix):
-		top_phrases_from_distributed_cache = self._top_phrases_for_prefix_distributed_cache(prefix)
+		return self._single_flight.do((prefix, options), self._top_phrases_for_prefix_remote, prefix, options, self._local_cache.generation)
+
+	def _top_phrases_for_prefix_remote(self, prefix, options, local_cache_generation):
+		# Cache keys include the target, so entries of the previous target are never served once the current one changes
+		target_id = self._routing_table.target_id
+		top_phrases_from_distributed_cache = self._top_phrases_for_prefix_distributed_cache(target_id, prefix, options)
 		if (top_phrases_from_distributed_cache is not None):
 			self._logger.debug(f'Got top phrases from distributed cache: {top_phrases_from_distributed_cache}')
+			self._insert_top_phrases_local_cache(prefix, options, top_phrases_from_distributed_cache, local_cache_generation)
 			return top_phrases_from_distributed_cache
 
-		backend_hostname = self._random_backend_for_prefix(prefix)
+		backends = self._backends_for_prefix(prefix, options)
 
-		if (backend_hostname is None):
-			raise BackendNodesNotAvailable("No backend nodes available to complete the request")
+		start_time = time.monotonic()
+		if (len(backends) == 1):
+			partition, backend_hostnames = backends[0]
+			top_phrases = self._top_phrases_backends(partition, backend_hostnames, '/top-phrases', prefix, options)
+		else:
+			futures = [
+				self._partitions_executor.submit(self._top_phrases_backends, partition, backend_hostnames, '/top-phrases', prefix, options, True)
+				for partition, backend_hostnames in backends]
+			top_phrases = merge_weighted_top_phrases([future.result() for future in futures])
+		self._early_refresh.record_fetch_time(time.monotonic() - start_time)
+		self._insert_top_phrases_distributed_cache(target_id, prefix, options, top_phrases)
+		self._insert_top_phrases_local_cache(prefix, options, top_phrases, local_cache_generation)
+
+		return top_phrases
+
+	def top_phrases_for_prefixes(self, prefixes, fuzzy=False, mode=LOOKUP_MODE_PREFIX):
+		"""
+		Batched version of top_phrases_for_prefix, returning a dict from each prefix to its top phrases.
+		Cache misses are fetched from the distributed cache in a single round trip, and then with a single backend request per partition,
+		plus a weighted one for the fuzzy lookups looked up in several partitions.
+		"""
+		prefixes = list(dict.fromkeys(prefixes))
+		options = LookupOptions(fuzzy, mode)
+		if (options == DEFAULT_LOOKUP_OPTIONS):
+			self._record_hot_prefixes(prefixes)
+		top_phrases_by_prefix = dict()
+		local_cache_generation = self._local_cache.generation
+		target_id = self._routing_table.target_id
+
+		missing_prefixes = []
+		for prefix in prefixes:
+			top_phrases = self._top_phrases_for_prefix_local_cache(prefix, options)
+			if (top_phrases is not None):
+				top_phrases_by_prefix[prefix] = top_phrases
+			else:
+				missing_prefixes.append(prefix)
+
+		if (missing_prefixes):
+			top_phrases_from_distributed_cache = self._top_phrases_for_prefixes_distributed_cache(target_id, missing_prefixes, options)
+			missing_prefixes = []
+			for prefix, top_phrases in top_phrases_from_distributed_cache.items():
+				if (top_phrases is not None):
+					top_phrases_by_prefix[prefix] = top_phrases
+					self._insert_top_phrases_local_cache(prefix, options, top_phrases, local_cache_generation)
+				else:
+					missing_prefixes.append(prefix)
+
+		backends_by_prefix = {prefix: self._backends_for_prefix(prefix, options) for prefix in missing_prefixes}
+		prefixes_by_request = group_prefixes_by_request(backends_by_prefix)
+		futures = {
+			(partition, weighted): self._partitions_executor.submit(self._top_phrases_backends, partition, hostnames, '/top-phrases/batch', partition_prefixes, options, weighted)
+			for (partition, weighted), (hostnames, partition_prefixes) in prefixes_by_request.items()}
+		top_phrases_from_backends = merge_requests_top_phrases(backends_by_prefix, {request: future.result() for request, future in futures.items()})
+
+		self._insert_top_phrases_distributed_cache_many(target_id, top_phrases_from_backends, options)
+		for prefix, top_phrases in top_phrases_from_backends.items():
+			self._insert_top_phrases_local_cache(prefix, options, top_phrases, local_cache_generation)
+		top_phrases_by_prefix.update(top_phrases_from_backends)
+
+		return {prefix: top_phrases_by_prefix[prefix] for prefix in prefixes}
+
+	def _top_phrases_backends(self, partition, backend_hostnames, path, prefix, options, weighted=False):
+		""" Asks the first backend node, and a second one when the first fails or, with hedging, once it becomes slow """
+		hedge_after_s = self._backend_latencies.value
+		if (not self._backend_hedging_enabled or hedge_after_s is None or len(backend_hostnames) < 2):
+			try:
+				return self._top_phrases_backend(partition, backend_hostnames[0], path, prefix, options, weighted)
+			except requests.RequestException as e:
+				if (len(backend_hostnames) < 2):
+					raise
+				self._logger.warn(f'Request to backend {backend_hostnames[0]} failed ({e}), retrying with {backend_hostnames[1]}')
+				return self._top_phrases_backend(partition, backend_hostnames[1], path, prefix, options, weighted)
+
+		pending = {self._backend_executor.submit(self._top_phrases_backend, partition, backend_hostnames[0], path, prefix, options, weighted)}
+		done, pending = wait(pending, timeout=hedge_after_s)
+		if (done and next(iter(done)).exception() is None):
+			return next(iter(done)).result()
+		self._logger.debug(f'Hedging request for prefix {prefix} to backend {backend_hostnames[1]}')
+		pending.add(self._backend_executor.submit(self._top_phrases_backend, partition, backend_hostnames[1], path, prefix, options, weighted))
+
+		error = None
+		while (pending):
+			done, pending = wait(pending, return_when=FIRST_COMPLETED)
+			for future in done:
+				if (future.exception() is None):
+					return future.result()
+				error = future.exception()
+		raise error
 
+	def _top_phrases_backend(self, partition, backend_hostname, path, prefix, options, weighted=False):
+		"""
+		The prefix is a list of prefixes for batch requests, which is sent as a repeated query parameter.
+		Weighted requests get (phrase, weight, edits) triples instead of phrases, see merge_weighted_top_phrases.
+		"""
 		self._logger.debug(f'Getting phrases from host {backend_hostname}')
-		r = requests.get(f'http://{backend_hostname}:8001/top-phrases', params = {'prefix': prefix})
-		self._logger.debug(f'request content: {r.content}; r.json(): {r.json()}')
-		top_phrases = r.json()["data"]["top_phrases"]
-		self._insert_top_phrases_distributed_cache(prefix, top_phrases)
+		start_time = time.monotonic()
+		params = {'prefix': prefix, 'fuzzy': str(options.fuzzy).lower(), 'mode': options.mode, 'weighted': str(weighted).lower()}
+		try:
+			r = self._backend_session.get(f'http://{backend_hostname}:8001{path}', params = params, headers={'Accept': BACKEND_ACCEPT}, timeout=self._backend_timeout_s)
+			r.raise_for_status()
+		except requests.RequestException:
+			BACKEND_REQUEST_ERRORS.labels(partition, path).inc()
+			raise
+		latency_s = time.monotonic() - start_time
+		self._backend_latencies.record(latency_s)
+		BACKEND_REQUEST_DURATION.labels(partition, path).observe(latency_s)
+		self._logger.debug(f'request content: {r.content}')
+		return decode_backend_response(r.headers.get('Content-Type'), r.content, isinstance(prefix, list))
 
+	def _on_current_target_changed(self, target_id):
+		# Called once the routing table points to the new target, so nothing fetched afterwards comes from the previous one
+		self._logger.info(f'Current target is now {target_id}; clearing local cache')
+		self._local_cache.clear()
+
+	def _top_phrases_for_prefix_local_cache(self, prefix, options):
+		if (not self._local_cache_enabled):
+			return None
+		top_phrases = self._local_cache.get((prefix, options))
+		(LOCAL_CACHE_MISSES if (top_phrases is None) else LOCAL_CACHE_HITS).inc()
 		return top_phrases
 
+	def _insert_top_phrases_local_cache(self, prefix, options, top_phrases, generation):
+		if (not self._local_cache_enabled):
+			return
+		self._local_cache.set((prefix, options), top_phrases, generation)
+
 
-	def _top_phrases_for_prefix_distributed_cache(self, prefix):
+	def _top_phrases_for_prefix_distributed_cache(self, target_id, prefix, options):
 		if (not self._distributed_cache_enabled):
 			return None
 
-		key = DISTRIBUTED_CACHE_TOP_PHRASES_KEY + prefix
-		self._logger.debug(f'Attempting to get top phrases from distributed cache with key {key}')
-		if (self._distributed_cache.exists(key)):
-			pickled_list = self._distributed_cache.get(key)
-			return pickle.loads(pickled_list)
-		return None
+		self._logger.debug(f'Attempting to get top phrases from distributed cache for prefix {prefix}')
+		return self._top_phrases_for_prefixes_distributed_cache(target_id, [prefix], options)[prefix]
 
-	def _insert_top_phrases_distributed_cache(self, prefix, top_phrases):
-		if (not self._distributed_cache_enabled):
+	def _top_phrases_for_prefixes_distributed_cache(self, target_id, prefixes, options):
+		"""
+		Returns a dict from each prefix to its cached top phrases, or None when they are not cached,
+		or when they were picked to be refreshed early
+		"""
+		if (not self._distributed_cache_enabled or not target_id):
+			return dict.fromkeys(prefixes)
+
+		pipeline = self._distributed_cache.pipeline(transaction=False)
+		for prefix in prefixes:
+			key = distributed_cache_key(target_id, prefix, options)
+			pipeline.get(key)
+			pipeline.pttl(key)
+		with DISTRIBUTED_CACHE_DURATION.labels('get').time():
+			results = pipeline.execute()
+
+		top_phrases_by_prefix = dict()
+		for prefix, value, time_to_live_ms in zip(prefixes, results[0::2], results[1::2]):
+			# Values that cannot be decoded are misses too, so they are fetched again and overwritten
+			top_phrases = decode_cached_top_phrases(value) if (value is not None) else None
+			if (top_phrases is None):
+				top_phrases_by_prefix[prefix] = None
+				DISTRIBUTED_CACHE_MISSES.inc()
+			elif (self._early_refresh.should_refresh(time_to_live_ms / 1000 if (time_to_live_ms >= 0) else None)):
+				top_phrases_by_prefix[prefix] = None
+				DISTRIBUTED_CACHE_EARLY_REFRESHES.inc()
+			else:
+				top_phrases_by_prefix[prefix] = top_phrases
+				DISTRIBUTED_CACHE_HITS.inc()
+		return top_phrases_by_prefix
+
+	def _insert_top_phrases_distributed_cache(self, target_id, prefix, options, top_phrases):
+		if (not self._distributed_cache_enabled or not target_id):
 			return
 
-		key = DISTRIBUTED_CACHE_TOP_PHRASES_KEY + prefix
-		time_to_expire_s = 30 * 60 # Expire entry after 30 minutes
+		key = distributed_cache_key(target_id, prefix, options)
 		self._logger.debug(f'Inserting top phrases tokey {key}, with top phrases {top_phrases}')
-		self._distributed_cache.set(key, pickle.dumps(top_phrases), ex=time_to_expire_s)
-
+		value = encode_cached_top_phrases(top_phrases)
+		if (value is not None):
+			with DISTRIBUTED_CACHE_DURATION.labels('set').time():
+				self._distributed_cache.set(key, value, ex=DISTRIBUTED_CACHE_TIME_TO_EXPIRE_S)
 
-	def _random_backend_for_prefix(self, prefix):
+	def _insert_top_phrases_distributed_cache_many(self, target_id, top_phrases_by_prefix, options):
+		if (not self._distributed_cache_enabled or not target_id or not top_phrases_by_prefix):
+			return
 
-		if (self._zk.exists(ZK_CURRENT_TARGET) is None):
-			return None
+		pipeline = self._distributed_cache.pipeline(transaction=False)
+		for prefix, top_phrases in top_phrases_by_prefix.items():
+			value = encode_cached_top_phrases(top_phrases)
+			if (value is not None):
+				pipeline.set(distributed_cache_key(target_id, prefix, options), value, ex=DISTRIBUTED_CACHE_TIME_TO_EXPIRE_S)
+		with DISTRIBUTED_CACHE_DURATION.labels('set').time():
+			pipeline.execute()
 
-		target_id = self._zk.get(ZK_CURRENT_TARGET)[0].decode()
-		if (not target_id):
-			return None
+	def _record_hot_prefixes(self, prefixes):
+		if (not self._distributed_cache_enabled):
+			return
+		self._hot_prefixes.record(prefixes)
+		prefix_counts = self._hot_prefixes.take_if_due()
+		if (not prefix_counts):
+			return
 
-		partitions = self._zk.get_children(f'/phrases/distributor/{target_id}/partitions')
-		for partition in partitions:
-			start, end = partition.split('|')
-			if ((not start or prefix >= start) and (not end or prefix < end)):
-				nodes_path = f'/phrases/distributor/{target_id}/partitions/{partition}/nodes'
+		try:
+			pipeline = self._distributed_cache.pipeline(transaction=False)
+			for prefix, count in prefix_counts:
+				pipeline.zincrby(DISTRIBUTED_CACHE_HOT_PREFIXES_KEY, count, prefix)
+			pipeline.zremrangebyrank(DISTRIBUTED_CACHE_HOT_PREFIXES_KEY, 0, -HOT_PREFIXES_MAX_ENTRIES - 1) # Keeps the hottest ones
+			with DISTRIBUTED_CACHE_DURATION.labels('record_hot_prefixes').time():
+				pipeline.execute()
+		except redis.RedisError as e:
+			self._logger.warn(f'Could not record hot prefixes ({e})')
 
-				nodes = self._zk.get_children(nodes_path)
-				random.shuffle(nodes)
 
-				while nodes:
-					node = nodes.pop()
-					hostname = self._zk.get(f'{nodes_path}/{node}')[0].decode()
-					if (hostname):
-						return hostname
+	def _backends_for_prefix(self, prefix, options):
+		"""
+		Returns the (partition, hostnames of its nodes in random order) of the partitions to ask for the prefix. Fuzzy matches
+		only share the first character of the prefix, and partition boundaries can be longer than that, so they are looked up
+		in every partition serving some of the prefixes starting with it.
+		"""
+		if (options.fuzzy and prefix):
+			partitions = self._routing_table.partitions_for_first_character(prefix.lower()[0])
+		else:
+			partition_and_hostnames = self._routing_table.partition_for_prefix(prefix)
+			partitions = [partition_and_hostnames] if (partition_and_hostnames is not None) else []
 
+		if (not partitions):
+			raise BackendNodesNotAvailable("No backend nodes available to complete the request")
+		for partition, hostnames in partitions:
+			if (not hostnames):
 				self._logger.warn(f'The partition {partition} does not have any active nodes')
-				return None
+				raise BackendNodesNotAvailable("No backend nodes available to complete the request")
+		return [(partition, random.sample(hostnames, len(hostnames))) for partition, hostnames in partitions]
+
+
+def group_prefixes_by_request(backends_by_prefix):
+	"""
+	Groups the prefixes of a batch into one request per partition, and per whether they are weighted: the top phrases of
+	the prefixes looked up in several partitions are asked with their weights, so that they can be merged.
+	Returns a dict from each (partition, weighted) to the hostnames of the partition and its prefixes.
+	"""
+	prefixes_by_request = dict()
+	for prefix, backends in backends_by_prefix.items():
+		for partition, hostnames in backends:
+			prefixes_by_request.setdefault((partition, len(backends) > 1), (hostnames, []))[1].append(prefix)
+	return prefixes_by_request
+
+def merge_requests_top_phrases(backends_by_prefix, top_phrases_by_request):
+	""" Returns a dict from each prefix to its top phrases, from the results of the requests of group_prefixes_by_request """
+	top_phrases_by_prefix = dict()
+	for prefix, backends in backends_by_prefix.items():
+		if (len(backends) == 1):
+			top_phrases_by_prefix[prefix] = top_phrases_by_request[(backends[0][0], False)][prefix]
+		else:
+			top_phrases_by_prefix[prefix] = merge_weighted_top_phrases([top_phrases_by_request[(partition, True)][prefix] for partition, _ in backends])
+	return top_phrases_by_prefix
+
+def merge_weighted_top_phrases(partitions_top_phrases):
+	"""
+	Merges the (phrase, weight, edits) top phrases of several partitions into the TOP_PHRASES_PER_PREFIX best phrases,
+	by fewest edits and then highest weight, as each backend ranks them
+	"""
+	best = dict()
+	for top_phrases in partitions_top_phrases:
+		for phrase, weight, edits in top_phrases:
+			if (phrase not in best or (edits, -weight) < best[phrase]):
+				best[phrase] = (edits, -weight)
+	return [phrase for phrase, _ in sorted(best.items(), key=lambda entry: entry[1])[:TOP_PHRASES_PER_PREFIX]]
+
+def distributed_cache_key(target_id, prefix, options=DEFAULT_LOOKUP_OPTIONS):
+	return top_phrases_cache_key(target_id, prefix, options.fuzzy, options.mode)
 
-		return None
+def decode_backend_response(content_type, content, batch):
+	if (content_type and content_type.startswith(top_phrases_codec.MEDIA_TYPE)):
+		return top_phrases_codec.decode_top_phrases_by_prefix(content) if (batch) else top_phrases_codec.decode_top_phrases(content)
+	return json.loads(content)["data"]["top_phrases"]
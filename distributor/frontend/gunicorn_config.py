@@ -1,6 +1,7 @@
 """gunicorn WSGI server configuration."""
 from multiprocessing import cpu_count
-from os import environ, getenv
+from os import environ, getenv, path
+import sys
 from distutils.util import strtobool
 
 
@@ -10,5 +11,18 @@ max_requests = 1000
 
 workers = int(getenv('NUM_WORKERS', cpu_count() * 2))
 threads = int(getenv('MAX_THREADS', 1))
+# In async mode, each worker runs the aiohttp app in an event loop, and threads are not used
+worker_class = 'aiohttp.GunicornWebWorker' if (getenv('SERVING_MODE', 'sync') == 'async') else 'sync'
 reload = bool(strtobool(getenv('RELOAD', 'false')))
 loglevel = getenv('LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+	sys.path.insert(0, path.dirname(path.abspath(__file__)))
+	from metrics import clear_multiprocess_dir
+	clear_multiprocess_dir()
+
+
+def child_exit(server, worker):
+	from metrics import mark_process_dead
+	mark_process_dead(worker.pid)
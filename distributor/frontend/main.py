@@ -1,7 +1,16 @@
 import falcon
 import json
 import logging
-from frontend import Frontend, BackendNodesNotAvailable
+import os
+from frontend import Frontend, BackendNodesNotAvailable, LOOKUP_MODES, LOOKUP_MODE_PREFIX
+from metrics import MetricsResource
+
+
+MAX_BATCH_PREFIXES = int(os.getenv('MAX_BATCH_PREFIXES', 100))
+
+
+class BatchTooLargeError(Exception):
+	pass
 
 
 class MainResource(object):
@@ -12,8 +21,49 @@ class MainResource(object):
 
 	def on_get(self, req, resp):
 		self._logger.debug(f'Handling {req.method} request {req.url} with params {req.params}')
+		fuzzy, mode = self._lookup_params(req)
+		try:
+			top_phrases = self._frontend.top_phrases_for_prefix(req.params['prefix'], fuzzy, mode)
+			response_body = json.dumps(
+				{
+					"status": "success",
+					"data": {
+						"top_phrases": top_phrases 
+					}
+				 })
+			resp.status = falcon.HTTP_200
+			resp.body = response_body
+			
+		except BackendNodesNotAvailable as err:
+			response_body = json.dumps(
+				{
+					"status": "error",
+					"message": "No backend nodes available to complete the request"
+				 })
+			resp.status = falcon.HTTP_500
+			resp.body = response_body
+
+		except Exception as e:
+			self._logger.error('An error occurred when processing the request', exc_info=e)
+			response_body = json.dumps(
+				{
+					"status": "error",
+					"message": "An error occurred when processing the request"
+				 })
+			resp.status = falcon.HTTP_500
+			resp.body = response_body
+
+	def on_get_batch(self, req, resp):
+		self._logger.debug(f'Handling {req.method} request {req.url} with params {req.params}')
+		fuzzy, mode = self._lookup_params(req)
 		try:
-			top_phrases = self._frontend.top_phrases_for_prefix(req.params['prefix'])
+			prefixes = req.params.get('prefix', [])
+			if (isinstance(prefixes, str)):
+				prefixes = [prefixes]
+			if (len(prefixes) > MAX_BATCH_PREFIXES):
+				raise BatchTooLargeError(f'At most {MAX_BATCH_PREFIXES} prefixes can be requested at once')
+
+			top_phrases = self._frontend.top_phrases_for_prefixes(prefixes, fuzzy, mode)
 			response_body = json.dumps(
 				{
 					"status": "success",
@@ -24,6 +74,15 @@ class MainResource(object):
 			resp.status = falcon.HTTP_200
 			resp.body = response_body
 			
+		except BatchTooLargeError as err:
+			response_body = json.dumps(
+				{
+					"status": "error",
+					"message": str(err)
+				 })
+			resp.status = falcon.HTTP_400
+			resp.body = response_body
+
 		except BackendNodesNotAvailable as err:
 			response_body = json.dumps(
 				{
@@ -42,9 +101,19 @@ class MainResource(object):
 				 })
 			resp.status = falcon.HTTP_500
 			resp.body = response_body
-		
+
+	def _lookup_params(self, req):
+		""" Returns the fuzzy and mode parameters, raising falcon's own 400 response for invalid values """
+		fuzzy = req.get_param_as_bool('fuzzy', default=False)
+		mode = req.get_param('mode', default=LOOKUP_MODE_PREFIX)
+		if (mode not in LOOKUP_MODES):
+			raise falcon.HTTPInvalidParam(f'The mode must be one of {", ".join(LOOKUP_MODES)}', 'mode')
+		return fuzzy, mode
+
 
 app = falcon.API()
 main_resource = MainResource()
 app.add_route('/top-phrases', main_resource)
+app.add_route('/top-phrases/batch', main_resource, suffix='batch')
+app.add_route('/metrics', MetricsResource())
 
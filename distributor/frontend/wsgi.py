@@ -1,4 +1,9 @@
-from main import app
+import os
+
+if (os.getenv('SERVING_MODE', 'sync') == 'async'):
+    from async_main import app
+else:
+    from main import app
 
 if __name__ == "__main__":
-    app.run()
\ No newline at end of file
+    app.run()
@@ -0,0 +1,29 @@
+import top_phrases_codec
+
+# Keys and values of the top phrases cached in redis by the frontends, and pre-warmed by the applier on target switches.
+# Both sides use these, so that pre-warmed entries are the ones the frontends look up.
+DISTRIBUTED_CACHE_TOP_PHRASES_KEY = 'top-phrases:' # Followed by the target id, a colon and the prefix, see top_phrases_cache_key
+DISTRIBUTED_CACHE_TIME_TO_EXPIRE_S = 30 * 60 # Expire entries after 30 minutes
+DISTRIBUTED_CACHE_HOT_PREFIXES_KEY = 'hot-prefixes' # Sorted set of the most looked up prefixes, pre-warmed by the applier on target switches
+DEFAULT_MODE = 'prefix' # The backends' trie.MODE_PREFIX
+
+
+def top_phrases_cache_key(target_id, prefix, fuzzy=False, mode=DEFAULT_MODE):
+    """ Lookups other than the default ones prefix the key with their options, such as fuzzy-infix-top-phrases: """
+    fuzzy_key_prefix = 'fuzzy-' if (fuzzy) else ''
+    mode_key_prefix = f'{mode}-' if (mode != DEFAULT_MODE) else ''
+    return f'{fuzzy_key_prefix}{mode_key_prefix}{DISTRIBUTED_CACHE_TOP_PHRASES_KEY}{target_id}:{prefix}'
+
+def encode_cached_top_phrases(top_phrases):
+    """ Returns the distributed cache value for the top phrases, or None if they cannot be encoded and are not to be cached """
+    try:
+        return top_phrases_codec.encode_top_phrases(top_phrases)
+    except top_phrases_codec.CodecError:
+        return None
+
+def decode_cached_top_phrases(value):
+    """ Values in another format, such as the pickles written by older frontends, are treated as cache misses """
+    try:
+        return top_phrases_codec.decode_top_phrases(value)
+    except top_phrases_codec.CodecError:
+        return None
@@ -0,0 +1,61 @@
+import os
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram, generate_latest, multiprocess
+
+# Each gunicorn worker is a process of its own, with its own metrics. When PROMETHEUS_MULTIPROC_DIR is set, prometheus_client
+# keeps every process' metrics in memory-mapped files of that directory, so that updating them stays a local write, and
+# /metrics adds up the files of all the processes. gunicorn's master empties the directory on start, and marks the files
+# of the workers that exit as dead, so that their live gauges are dropped (see the services' gunicorn_config.py).
+MULTIPROCESS_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+LATENCY_BUCKETS_S = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+LOAD_BUCKETS_S = (.01, .1, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Both the frontends and the backends talk to zookeeper
+ZOOKEEPER_CALL_DURATION = Histogram('zookeeper_call_duration_seconds', 'Duration of the zookeeper client calls', ['method'], buckets=LATENCY_BUCKETS_S)
+
+
+class MetricsResource:
+    """ Falcon resource serving the metrics in the Prometheus text format """
+
+    def on_get(self, req, resp):
+        resp.data = latest_metrics()
+        resp.content_type = CONTENT_TYPE_LATEST
+
+
+def latest_metrics():
+    if (not MULTIPROCESS_DIR):
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def clear_multiprocess_dir():
+    """ Removes the metrics of the processes of a previous run, to be called before any worker starts """
+    if (not MULTIPROCESS_DIR):
+        return
+    os.makedirs(MULTIPROCESS_DIR, exist_ok=True)
+    for file_name in os.listdir(MULTIPROCESS_DIR):
+        if (file_name.endswith('.db')):
+            os.remove(os.path.join(MULTIPROCESS_DIR, file_name))
+
+
+def mark_process_dead(pid):
+    if (MULTIPROCESS_DIR):
+        multiprocess.mark_process_dead(pid, MULTIPROCESS_DIR)
+
+
+def time_methods(instance, histogram, method_names):
+    """ Observes the duration of the calls of the instance's methods in the histogram, labeled by method name """
+    for method_name in method_names:
+        setattr(instance, method_name, _timed(getattr(instance, method_name), histogram.labels(method_name)))
+    return instance
+
+def _timed(method, histogram):
+    def timed_method(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start_time)
+    return timed_method
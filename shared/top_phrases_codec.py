@@ -0,0 +1,82 @@
+import struct
+
+# Compact binary encoding of top phrases, for the distributed cache values and the backend responses.
+# Unlike pickle, decoding cannot run code, and the leading version byte lets the format evolve.
+#
+# Phrases are stored one per line all along the pipeline, so they never contain a newline, and the strings are
+# newline separated UTF-8, which is both small and quick to split. Layout, little endian:
+#   list of top phrases: version (B), kind (B), the newline separated phrases
+#   mapping of prefixes to top phrases: version (B), kind (B), number of prefixes (H), number of top phrases of each
+#   prefix (H each), and then the newline separated strings, each prefix followed by its top phrases
+# Strings that are empty or contain a newline cannot be encoded, in which case a CodecError is raised.
+
+MEDIA_TYPE = 'application/vnd.autocomplete.top-phrases'
+VERSION = 1
+KIND_LIST = 0
+KIND_MAPPING = 1
+
+_HEADER = struct.Struct('<BB')
+_LIST_HEADER = _HEADER.pack(VERSION, KIND_LIST)
+_MAPPING_HEADER = _HEADER.pack(VERSION, KIND_MAPPING)
+_COUNT = struct.Struct('<H')
+
+
+class CodecError(Exception):
+    pass
+
+
+def encode_top_phrases(top_phrases):
+    return _LIST_HEADER + _encode_strings(top_phrases)
+
+def decode_top_phrases(data):
+    _check_header(data, _LIST_HEADER)
+    return _decode_strings(data, _HEADER.size, None)
+
+def encode_top_phrases_by_prefix(top_phrases_by_prefix):
+    strings = []
+    for prefix, top_phrases in top_phrases_by_prefix.items():
+        strings.append(prefix)
+        strings.extend(top_phrases)
+    try:
+        counts = struct.pack(f'<H{len(top_phrases_by_prefix)}H', len(top_phrases_by_prefix), *map(len, top_phrases_by_prefix.values()))
+    except struct.error as e:
+        raise CodecError(f'Cannot encode top phrases: {e}')
+    return _MAPPING_HEADER + counts + _encode_strings(strings)
+
+def decode_top_phrases_by_prefix(data):
+    _check_header(data, _MAPPING_HEADER)
+    try:
+        number_prefixes, = _COUNT.unpack_from(data, _HEADER.size)
+        counts = struct.unpack_from(f'<{number_prefixes}H', data, _HEADER.size + _COUNT.size)
+    except struct.error as e:
+        raise CodecError(f'Malformed top phrases: {e}')
+    strings = _decode_strings(data, _HEADER.size + _COUNT.size + 2 * number_prefixes, number_prefixes + sum(counts))
+
+    top_phrases_by_prefix = dict()
+    i = 0
+    for count in counts:
+        top_phrases_by_prefix[strings[i]] = strings[i + 1:i + 1 + count]
+        i += 1 + count
+    return top_phrases_by_prefix
+
+
+def _encode_strings(strings):
+    text = '\n'.join(strings)
+    # Each string adds one separator, unless it is empty or has newlines of its own
+    if (text.count('\n') != max(len(strings) - 1, 0) or not all(strings)):
+        raise CodecError('Cannot encode empty strings or strings with newlines')
+    return text.encode('utf-8')
+
+def _decode_strings(data, offset, expected_number_strings):
+    try:
+        text = str(data[offset:], 'utf-8')
+    except UnicodeDecodeError as e:
+        raise CodecError(f'Malformed top phrases: {e}')
+    strings = text.split('\n') if (text) else []
+    if (expected_number_strings is not None and len(strings) != expected_number_strings):
+        raise CodecError(f'Malformed top phrases: {len(strings)} strings instead of {expected_number_strings}')
+    return strings
+
+def _check_header(data, expected_header):
+    if (data[:_HEADER.size] != expected_header):
+        raise CodecError(f'Unsupported top phrases encoding {bytes(data[:_HEADER.size])}')
@@ -0,0 +1,129 @@
+from array import array
+from bisect import bisect_left, insort
+import heapq
+import math
+import threading
+import time
+import zlib
+
+
+class CountMinSketch:
+    """
+    Approximate counts in a fixed depth x width table of floats. Estimates never undercount, and overcount by at most
+    e / width of the total count with probability 1 - e^-depth.
+    """
+
+    def __init__(self, width, depth):
+        self._width = width
+        self._depth = depth
+        self._counts = array('d', [0.0]) * (width * depth)
+
+    def add(self, key, count):
+        """ Adds count to the key, returning its new estimate """
+        estimate = math.inf
+        for index in self._indexes(key):
+            self._counts[index] += count
+            estimate = min(estimate, self._counts[index])
+        return estimate
+
+    def estimate(self, key):
+        return min(self._counts[index] for index in self._indexes(key))
+
+    def scale(self, factor):
+        for index in range(len(self._counts)):
+            self._counts[index] *= factor
+
+    def _indexes(self, key):
+        # Two independent hashes combined (Kirsch-Mitzenmacher) give the depth row hashes
+        key_bytes = key.encode('utf-8')
+        hash_a = zlib.crc32(key_bytes)
+        hash_b = zlib.adler32(key_bytes) | 1
+        return [row * self._width + (hash_a + row * hash_b) % self._width for row in range(self._depth)]
+
+
+class TrendingPhrases:
+    """
+    Keeps the most searched phrases of the last few half-lives in a fixed amount of memory: a count-min sketch estimates
+    the exponentially decayed count of every phrase, and the capacity phrases with the highest estimates are kept as
+    heavy hitters, sorted so that the ones for a prefix are a bisect away.
+
+    Decay is applied forward: a search at time t counts 2^((t - landmark) / half_life), so counts never need to be aged,
+    and dividing by the same factor for the current time gives the decayed count. Everything is rescaled to a new landmark
+    before the factors grow too large.
+    """
+
+    RESCALE_EXPONENT = 32
+
+    def __init__(self, capacity=1000, width=2048, depth=4, half_life_s=600, clock=time.time):
+        self._capacity = capacity
+        self._half_life_s = half_life_s
+        self._clock = clock
+        self._sketch = CountMinSketch(width, depth)
+        self._landmark = clock()
+        self._counts = dict() # Heavy hitter phrase -> count, scaled to the landmark
+        self._heap = [] # (count, phrase) entries, some of them outdated, to find the heavy hitter with the lowest count
+        self._sorted_phrases = []
+        self._lock = threading.Lock()
+
+    def add(self, phrase, count=1):
+        phrase = phrase.lower()
+        with self._lock:
+            exponent = (self._clock() - self._landmark) / self._half_life_s
+            if (exponent > TrendingPhrases.RESCALE_EXPONENT):
+                self._rescale(exponent)
+                exponent = 0
+            estimate = self._sketch.add(phrase, count * 2 ** exponent)
+
+            if (phrase in self._counts):
+                self._counts[phrase] = estimate
+            elif (len(self._counts) < self._capacity):
+                self._counts[phrase] = estimate
+                insort(self._sorted_phrases, phrase)
+            elif (estimate > self._lowest_count()):
+                evicted_phrase = heapq.heappop(self._heap)[1]
+                del self._counts[evicted_phrase]
+                del self._sorted_phrases[bisect_left(self._sorted_phrases, evicted_phrase)]
+                self._counts[phrase] = estimate
+                insort(self._sorted_phrases, phrase)
+            else:
+                return
+            heapq.heappush(self._heap, (estimate, phrase))
+            if (len(self._heap) > 4 * self._capacity):
+                self._heap = [(count, phrase) for phrase, count in self._counts.items()]
+                heapq.heapify(self._heap)
+
+    def top_phrases_with_counts_for_prefix(self, prefix, k, min_count=0):
+        """ Returns the k heavy hitters starting with prefix with the highest decayed counts, and at least min_count """
+        prefix = prefix.lower()
+        with self._lock:
+            divisor = 2 ** ((self._clock() - self._landmark) / self._half_life_s)
+            start = bisect_left(self._sorted_phrases, prefix)
+            end = bisect_left(self._sorted_phrases, prefix + '\U0010ffff', start)
+            candidates = [(self._counts[phrase] / divisor, phrase) for phrase in self._sorted_phrases[start:end]]
+        return [(phrase, count) for count, phrase in heapq.nlargest(k, candidates) if count >= min_count]
+
+    def _lowest_count(self):
+        # Counts only grow, so an entry whose count is outdated is replaced by the current one and looked at again later
+        while (self._heap[0][0] != self._counts.get(self._heap[0][1])):
+            phrase = heapq.heappop(self._heap)[1]
+            if (phrase in self._counts):
+                heapq.heappush(self._heap, (self._counts[phrase], phrase))
+        return self._heap[0][0]
+
+    def _rescale(self, exponent):
+        factor = 2 ** -exponent
+        self._sketch.scale(factor)
+        self._counts = {phrase: count * factor for phrase, count in self._counts.items()}
+        self._heap = [(count, phrase) for phrase, count in self._counts.items()]
+        heapq.heapify(self._heap)
+        self._landmark += exponent * self._half_life_s
+
+
+def merge_top_phrases(top_phrases, trending_phrases, k, max_trending_phrases):
+    """
+    Merges the trending phrases into a top phrases list of at most k phrases, giving up to max_trending_phrases of its
+    last positions to trending phrases that are not already in it.
+    """
+    trending_phrases = [phrase for phrase in trending_phrases if phrase not in top_phrases][:max_trending_phrases]
+    number_top_phrases = max(k - len(trending_phrases), 0)
+    return (top_phrases[:number_top_phrases] + trending_phrases + top_phrases[number_top_phrases:])[:k]
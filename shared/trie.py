@@ -1,25 +1,58 @@
+from array import array
+from bisect import bisect_left
 from collections import namedtuple
-PhraseContainer = namedtuple('PhraseContainer', ('value'))
+import heapq
+import time
+
+PhraseContainer = namedtuple('PhraseContainer', ('value', 'weight'), defaults=(0,))
+
+FUZZY_MAX_EDITS = 2
+FUZZY_PREFIX_LENGTH_PER_EDIT = 3 # Each allowed edit needs this many typed characters, so short prefixes stay exact
+FUZZY_DEADLINE_CHECK_INTERVAL = 64 # Nodes expanded between deadline checks
+MODE_PREFIX = 'prefix' # Phrases starting with the prefix
+MODE_INFIX = 'infix' # Phrases with a word other than the first one starting with the prefix
+MODE_ANY = 'any' # Phrases with any word starting with the prefix
+MODES = (MODE_PREFIX, MODE_INFIX, MODE_ANY)
 
 
 class Node:
     def __init__(self):
         self.childs = dict()
-        self.top_phrases = []
+        self.top_phrases = [] # Kept sorted by descending weight, with ties in insertion order
         
     def __repr__(self):
         return f'{self.childs}; {self.top_phrases}'
 
         
 class Trie:
+    """
+    Keeps the top phrases of each prefix. Phrases can also be added to a separate infix index, under the suffixes starting
+    at some of their words, so that they can be looked up by the start of those words too.
+    """
+
     TOP_PHRASES_PER_PREFIX = 5
+    _infix_root = None # Tries pickled before the infix index existed do not have one
     
     def __init__(self):
         self._root = Node()
         self._all_phrases = dict() # Flyweight pattern, in order to decrease duplication of phrase values
+        self._infix_root = Node()
+        self._infix_phrases = dict() # Phrase -> (weight, offsets) of the phrases added to some infix top phrases list
     
-    def add_phrase(self, phrase):
+    def add_phrase(self, phrase, weight=None):
+        """
+        Adds a phrase, keeping in each prefix node the TOP_PHRASES_PER_PREFIX phrases with the highest weight.
+        Without a weight, phrases are kept in the order they are added, which requires adding them by descending weight.
+        As in CompactTrie, a phrase added again keeps its first weight; see update_phrase to change it.
+        """
         phrase = phrase.lower()
+        if (weight is None):
+            weight = 0
+        if (phrase in self._all_phrases):
+            return
+        # Every phrase is kept, including those in no top phrases list, so that update_phrase can bring them back
+        container = PhraseContainer(phrase, weight)
+        self._all_phrases[phrase] = container
         node = self._root
         for c in phrase:
             if (c in node.childs):
@@ -29,12 +62,99 @@ class Trie:
                 node.childs[c] = new_node
                 node = new_node
                 
-            if (len(node.top_phrases) < Trie.TOP_PHRASES_PER_PREFIX):
-                if (phrase not in self._all_phrases):
-                    self._all_phrases[phrase] = PhraseContainer(phrase)
-                node.top_phrases.append(self._all_phrases[phrase])
+            self._add_top_phrase(node, container)
+
+    def _add_top_phrase(self, node, container):
+        # The top phrases list holds at most TOP_PHRASES_PER_PREFIX entries, so a sorted insertion
+        # is cheaper than keeping a heap and sorting it on every lookup
+        top_phrases = node.top_phrases
+        if (len(top_phrases) >= Trie.TOP_PHRASES_PER_PREFIX and container.weight <= top_phrases[-1].weight):
+            return
+        self._insert_top_phrase(top_phrases, container)
+
+    def _insert_top_phrase(self, top_phrases, container):
+        i = len(top_phrases)
+        while (i > 0 and top_phrases[i - 1].weight < container.weight):
+            i -= 1
+        top_phrases.insert(i, container)
+        if (len(top_phrases) > Trie.TOP_PHRASES_PER_PREFIX):
+            top_phrases.pop()
+
+    def add_infix_phrase(self, phrase, weight, offsets):
+        """
+        Adds a phrase to the infix index under each of its suffixes starting at the given offsets, which are usually
+        some of its token_starts. Phrases only in the infix index are not returned by prefix lookups.
+        """
+        phrase = phrase.lower()
+        if (weight is None):
+            weight = 0
+        container = PhraseContainer(phrase, weight)
+        added = False
+        for offset in offsets:
+            node = self._infix_root
+            for c in phrase[offset:]:
+                if (c in node.childs):
+                    node = node.childs[c]
+                else:
+                    new_node = Node()
+                    node.childs[c] = new_node
+                    node = new_node
+
+                top_phrases = node.top_phrases
+                if (len(top_phrases) >= Trie.TOP_PHRASES_PER_PREFIX and weight <= top_phrases[-1].weight):
+                    continue
+                # A phrase can have the same suffix start at two of its words
+                if (all(top_phrase.value != phrase for top_phrase in top_phrases)):
+                    self._insert_top_phrase(top_phrases, container)
+                    added = True
+        if (added):
+            previous_weight, previous_offsets = self._infix_phrases.get(phrase, (weight, ()))
+            self._infix_phrases[phrase] = (previous_weight, tuple(dict.fromkeys(previous_offsets + tuple(offsets))))
+
+    def update_phrase(self, phrase, weight):
+        """
+        Sets the weight of a phrase which may already be in the trie, repairing the top phrases of each of its prefixes bottom-up.
+        When the weight decreases, the phrase's place is taken by the best of the phrase ending at the node, if any, and the
+        top phrases of the child nodes.
+        Each node gets a new top phrases list, so concurrent lookups never see a partially updated one.
+        """
+        phrase = phrase.lower()
+        previous_container = self._all_phrases.get(phrase)
+        path = []
+        node = self._root
+        for c in phrase:
+            if (c not in node.childs):
+                node.childs[c] = Node()
+            node = node.childs[c]
+            path.append(node)
+
+        container = PhraseContainer(phrase, weight)
+        self._all_phrases[phrase] = container
+        for depth in range(len(path), 0, -1):
+            node = path[depth - 1]
+            top_phrases = [top_phrase for top_phrase in node.top_phrases if top_phrase.value != phrase]
+            if (len(top_phrases) < len(node.top_phrases) and weight < previous_container.weight):
+                values = {top_phrase.value for top_phrase in top_phrases}
+                node_phrase = self._all_phrases.get(phrase[:depth])
+                if (node_phrase is not None and node_phrase.value != phrase and node_phrase.value not in values):
+                    top_phrases.append(node_phrase)
+                    values.add(node_phrase.value)
+                for child in node.childs.values():
+                    for top_phrase in child.top_phrases:
+                        if (top_phrase.value not in values and top_phrase.value != phrase):
+                            top_phrases.append(top_phrase)
+                            values.add(top_phrase.value)
+            top_phrases.append(container)
+            top_phrases.sort(key=lambda top_phrase: -top_phrase.weight) # Stable, so ties keep their order
+            node.top_phrases = top_phrases[:Trie.TOP_PHRASES_PER_PREFIX]
     
     def top_phrases_for_prefix(self, prefix):
+        return [top_phrase.value for top_phrase in self._top_phrase_containers_for_prefix(prefix)]
+
+    def top_phrases_with_weights_for_prefix(self, prefix):
+        return [(top_phrase.value, top_phrase.weight) for top_phrase in self._top_phrase_containers_for_prefix(prefix)]
+
+    def _top_phrase_containers_for_prefix(self, prefix):
         prefix = prefix.lower()
         node = self._root
         for c in prefix:
@@ -42,4 +162,478 @@ class Trie:
                 return []
             node = node.childs[c]
 
-        return [top_phrase.value for top_phrase in node.top_phrases]
+        return node.top_phrases
+
+    def infix_top_phrases_for_prefix(self, prefix):
+        return [top_phrase.value for top_phrase in self._infix_top_phrase_containers_for_prefix(prefix)]
+
+    def infix_top_phrases_with_weights_for_prefix(self, prefix):
+        return [(top_phrase.value, top_phrase.weight) for top_phrase in self._infix_top_phrase_containers_for_prefix(prefix)]
+
+    def _infix_top_phrase_containers_for_prefix(self, prefix):
+        prefix = prefix.lower()
+        node = self._infix_root
+        if (node is None):
+            return []
+        for c in prefix:
+            if (c not in node.childs):
+                return []
+            node = node.childs[c]
+
+        return node.top_phrases
+
+    def fuzzy_top_phrases_for_prefix(self, prefix, max_edits, deadline=None):
+        return [phrase for phrase, _, _ in self.fuzzy_top_phrases_with_weights_for_prefix(prefix, max_edits, deadline)]
+
+    def fuzzy_top_phrases_with_weights_for_prefix(self, prefix, max_edits, deadline=None):
+        """ Returns (phrase, weight, edits) triples, see fuzzy_top_phrases """
+        return fuzzy_top_phrases(
+            prefix.lower(), max_edits, self._root, deadline,
+            children=lambda node: node.childs.items(),
+            top_weight=lambda node: node.top_phrases[0].weight if (node.top_phrases) else 0,
+            top_phrases=lambda node: node.top_phrases, # PhraseContainers unpack as (phrase, weight)
+            phrase=lambda phrase: phrase)
+
+
+class CompactTrie:
+    """
+    Same interface as Trie, but stored in a handful of flat arrays instead of one Node object per prefix.
+
+    Nodes are numbered in post-order. The child edges of node i are edge_chars/edge_childs[edge_starts[i]:edge_starts[i + 1]],
+    sorted by character code point, and its top phrases are the phrase ids in top_ids[top_starts[i]:top_starts[i + 1]].
+    Phrase ids are ranks (0 is the phrase with the highest weight, ties broken by insertion order) and index into a single
+    UTF-8 string pool, with the phrase weights kept in a parallel array.
+    The infix index is a second set of the same arrays (prefixed with infix_) over the indexed suffixes, sharing the phrase
+    ids. To keep it small, a node whose suffixes belong to TOP_PHRASES_PER_PREFIX phrases at most has no children: lookups
+    going past it filter its top phrases instead. prefix_flags and infix_ids/infix_offsets record which phrases are in
+    which index, so that the arrays can be rebuilt.
+    Added phrases are staged and only compacted into the arrays on the first lookup, or when the trie is pickled.
+    """
+
+    def __init__(self):
+        self._pending = [] # (phrase, weight, infix offsets or None for the prefix index)
+        self._pool = b''
+        self._pool_offsets = array('Q', [0])
+        self._weights = array('q')
+        self._edge_starts = array('I', [0, 0])
+        self._edge_chars = array('I')
+        self._edge_childs = array('I')
+        self._top_starts = array('I', [0, 0])
+        self._top_ids = array('I')
+        self._root = 0
+        self._init_infix_index()
+
+    def _init_infix_index(self):
+        self._prefix_flags = array('B', [1]) * len(self._weights)
+        self._infix_ids = array('I')
+        self._infix_offsets = array('I')
+        self._infix_edge_starts = array('I', [0, 0])
+        self._infix_edge_chars = array('I')
+        self._infix_edge_childs = array('I')
+        self._infix_top_starts = array('I', [0, 0])
+        self._infix_top_ids = array('I')
+        self._infix_root = 0
+
+    @classmethod
+    def from_trie(cls, trie):
+        compact_trie = cls()
+        # Trie._all_phrases keeps the phrases in the order they were added
+        for container in trie._all_phrases.values():
+            compact_trie.add_phrase(container.value, container.weight)
+        for phrase, (weight, offsets) in getattr(trie, '_infix_phrases', dict()).items():
+            compact_trie.add_infix_phrase(phrase, weight, offsets)
+        compact_trie._compact()
+        return compact_trie
+
+    def add_phrase(self, phrase, weight=None):
+        self._pending.append((phrase.lower(), 0 if weight is None else weight, None))
+
+    def add_infix_phrase(self, phrase, weight, offsets):
+        """ See Trie.add_infix_phrase """
+        self._pending.append((phrase.lower(), 0 if weight is None else weight, tuple(offsets)))
+
+    def top_phrases_for_prefix(self, prefix):
+        return [self._phrase(phrase_id) for phrase_id in self._top_phrase_ids_for_prefix(prefix)]
+
+    def top_phrases_with_weights_for_prefix(self, prefix):
+        return [(self._phrase(phrase_id), self._weights[phrase_id]) for phrase_id in self._top_phrase_ids_for_prefix(prefix)]
+
+    def _top_phrase_ids_for_prefix(self, prefix):
+        if (self._pending):
+            self._compact()
+
+        node = self._find_node(prefix.lower())
+        if (node is None):
+            return []
+        return self._top_ids[self._top_starts[node]:self._top_starts[node + 1]]
+
+    def infix_top_phrases_for_prefix(self, prefix):
+        return [self._phrase(phrase_id) for phrase_id in self._infix_top_phrase_ids_for_prefix(prefix)]
+
+    def infix_top_phrases_with_weights_for_prefix(self, prefix):
+        return [(self._phrase(phrase_id), self._weights[phrase_id]) for phrase_id in self._infix_top_phrase_ids_for_prefix(prefix)]
+
+    def _infix_top_phrase_ids_for_prefix(self, prefix):
+        if (self._pending):
+            self._compact()
+
+        prefix = prefix.lower()
+        edge_starts, edge_chars = self._infix_edge_starts, self._infix_edge_chars
+        node = self._infix_root
+        for depth, c in enumerate(prefix):
+            code = ord(c)
+            start = edge_starts[node]
+            end = edge_starts[node + 1]
+            if (start == end and depth > 0):
+                # A node without children holds all the phrases of its suffixes, which only need to be checked for the rest of the prefix
+                return [phrase_id for phrase_id in self._infix_top_ids[self._infix_top_starts[node]:self._infix_top_starts[node + 1]]
+                    if (has_infix(self._phrase(phrase_id), prefix))]
+            i = bisect_left(edge_chars, code, start, end)
+            if (i == end or edge_chars[i] != code):
+                return []
+            node = self._infix_edge_childs[i]
+        return self._infix_top_ids[self._infix_top_starts[node]:self._infix_top_starts[node + 1]]
+
+    def fuzzy_top_phrases_for_prefix(self, prefix, max_edits, deadline=None):
+        return [phrase for phrase, _, _ in self.fuzzy_top_phrases_with_weights_for_prefix(prefix, max_edits, deadline)]
+
+    def fuzzy_top_phrases_with_weights_for_prefix(self, prefix, max_edits, deadline=None):
+        """ Returns (phrase, weight, edits) triples, see fuzzy_top_phrases """
+        if (self._pending):
+            self._compact()
+
+        # Edges hold code points, so the prefix is matched as code points too, and phrases are only decoded at the end
+        edge_starts, edge_chars, edge_childs = self._edge_starts, self._edge_chars, self._edge_childs
+        top_starts, top_ids, weights = self._top_starts, self._top_ids, self._weights
+        return fuzzy_top_phrases(
+            [ord(c) for c in prefix.lower()], max_edits, self._root, deadline,
+            children=lambda node: zip(edge_chars[edge_starts[node]:edge_starts[node + 1]], edge_childs[edge_starts[node]:edge_starts[node + 1]]),
+            top_weight=lambda node: weights[top_ids[top_starts[node]]] if (top_starts[node] < top_starts[node + 1]) else 0,
+            top_phrases=lambda node: [(phrase_id, weights[phrase_id]) for phrase_id in top_ids[top_starts[node]:top_starts[node + 1]]],
+            phrase=self._phrase)
+
+    def __getstate__(self):
+        if (self._pending):
+            self._compact()
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if ('_prefix_flags' not in state): # Pickled before the infix index existed
+            self._init_infix_index()
+
+    def _find_node(self, prefix):
+        node = self._root
+        for c in prefix:
+            code = ord(c)
+            end = self._edge_starts[node + 1]
+            i = bisect_left(self._edge_chars, code, self._edge_starts[node], end)
+            if (i == end or self._edge_chars[i] != code):
+                return None
+            node = self._edge_childs[i]
+        return node
+
+    def _phrase(self, phrase_id):
+        return str(self._pool[self._pool_offsets[phrase_id]:self._pool_offsets[phrase_id + 1]], 'utf-8')
+
+    def _compact(self):
+        # Phrase -> [weight, whether it is in the prefix index, infix offsets], in insertion order
+        entries = dict()
+        for phrase_id in range(len(self._weights)):
+            entries[self._phrase(phrase_id)] = [self._weights[phrase_id], bool(self._prefix_flags[phrase_id]), []]
+        for phrase_id, offset in zip(self._infix_ids, self._infix_offsets):
+            entries[self._phrase(phrase_id)][2].append(offset)
+        for phrase, weight, offsets in self._pending:
+            if (not phrase):
+                continue # Drop empty phrases
+            entry = entries.setdefault(phrase, [weight, False, []]) # Duplicates keep the first weight
+            if (offsets is None):
+                entry[1] = True
+            else:
+                entry[2].extend(offset for offset in offsets if (0 < offset < len(phrase) and offset not in entry[2]))
+        entries = [(phrase, entry) for phrase, entry in entries.items() if (entry[1] or entry[2])]
+        entries.sort(key=lambda entry: -entry[1][0]) # Stable, so ties keep their insertion order
+        phrases = [phrase for phrase, _ in entries]
+        weights = array('q', [weight for _, (weight, _, _) in entries])
+        prefix_flags = array('B', [in_prefix_index for _, (_, in_prefix_index, _) in entries])
+        infix_ids = array('I')
+        infix_offsets = array('I')
+        for phrase_id, (_, (_, _, offsets)) in enumerate(entries):
+            for offset in offsets:
+                infix_ids.append(phrase_id)
+                infix_offsets.append(offset)
+
+        encoded_phrases = [phrase.encode('utf-8') for phrase in phrases]
+        pool_offsets = array('Q', [0])
+        for encoded_phrase in encoded_phrases:
+            pool_offsets.append(pool_offsets[-1] + len(encoded_phrase))
+
+        prefix_keys = sorted((phrase, phrase_id) for phrase_id, phrase in enumerate(phrases) if (prefix_flags[phrase_id]))
+        infix_keys = sorted((phrases[phrase_id][offset:], phrase_id) for phrase_id, offset in zip(infix_ids, infix_offsets))
+
+        self._pending = []
+        self._pool = b''.join(encoded_phrases)
+        self._pool_offsets = pool_offsets
+        self._weights = weights
+        self._prefix_flags = prefix_flags
+        self._infix_ids = infix_ids
+        self._infix_offsets = infix_offsets
+        self._edge_starts, self._edge_chars, self._edge_childs, self._top_starts, self._top_ids, self._root = build_trie_arrays(prefix_keys)
+        (self._infix_edge_starts, self._infix_edge_chars, self._infix_edge_childs, self._infix_top_starts, self._infix_top_ids,
+            self._infix_root) = build_trie_arrays(truncate_infix_keys(infix_keys))
+
+
+class LiveTrie:
+    """
+    Serves an immutable trie (such as a MappedTrie) together with the phrase weight changes received since it was built.
+
+    Updated phrases go to a small overlay Trie, and lookups merge the base and overlay top phrases, the overlay weights
+    taking precedence. As the base trie only knows the weights of phrases in some top phrases list, an updated phrase starts
+    from its weight there, or from 0. Weight decreases are only approximate until the next full rebuild replaces the trie.
+    """
+
+    def __init__(self, base):
+        self._base = base
+        self._overlay = Trie()
+        self._weights = dict()
+
+    def apply_weight_deltas(self, weight_deltas):
+        """ Adds each (phrase, weight delta) pair to the phrase's current weight """
+        for phrase, weight_delta in weight_deltas:
+            phrase = phrase.lower()
+            weight = self._weights.get(phrase)
+            if (weight is None):
+                weight = self._base_weight(phrase)
+            weight += weight_delta
+            self._overlay.update_phrase(phrase, weight)
+            self._weights[phrase] = weight
+
+    def top_phrases_for_prefix(self, prefix):
+        return [phrase for phrase, _ in self.top_phrases_with_weights_for_prefix(prefix)]
+
+    def top_phrases_with_weights_for_prefix(self, prefix):
+        top_phrases = dict(self._overlay.top_phrases_with_weights_for_prefix(prefix))
+        for phrase, weight in self._base.top_phrases_with_weights_for_prefix(prefix):
+            if (phrase not in top_phrases):
+                top_phrases[phrase] = self._weights.get(phrase, weight)
+        return sorted(top_phrases.items(), key=lambda top_phrase: -top_phrase[1])[:Trie.TOP_PHRASES_PER_PREFIX]
+
+    def infix_top_phrases_for_prefix(self, prefix):
+        return [phrase for phrase, _ in self.infix_top_phrases_with_weights_for_prefix(prefix)]
+
+    def infix_top_phrases_with_weights_for_prefix(self, prefix):
+        # Only the base trie has an infix index, so updated phrases are ranked by their new weights, but phrases that are not
+        # among its infix top phrases only show up after the next full rebuild
+        top_phrases = [(phrase, self._weights.get(phrase, weight)) for phrase, weight in self._base.infix_top_phrases_with_weights_for_prefix(prefix)]
+        return sorted(top_phrases, key=lambda top_phrase: -top_phrase[1])
+
+    def fuzzy_top_phrases_for_prefix(self, prefix, max_edits, deadline=None):
+        return [phrase for phrase, _, _ in self.fuzzy_top_phrases_with_weights_for_prefix(prefix, max_edits, deadline)]
+
+    def fuzzy_top_phrases_with_weights_for_prefix(self, prefix, max_edits, deadline=None):
+        top_phrases = {phrase: (weight, edits) for phrase, weight, edits in self._overlay.fuzzy_top_phrases_with_weights_for_prefix(prefix, max_edits, deadline)}
+        for phrase, weight, edits in self._base.fuzzy_top_phrases_with_weights_for_prefix(prefix, max_edits, deadline):
+            if (phrase not in top_phrases):
+                top_phrases[phrase] = (self._weights.get(phrase, weight), edits)
+            elif (edits < top_phrases[phrase][1]):
+                top_phrases[phrase] = (top_phrases[phrase][0], edits)
+        top_phrases = sorted(top_phrases.items(), key=lambda top_phrase: (top_phrase[1][1], -top_phrase[1][0]))
+        return [(phrase, weight, edits) for phrase, (weight, edits) in top_phrases[:Trie.TOP_PHRASES_PER_PREFIX]]
+
+    def _base_weight(self, phrase):
+        # A phrase is most likely among the top phrases of its own prefix node, if it is in any list at all
+        for top_phrase, weight in self._base.top_phrases_with_weights_for_prefix(phrase):
+            if (top_phrase == phrase):
+                return weight
+        return 0
+
+
+def fuzzy_top_phrases(prefix, max_edits, root, deadline, children, top_weight, top_phrases, phrase):
+    """
+    Returns the (phrase, weight, edits) of the TOP_PHRASES_PER_PREFIX best phrases starting with a string within max_edits
+    edits of prefix (insertions, deletions, substitutions and transpositions of adjacent characters), by fewest edits and
+    then highest weight. The first character has to match, and prefixes shorter than FUZZY_PREFIX_LENGTH_PER_EDIT
+    characters per edit get fewer edits, as most phrases are a couple of edits away from them. Partition boundaries can
+    be within the phrases starting with a character, so the matches of a partitioned trie have to be merged with those
+    of the other partitions serving its first character.
+
+    The trie is walked best first, each node carrying its row of the edit distance table against prefix (a Levenshtein
+    automaton state). A node's top phrases are all within its row's minimum edits and its best top phrase's weight,
+    so the walk ends once no node left can beat the current TOP_PHRASES_PER_PREFIX results, or once the time.monotonic()
+    deadline passes, in which case the best phrases found so far are returned.
+    The trie is reached through the given functions of a node: its (character, child) edges, the weight of its best top
+    phrase, its (phrase key, weight) top phrases, and the phrase of a phrase key.
+    """
+    if (not prefix):
+        return []
+    max_edits = min(max_edits, FUZZY_MAX_EDITS, len(prefix) // FUZZY_PREFIX_LENGTH_PER_EDIT)
+    length = len(prefix)
+    best = dict() # Phrase key -> (edits, -weight)
+    threshold = None # Worst (edits, -weight) among the results, once there are enough of them
+    limit = max_edits + 1 # Edit counts are capped here, and only the band of cells that can stay below it is computed
+    # Entries: (lower bound for the subtree's results, insertion order, node, character, depth, row, parent row)
+    queue = [((0, 0), 0, root, None, 0, [min(i, limit) for i in range(length + 1)], None)]
+    number_queued = 1
+    number_expanded = 0
+    while (queue):
+        bound, _, node, char, depth, row, parent_row = heapq.heappop(queue)
+        if (threshold is not None and bound >= threshold):
+            break
+        number_expanded += 1
+        if (deadline is not None and number_expanded % FUZZY_DEADLINE_CHECK_INTERVAL == 0 and time.monotonic() > deadline):
+            break
+
+        edits = row[length]
+        if (edits <= max_edits and depth > 0):
+            for key, weight in top_phrases(node):
+                if (key not in best or (edits, -weight) < best[key]):
+                    best[key] = (edits, -weight)
+            if (len(best) >= Trie.TOP_PHRASES_PER_PREFIX):
+                threshold = heapq.nsmallest(Trie.TOP_PHRASES_PER_PREFIX, best.values())[-1]
+            if (min(row) == edits):
+                continue # Deeper nodes cannot be closer, and their best phrases are already in this node's top phrases
+
+        child_depth = depth + 1
+        band = range(max(1, child_depth - max_edits), min(length, child_depth + max_edits) + 1)
+        for child_char, child in children(node):
+            if (depth == 0 and child_char != prefix[0]):
+                continue
+            child_row = [limit] * (length + 1)
+            child_row[0] = min(child_depth, limit)
+            for i in band:
+                cost = row[i - 1] if (prefix[i - 1] == child_char) else row[i - 1] + 1
+                cost = min(cost, row[i] + 1, child_row[i - 1] + 1)
+                if (i > 1 and prefix[i - 1] == char and prefix[i - 2] == child_char):
+                    cost = min(cost, parent_row[i - 2] + 1)
+                child_row[i] = min(cost, limit)
+            min_edits = min(child_row)
+            if (min_edits <= max_edits):
+                child_bound = (min_edits, -top_weight(child))
+                if (threshold is None or child_bound < threshold):
+                    heapq.heappush(queue, (child_bound, number_queued, child, child_char, child_depth, child_row, row))
+                    number_queued += 1
+
+    results = heapq.nsmallest(Trie.TOP_PHRASES_PER_PREFIX, best.items(), key=lambda entry: entry[1])
+    return [(phrase(key), -negative_weight, edits) for key, (edits, negative_weight) in results]
+
+
+def build_trie_arrays(keys, arrays=None):
+    """
+    Returns the CompactTrie (edge_starts, edge_chars, edge_childs, top_starts, top_ids, root) arrays of a trie over the
+    (key, phrase id) pairs, which must be sorted by key. The arrays are only appended to, so they can be given as any
+    empty (edge_starts, edge_chars, edge_childs, top_starts, top_ids) objects with append, extend and len, such as
+    trie_file's section writers. Phrase ids only need to compare in top phrases order.
+    """
+    edge_starts, edge_chars, edge_childs, top_starts, top_ids = arrays or tuple(array('I') for _ in range(5))
+    edge_starts.append(0)
+    top_starts.append(0)
+
+    # Walk the keys in lexicographic order, keeping the path of still open nodes in a stack. A node is closed
+    # (and written to the arrays) as soon as the walk moves past its prefix, at which point all its children are known.
+    # Each stack entry holds the node's character, its (code point, child id) edges and its top phrase id candidates.
+    stack = [[None, [], []]]
+
+    def close_node():
+        char, edges, candidates = stack.pop()
+        node_id = len(edge_starts) - 1
+        for code, child in edges:
+            edge_chars.append(code)
+            edge_childs.append(child)
+        edge_starts.append(len(edge_chars))
+        if (stack):
+            top = heapq.nsmallest(Trie.TOP_PHRASES_PER_PREFIX, set(candidates)) # Infix keys of a phrase can share a node
+            top_ids.extend(top)
+            parent = stack[-1]
+            parent[1].append((ord(char), node_id))
+            parent[2].extend(top)
+        top_starts.append(len(top_ids))
+
+    previous_key = ''
+    for key, phrase_id in keys:
+        common_length = 0
+        for a, b in zip(previous_key, key):
+            if (a != b):
+                break
+            common_length += 1
+
+        while (len(stack) > common_length + 1):
+            close_node()
+        for c in key[common_length:]:
+            stack.append([c, [], []])
+        stack[-1][2].append(phrase_id)
+        previous_key = key
+
+    while (stack):
+        close_node()
+
+    return edge_starts, edge_chars, edge_childs, top_starts, top_ids, len(edge_starts) - 2
+
+def truncate_infix_keys(keys):
+    """
+    Cuts each of the sorted (key, phrase id) pairs at the shortest prefix shared by TOP_PHRASES_PER_PREFIX keys at most, so
+    that the nodes below it, which would all have the same top phrases, are not built. The keys sharing a prefix are
+    contiguous, so that is one more character than the TOP_PHRASES_PER_PREFIX-th longest common prefix with its neighbours.
+    Yields the truncated pairs, only holding the TOP_PHRASES_PER_PREFIX keys on each side of the one being cut.
+    """
+    k = Trie.TOP_PHRASES_PER_PREFIX
+    window = [] # (key, phrase id, common prefix length with the previous key), from k keys before the current one to k after it
+    current = 0
+
+    def truncate(i):
+        key, phrase_id, _ = window[i]
+        neighbour_common_lengths = []
+        common_length = len(key)
+        for j in range(i, max(i - k, 0), -1):
+            common_length = min(common_length, window[j][2])
+            neighbour_common_lengths.append(common_length)
+        common_length = len(key)
+        for j in range(i + 1, min(i + k, len(window) - 1) + 1):
+            common_length = min(common_length, window[j][2])
+            neighbour_common_lengths.append(common_length)
+        neighbour_common_lengths.sort(reverse=True)
+        length = neighbour_common_lengths[k - 1] + 1 if (len(neighbour_common_lengths) >= k) else 1
+        return key[:length], phrase_id
+
+    previous_key = ''
+    for key, phrase_id in keys:
+        common_length = 0
+        for a, b in zip(previous_key, key):
+            if (a != b):
+                break
+            common_length += 1
+        window.append((key, phrase_id, common_length))
+        previous_key = key
+
+        if (len(window) > current + k):
+            yield truncate(current)
+            if (current == k):
+                window.pop(0)
+            else:
+                current += 1
+    for i in range(current, len(window)):
+        yield truncate(i)
+
+def merge_infix_top_phrases(top_phrases, infix_top_phrases):
+    """
+    Merges the (phrase, weight) infix matches into the (phrase, weight, edits) prefix matches, by fewest edits and then highest
+    weight, prefix matches first on ties. Returns the TOP_PHRASES_PER_PREFIX best, each phrase once.
+    """
+    merged_top_phrases = {phrase: (phrase, weight, edits) for phrase, weight, edits in top_phrases}
+    for phrase, weight in infix_top_phrases:
+        if (phrase not in merged_top_phrases):
+            merged_top_phrases[phrase] = (phrase, weight, 0)
+    return sorted(merged_top_phrases.values(), key=lambda top_phrase: (top_phrase[2], -top_phrase[1]))[:Trie.TOP_PHRASES_PER_PREFIX]
+
+def token_starts(phrase):
+    """ Returns the offsets of the words of the phrase, other than the first one """
+    return [i for i in range(1, len(phrase)) if (phrase[i - 1].isspace() and not phrase[i].isspace())]
+
+def has_infix(phrase, prefix):
+    """ Whether a word of the phrase, other than the first one, starts with prefix """
+    return any(phrase.startswith(prefix, offset) for offset in token_starts(phrase))
+
+
+TRIE_IMPLEMENTATIONS = {
+    'node': Trie,
+    'compact': CompactTrie,
+}
@@ -0,0 +1,334 @@
+import heapq
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from itertools import groupby
+
+from trie import Trie, CompactTrie, build_trie_arrays, truncate_infix_keys
+
+# Binary trie file layout (all integers little-endian):
+#   header:   magic (8 bytes), format version (uint32), root node id (uint32), number of sections (uint32),
+#             infix index root node id (uint32, padding before version 3)
+#   sections: (offset, length) uint64 pairs, in the order of SECTIONS
+#   data:     each section's bytes, starting at an 8 byte aligned offset
+# The sections are the CompactTrie arrays, so a MappedTrie can walk the file in place. Version 2 added the weights section;
+# version 1 files, whose phrase ids and top phrases are in insertion order, are read with every weight being 0, as Trie
+# pickles from before weights are. Version 3 added the infix index sections; older files are read as having an empty one.
+MAGIC = b'ACTRIE\x00\x00'
+FORMAT_VERSION = 3
+HEADER = struct.Struct('<8sIIII')
+SECTION = struct.Struct('<QQ')
+SECTIONS = (
+    ('_pool', 'B'),
+    ('_pool_offsets', 'Q'),
+    ('_weights', 'q'),
+    ('_edge_starts', 'I'),
+    ('_edge_chars', 'I'),
+    ('_edge_childs', 'I'),
+    ('_top_starts', 'I'),
+    ('_top_ids', 'I'),
+    ('_infix_edge_starts', 'I'),
+    ('_infix_edge_chars', 'I'),
+    ('_infix_edge_childs', 'I'),
+    ('_infix_top_starts', 'I'),
+    ('_infix_top_ids', 'I'),
+)
+SECTIONS_BY_VERSION = {1: SECTIONS[:2] + SECTIONS[3:8], 2: SECTIONS[:8], 3: SECTIONS}
+ALIGNMENT = 8
+SECTION_BUFFER_ITEMS = 65536 # Items a SectionWriter holds before appending them to its file
+SORT_BUFFER_ITEMS = 1000000 # Items sorted in memory at once by sorted_on_disk
+SORT_RUN_CHUNK_ITEMS = 1024 # Items pickled together in the sorted runs
+
+
+class TrieFileError(Exception):
+    pass
+
+
+def is_trie_file(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_trie_file(trie, path):
+    if (isinstance(trie, Trie)):
+        trie = CompactTrie.from_trie(trie)
+    elif (trie._pending):
+        trie._compact()
+
+    sections = []
+    for attribute, typecode in SECTIONS:
+        data = getattr(trie, attribute)
+        if (isinstance(data, array) and sys.byteorder != 'little'):
+            data = array(data.typecode, data)
+            data.byteswap()
+        sections.append(bytes(data))
+
+    offset = HEADER.size + SECTION.size * len(sections)
+    section_table = []
+    for data in sections:
+        offset += -offset % ALIGNMENT
+        section_table.append((offset, len(data)))
+        offset += len(data)
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, trie._root, len(sections), trie._infix_root))
+        for section_offset, section_length in section_table:
+            f.write(SECTION.pack(section_offset, section_length))
+        for (section_offset, _), data in zip(section_table, sections):
+            f.write(b'\x00' * (section_offset - f.tell()))
+            f.write(data)
+
+
+def write_sorted_trie_file(phrases, infix_phrases, path, work_dir=None, sort_buffer_items=SORT_BUFFER_ITEMS):
+    """
+    Writes the binary trie file of the (phrase, weight) pairs and of the (phrase, weight, offsets) infix index entries, as
+    write_trie_file would for a CompactTrie they were added to, in memory bounded by the trie depth and top phrases
+    instead of by the number of phrases. Both must be sorted by lowercase phrase, keeping the input order of duplicates
+    (as sorted_on_disk does), so that a duplicate phrase keeps its first weight as in CompactTrie.
+
+    Each node is written out as soon as the phrases move past its prefix, along with the phrases, to a temporary file per
+    section in work_dir, which are then copied into the trie file. Phrase ids follow the phrases order instead of their
+    weight, so ties between phrases of the same weight are broken alphabetically instead of by insertion order.
+    The infix index keys are sorted on disk, sort_buffer_items at a time.
+    """
+    if (work_dir is None):
+        work_dir = os.path.dirname(os.path.abspath(path))
+    writers = {attribute: SectionWriter(typecode, work_dir) for attribute, typecode in SECTIONS}
+    writers['_top_ids'] = TopIdsWriter(writers['_top_ids'])
+    writers['_infix_top_ids'] = TopIdsWriter(writers['_infix_top_ids'])
+    writers['_pool_offsets'].append(0)
+    infix_keys = SortedOnDisk(work_dir, sort_buffer_items) # Sorted as they come, so that only sort_buffer_items are held in memory
+
+    def prefix_keys():
+        """ Yields the prefix index keys, while writing the phrases and collecting the infix index keys """
+        entries = heapq.merge(
+            ((phrase.lower(), weight, None) for phrase, weight in phrases),
+            ((phrase.lower(), weight, offsets) for phrase, weight, offsets in infix_phrases),
+            key=lambda entry: entry[0])
+        previous_phrase = None
+        for phrase, phrase_entries in groupby(entries, key=lambda entry: entry[0]):
+            if (previous_phrase is not None and phrase < previous_phrase):
+                raise TrieFileError(f'The phrases must be sorted, but {phrase!r} comes after {previous_phrase!r}')
+            previous_phrase = phrase
+            if (not phrase):
+                continue # Drop empty phrases
+
+            # As in CompactTrie, the prefix index weight comes first, and the infix offsets of all the entries are kept
+            prefix_weights, infix_weights, offsets = [], [], []
+            for _, weight, entry_offsets in phrase_entries:
+                if (entry_offsets is None):
+                    prefix_weights.append(weight or 0)
+                else:
+                    infix_weights.append(weight or 0)
+                    offsets.extend(offset for offset in entry_offsets if (0 < offset < len(phrase) and offset not in offsets))
+            if (not prefix_weights and not offsets):
+                continue
+
+            weight = (prefix_weights or infix_weights)[0]
+            phrase_id = len(writers['_weights'])
+            encoded_phrase = phrase.encode('utf-8')
+            writers['_pool'].extend(encoded_phrase)
+            writers['_pool_offsets'].append(writers['_pool_offsets'].last + len(encoded_phrase))
+            writers['_weights'].append(weight)
+            # build_trie_arrays picks the smallest candidates as the top phrases
+            candidate = (-weight, phrase_id)
+            infix_keys.extend((phrase[offset:], candidate) for offset in offsets)
+            if (prefix_weights):
+                yield phrase, candidate
+
+    try:
+        *_, root = build_trie_arrays(prefix_keys(), tuple(writers[attribute] for attribute in ('_edge_starts', '_edge_chars', '_edge_childs', '_top_starts', '_top_ids')))
+        *_, infix_root = build_trie_arrays(truncate_infix_keys(infix_keys.sorted()),
+            tuple(writers[attribute] for attribute in ('_infix_edge_starts', '_infix_edge_chars', '_infix_edge_childs', '_infix_top_starts', '_infix_top_ids')))
+
+        offset = HEADER.size + SECTION.size * len(SECTIONS)
+        section_table = []
+        for attribute, _ in SECTIONS:
+            offset += -offset % ALIGNMENT
+            section_table.append((offset, writers[attribute].nbytes))
+            offset += writers[attribute].nbytes
+
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, root, len(SECTIONS), infix_root))
+            for section_offset, section_length in section_table:
+                f.write(SECTION.pack(section_offset, section_length))
+            for (section_offset, _), (attribute, _) in zip(section_table, SECTIONS):
+                f.write(b'\x00' * (section_offset - f.tell()))
+                writers[attribute].copy_to(f)
+    finally:
+        for writer in writers.values():
+            writer.close()
+        infix_keys.close()
+
+
+class SectionWriter:
+    """ Appends the items of a trie file section to a temporary file, holding at most SECTION_BUFFER_ITEMS of them in memory """
+
+    def __init__(self, typecode, directory):
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._buffer = array(typecode)
+        self._length = 0
+        self.last = None
+
+    def append(self, item):
+        self._buffer.append(item)
+        self.last = item
+        if (len(self._buffer) >= SECTION_BUFFER_ITEMS):
+            self._flush()
+
+    def extend(self, items):
+        if (isinstance(items, bytes)):
+            self._buffer.frombytes(items)
+        else:
+            self._buffer.extend(items)
+        if (self._buffer):
+            self.last = self._buffer[-1]
+        if (len(self._buffer) >= SECTION_BUFFER_ITEMS):
+            self._flush()
+
+    def __len__(self):
+        return self._length + len(self._buffer)
+
+    @property
+    def nbytes(self):
+        return len(self) * self._buffer.itemsize
+
+    def copy_to(self, f):
+        self._flush()
+        self._file.seek(0)
+        shutil.copyfileobj(self._file, f)
+
+    def close(self):
+        self._file.close()
+
+    def _flush(self):
+        if (sys.byteorder != 'little'):
+            self._buffer.byteswap()
+        self._file.write(self._buffer.tobytes())
+        self._length += len(self._buffer)
+        self._buffer = array(self._buffer.typecode)
+
+
+class TopIdsWriter:
+    """ SectionWriter of the top phrase ids, given as the (negative weight, phrase id) candidates build_trie_arrays ranks """
+
+    def __init__(self, writer):
+        self._writer = writer
+
+    def extend(self, candidates):
+        self._writer.extend(phrase_id for _, phrase_id in candidates)
+
+    def __len__(self):
+        return len(self._writer)
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+
+class SortedOnDisk:
+    """ Collects items and sorts them in runs of at most buffer_items, spilled to work_dir, which are merged once read back """
+
+    def __init__(self, work_dir, buffer_items=SORT_BUFFER_ITEMS, key=None):
+        self._work_dir = work_dir
+        self._buffer_items = buffer_items
+        self._key = key
+        self._buffer = []
+        self._runs = []
+
+    def extend(self, items):
+        for item in items:
+            self._buffer.append(item)
+            if (len(self._buffer) >= self._buffer_items):
+                self._spill()
+
+    def sorted(self):
+        self._buffer.sort(key=self._key)
+        runs = [self._read_run(run) for run in self._runs]
+        return heapq.merge(*runs, self._buffer, key=self._key)
+
+    def close(self):
+        for run in self._runs:
+            run.close()
+        self._runs = []
+
+    def _spill(self):
+        self._buffer.sort(key=self._key)
+        run = tempfile.TemporaryFile(dir=self._work_dir)
+        for i in range(0, len(self._buffer), SORT_RUN_CHUNK_ITEMS):
+            pickle.dump(self._buffer[i:i + SORT_RUN_CHUNK_ITEMS], run, protocol=pickle.HIGHEST_PROTOCOL)
+        self._runs.append(run)
+        self._buffer = []
+
+    def _read_run(self, run):
+        run.seek(0)
+        while (True):
+            try:
+                yield from pickle.load(run)
+            except EOFError:
+                return
+
+
+def sorted_on_disk(items, work_dir, key=None, buffer_items=SORT_BUFFER_ITEMS):
+    """ Yields the items sorted, holding at most buffer_items of them in memory, see write_sorted_trie_file """
+    sorted_items = SortedOnDisk(work_dir, buffer_items, key)
+    try:
+        sorted_items.extend(items)
+        yield from sorted_items.sorted()
+    finally:
+        sorted_items.close()
+
+
+class MappedTrie(CompactTrie):
+    """
+    Read-only CompactTrie backed by a memory-mapped trie file.
+
+    Lookups walk the mapped pages directly, so opening the file costs the same regardless of its size,
+    and processes mapping the same file share a single page cache copy.
+    """
+
+    def __init__(self, path):
+        if (sys.byteorder != 'little'):
+            raise TrieFileError('Trie files can only be mapped on little-endian hosts')
+
+        self._pending = []
+        with open(path, 'rb') as f:
+            if (os.fstat(f.fileno()).st_size < HEADER.size): # Empty files cannot be mapped
+                raise TrieFileError(f'{path} is too small to be a trie file')
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, root, number_sections, infix_root = HEADER.unpack_from(self._mmap, 0)
+        if (magic != MAGIC):
+            raise TrieFileError(f'{path} is not a trie file')
+        sections = SECTIONS_BY_VERSION.get(version)
+        if (sections is None or number_sections != len(sections)):
+            raise TrieFileError(f'{path} has unsupported trie file version {version}')
+
+        self._infix_edge_starts = array('I', [0, 0])
+        self._infix_edge_chars = array('I')
+        self._infix_edge_childs = array('I')
+        self._infix_top_starts = array('I', [0, 0])
+        self._infix_top_ids = array('I')
+        buffer = memoryview(self._mmap)
+        for i, (attribute, typecode) in enumerate(sections):
+            section_offset, section_length = SECTION.unpack_from(self._mmap, HEADER.size + i * SECTION.size)
+            if (section_offset + section_length > len(self._mmap)):
+                raise TrieFileError(f'{path} is truncated')
+            setattr(self, attribute, buffer[section_offset:section_offset + section_length].cast(typecode))
+        self._root = root
+        self._infix_root = infix_root if (version >= 3) else 0
+        if (version < 2):
+            self._weights = array('q', bytes(8 * (len(self._pool_offsets) - 1)))
+
+    def add_phrase(self, phrase, weight=None):
+        raise TypeError('MappedTrie is read-only')
+
+    def add_infix_phrase(self, phrase, weight, offsets):
+        raise TypeError('MappedTrie is read-only')
+
+    def __getstate__(self):
+        raise TypeError('MappedTrie cannot be pickled, write it with write_trie_file instead')
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The services import the shared modules, and each other's, as top level modules, as they do in their containers
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICE_DIRS = [os.path.join(REPOSITORY_DIR, path) for path in ('shared', 'distributor/backend', 'distributor/frontend', 'assembler/collector', 'assembler/trie-builder', 'trie-backend-applier')]
+sys.path[:0] = [path for path in SERVICE_DIRS if path not in sys.path]
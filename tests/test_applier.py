@@ -0,0 +1,101 @@
+import logging
+import os
+import threading
+import time
+
+os.environ.setdefault('NUMBER_NODES_PER_PARTITION', '2')
+import applier
+import frontend
+from distributed_cache import DISTRIBUTED_CACHE_HOT_PREFIXES_KEY, decode_cached_top_phrases
+
+TARGET_ID = '20200101_0000'
+PARTITIONS = [('', 'g', ['backend-1', 'backend-2']), ('g', 'p', ['backend-3']), ('p', '', ['backend-4'])]
+
+
+class Pipeline:
+
+	def __init__(self, values):
+		self._values = values
+
+	def set(self, key, value, ex=None):
+		self._values[key] = value
+
+	def execute(self):
+		pass
+
+
+class DistributedCache:
+	""" The commands of a redis client that pre-warming uses, over a dict of values and a list of hot prefixes """
+
+	def __init__(self, hot_prefixes):
+		self._hot_prefixes = hot_prefixes
+		self.values = dict()
+
+	def zrevrange(self, key, start, end):
+		assert key == DISTRIBUTED_CACHE_HOT_PREFIXES_KEY
+		return [prefix.encode() for prefix in self._hot_prefixes[start:end + 1]]
+
+	def pipeline(self, transaction=True):
+		return Pipeline(self.values)
+
+
+def prewarming_applier(hot_prefixes, prewarm_backends):
+	instance = applier.Applier.__new__(applier.Applier)
+	instance._logger = logging.getLogger(__name__)
+	instance._distributed_cache_enabled = True
+	instance._distributed_cache = DistributedCache(hot_prefixes)
+	instance._get_partitions = lambda target_id: PARTITIONS
+	instance._prewarm_backends = prewarm_backends
+	return instance
+
+
+def test_prewarmed_entries_are_the_ones_frontends_look_up():
+	hot_prefixes = ['a', 'ho', 'new', 'zebra']
+	instance = prewarming_applier(hot_prefixes, lambda hostnames, prefixes: {prefix: [f'{prefix} top'] for prefix in prefixes})
+
+	instance._prewarm(TARGET_ID)
+
+	for prefix in hot_prefixes:
+		value = instance._distributed_cache.values.pop(frontend.distributed_cache_key(TARGET_ID, prefix))
+		assert decode_cached_top_phrases(value) == [f'{prefix} top']
+	assert instance._distributed_cache.values == dict()
+
+
+def test_partitions_are_prewarmed_concurrently():
+	requests_in_flight = []
+	lock = threading.Lock()
+
+	def prewarm_backends(hostnames, prefixes):
+		with lock:
+			requests_in_flight.append(hostnames[0])
+		time.sleep(0.2)
+		return {prefix: [prefix] for prefix in prefixes}
+
+	instance = prewarming_applier(['a', 'ho', 'new', 'zebra'], prewarm_backends)
+
+	start_time = time.monotonic()
+	instance._prewarm(TARGET_ID)
+
+	assert time.monotonic() - start_time < 0.2 * len(PARTITIONS)
+	assert sorted(requests_in_flight) == ['backend-1', 'backend-3', 'backend-4']
+	assert len(instance._distributed_cache.values) == 4
+
+
+def test_prewarming_stops_after_max_duration(monkeypatch):
+	released = threading.Event()
+
+	def prewarm_backends(hostnames, prefixes):
+		if (hostnames[0] == 'backend-4'):
+			released.wait()
+		return {prefix: [prefix] for prefix in prefixes}
+
+	monkeypatch.setattr(applier, 'PREWARM_MAX_DURATION_S', 0.1)
+	instance = prewarming_applier(['a', 'zebra'], prewarm_backends)
+
+	try:
+		start_time = time.monotonic()
+		instance._prewarm(TARGET_ID)
+		assert time.monotonic() - start_time < 1
+	finally:
+		released.set()
+	assert frontend.distributed_cache_key(TARGET_ID, 'a') in instance._distributed_cache.values
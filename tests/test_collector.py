@@ -0,0 +1,77 @@
+import threading
+import time
+
+import pytest
+
+import collector
+from collector import Collector, CollectorQueueFullError
+
+
+class AvroProducer:
+	""" Records the (phrase, count) of the produced messages, and the threads producing them, with a queue of capacity messages """
+
+	def __init__(self, config, default_key_schema=None, default_value_schema=None):
+		self.capacity = None
+		self.produced = []
+		self.producing_threads = set()
+
+	def produce(self, topic, value, key):
+		self.producing_threads.add(threading.current_thread())
+		if (self.capacity is not None and len(self.produced) >= self.capacity):
+			raise BufferError('Local: Queue full')
+		self.produced.append((value['phrase'], value['count']))
+
+	def poll(self, timeout):
+		return 0
+
+	def flush(self, timeout=-1):
+		return 0
+
+	def __len__(self):
+		return 0
+
+
+@pytest.fixture
+def aggregating_collector(monkeypatch):
+	monkeypatch.setattr(collector, 'AvroProducer', AvroProducer)
+	monkeypatch.setattr(collector, 'AGGREGATION_WINDOW_S', 3600)
+	instance = Collector()
+	yield instance
+	instance._producer.capacity = None
+	instance.stop()
+
+
+def test_phrases_not_sent_when_the_queue_fills_up_go_back_into_the_window(aggregating_collector):
+	aggregating_collector.collect_phrases(['a', 'b', 'a', 'c', 'b', 'a'])
+	aggregating_collector._producer.capacity = 1
+
+	with pytest.raises(CollectorQueueFullError):
+		aggregating_collector._send_phrase_counts()
+	aggregating_collector.collect_phrases(['c'])
+	aggregating_collector._producer.capacity = None
+	aggregating_collector._send_phrase_counts()
+
+	assert aggregating_collector._producer.produced == [('a', 3), ('b', 2), ('c', 2)]
+
+
+def test_full_window_is_sent_by_the_aggregation_thread(monkeypatch, aggregating_collector):
+	monkeypatch.setattr(collector, 'AGGREGATION_MAX_PHRASES', 2)
+
+	aggregating_collector.collect_phrases(['a', 'b', 'a'])
+
+	deadline = time.monotonic() + 5
+	while (len(aggregating_collector._producer.produced) < 2 and time.monotonic() < deadline):
+		time.sleep(0.001)
+	assert sorted(aggregating_collector._producer.produced) == [('a', 2), ('b', 1)]
+	assert aggregating_collector._producer.producing_threads == {aggregating_collector._aggregation_thread}
+
+
+def test_phrases_are_rejected_without_being_counted_while_the_window_cannot_be_sent(monkeypatch, aggregating_collector):
+	monkeypatch.setattr(collector, 'AGGREGATION_REJECT_PHRASES', 3)
+
+	aggregating_collector.collect_phrases(['a', 'b'])
+	aggregating_collector.collect_phrases(['c', 'a'])
+	with pytest.raises(CollectorQueueFullError):
+		aggregating_collector.collect_phrases(['d'])
+
+	assert aggregating_collector._phrase_counts == {'a': 2, 'b': 1, 'c': 1}
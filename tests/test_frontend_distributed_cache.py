@@ -0,0 +1,58 @@
+import logging
+import pickle
+
+import prometheus_client
+
+import frontend
+from frontend import DEFAULT_LOOKUP_OPTIONS, EarlyRefresh, distributed_cache_key, encode_cached_top_phrases
+
+TARGET_ID = '20200101_0000'
+
+
+class Pipeline:
+	""" The get and pttl commands of a redis pipeline, over a dict of values that never expire """
+
+	def __init__(self, values):
+		self._values = values
+		self._results = []
+
+	def get(self, key):
+		self._results.append(self._values.get(key))
+
+	def pttl(self, key):
+		self._results.append(-1 if (key in self._values) else -2)
+
+	def execute(self):
+		return self._results
+
+
+class DistributedCache:
+
+	def __init__(self, values):
+		self._values = values
+
+	def pipeline(self, transaction=True):
+		return Pipeline(self._values)
+
+
+def cache_lookups(result):
+	return prometheus_client.REGISTRY.get_sample_value('frontend_cache_lookups_total', {'cache': 'distributed', 'result': result}) or 0
+
+
+def test_values_that_cannot_be_decoded_are_misses():
+	instance = frontend.Frontend.__new__(frontend.Frontend)
+	instance._logger = logging.getLogger(__name__)
+	instance._distributed_cache_enabled = True
+	instance._early_refresh = EarlyRefresh(0)
+	instance._distributed_cache = DistributedCache({
+		distributed_cache_key(TARGET_ID, 'ab'): encode_cached_top_phrases(['abc', 'abd']),
+		distributed_cache_key(TARGET_ID, 'ac'): pickle.dumps(['acb']), # As written by older frontends
+		distributed_cache_key(TARGET_ID, 'ad'): b'\xff\x00',
+	})
+	hits, misses = cache_lookups('hit'), cache_lookups('miss')
+
+	top_phrases_by_prefix = instance._top_phrases_for_prefixes_distributed_cache(TARGET_ID, ['ab', 'ac', 'ad', 'ae'], DEFAULT_LOOKUP_OPTIONS)
+
+	assert top_phrases_by_prefix == {'ab': ['abc', 'abd'], 'ac': None, 'ad': None, 'ae': None}
+	assert cache_lookups('hit') - hits == 1
+	assert cache_lookups('miss') - misses == 3
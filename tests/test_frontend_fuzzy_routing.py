@@ -0,0 +1,102 @@
+import logging
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import frontend
+from frontend import EarlyRefresh, LatencyTracker, LocalCache, RoutingTable, SingleFlight
+from test_trie import built_trie, random_weights
+from trie import FUZZY_MAX_EDITS
+
+# Boundaries within the phrases starting with 'm', as compute_partition_boundaries can pick
+BOUNDARIES = ['', 'mo', 'mol', '']
+
+
+def partition_name(start, end):
+	return f'{start}|{end}'
+
+
+def routing_table(boundaries, hostnames=None):
+	table = RoutingTable.__new__(RoutingTable)
+	starts, partitions = [], []
+	for start, end in zip(boundaries, boundaries[1:]):
+		starts.append(start)
+		partitions.append((partition_name(start, end), end, (hostnames or {}).get(start, (f'backend-{start}',))))
+	table._table = (starts, partitions)
+	table.target_id = None
+	return table
+
+
+def partitioned_frontend(weights, boundaries):
+	"""
+	A frontend without caches, whose backend requests are answered from a trie of each partition's phrases, as the backends do.
+	The (partition, weighted) of each request are recorded in its requests.
+	"""
+	tries = dict()
+	for start, end in zip(boundaries, boundaries[1:]):
+		tries[partition_name(start, end)] = built_trie({phrase: weight for phrase, weight in weights.items() if (phrase >= start and (not end or phrase < end))})
+
+	instance = frontend.Frontend.__new__(frontend.Frontend)
+	instance._logger = logging.getLogger(__name__)
+	instance._routing_table = routing_table(boundaries)
+	instance._local_cache = LocalCache(10, 60)
+	instance._local_cache_enabled = False
+	instance._distributed_cache_enabled = False
+	instance._single_flight = SingleFlight()
+	instance._early_refresh = EarlyRefresh(0)
+	instance._backend_hedging_enabled = False
+	instance._backend_latencies = LatencyTracker(95)
+	instance._partitions_executor = ThreadPoolExecutor(max_workers=4)
+	instance.requests = []
+
+	def lookup(trie, prefix, options, weighted):
+		top_phrases = trie.fuzzy_top_phrases_with_weights_for_prefix(prefix, FUZZY_MAX_EDITS) if (options.fuzzy) else [(phrase, weight, 0) for phrase, weight in trie.top_phrases_with_weights_for_prefix(prefix)]
+		return top_phrases if (weighted) else [phrase for phrase, _, _ in top_phrases]
+
+	def top_phrases_backend(partition, backend_hostname, path, prefix, options, weighted=False):
+		instance.requests.append((partition, weighted))
+		if (isinstance(prefix, list)):
+			return {p: lookup(tries[partition], p, options, weighted) for p in prefix}
+		return lookup(tries[partition], prefix, options, weighted)
+
+	instance._top_phrases_backend = top_phrases_backend
+	return instance
+
+
+def test_partitions_for_first_character():
+	table = routing_table(['b', 'mo', 'mol', 'p', 'q'])
+
+	assert table.partitions_for_first_character('a') == []
+	assert table.partitions_for_first_character('b') == [('b|mo', ('backend-b',))]
+	assert table.partitions_for_first_character('m') == [('b|mo', ('backend-b',)), ('mo|mol', ('backend-mo',)), ('mol|p', ('backend-mol',))]
+	assert table.partitions_for_first_character('p') == [('p|q', ('backend-p',))]
+	assert table.partitions_for_first_character('q') == []
+
+
+def test_fuzzy_lookup_reaches_phrases_past_a_boundary_within_its_first_character():
+	instance = partitioned_frontend({'mldern': 1, 'modern family': 10, 'molten': 5, 'modest': 3}, ['', 'mod', ''])
+
+	assert instance.top_phrases_for_prefix('mldern', fuzzy=True) == ['mldern', 'modern family']
+	assert sorted(instance.requests) == [('mod|', True), ('|mod', True)]
+	instance.requests.clear()
+	assert instance.top_phrases_for_prefix('mod') == ['modern family', 'modest']
+	assert instance.requests == [('mod|', False)]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_fuzzy_lookups_across_partitions_match_an_unpartitioned_trie(seed):
+	rng = random.Random(seed)
+	weights = random_weights(rng, 300, 'lmno', max_length=7)
+	trie = built_trie(weights)
+	instance = partitioned_frontend(weights, BOUNDARIES)
+	prefixes = [''.join(rng.choice('lmno') for _ in range(rng.randint(1, 7))) for _ in range(60)]
+
+	top_phrases_by_prefix = instance.top_phrases_for_prefixes(prefixes, fuzzy=True)
+
+	for prefix in prefixes:
+		expected_top_phrases = trie.fuzzy_top_phrases_for_prefix(prefix, FUZZY_MAX_EDITS)
+		assert top_phrases_by_prefix[prefix] == expected_top_phrases, prefix
+		assert instance.top_phrases_for_prefix(prefix, fuzzy=True) == expected_top_phrases, prefix
+	# The prefixes starting with other characters than 'm' are each served by a single partition, without weights
+	assert {weighted for _, weighted in instance.requests} == {False, True}
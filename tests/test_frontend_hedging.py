@@ -0,0 +1,77 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+import frontend
+from frontend import DEFAULT_LOOKUP_OPTIONS, LatencyTracker
+
+HEDGE_AFTER_S = 0.05
+
+
+def hedging_frontend(responses):
+	"""
+	A frontend with hedging enabled after HEDGE_AFTER_S, whose backend requests wait for their host's event in responses
+	(if any) and then return its value, or raise it if it is an exception. The hosts asked are recorded in its requested_hostnames.
+	"""
+	instance = frontend.Frontend.__new__(frontend.Frontend)
+	instance._logger = logging.getLogger(__name__)
+	instance._backend_hedging_enabled = True
+	instance._backend_latencies = LatencyTracker(95)
+	instance._backend_latencies.value = HEDGE_AFTER_S
+	instance._backend_executor = ThreadPoolExecutor(max_workers=2)
+	instance.requested_hostnames = []
+
+	def top_phrases_backend(partition, backend_hostname, path, prefix, options, weighted=False):
+		instance.requested_hostnames.append(backend_hostname)
+		event, response = responses[backend_hostname]
+		if (event is not None):
+			event.wait()
+		if (isinstance(response, Exception)):
+			raise response
+		return response
+
+	instance._top_phrases_backend = top_phrases_backend
+	return instance
+
+
+def top_phrases_backends(instance):
+	try:
+		return instance._top_phrases_backends(0, ['first', 'second'], '/top-phrases', 'ab', DEFAULT_LOOKUP_OPTIONS)
+	finally:
+		instance._backend_executor.shutdown(wait=True)
+
+
+def test_response_before_hedge_delay_is_returned_without_hedging():
+	instance = hedging_frontend({'first': (None, ['abc']), 'second': (None, ['other'])})
+
+	assert top_phrases_backends(instance) == ['abc']
+	assert instance.requested_hostnames == ['first']
+
+
+def test_slow_response_is_hedged_to_second_backend():
+	first_released = threading.Event()
+	instance = hedging_frontend({'first': (first_released, ['slow']), 'second': (None, ['abc'])})
+
+	try:
+		assert instance._top_phrases_backends(0, ['first', 'second'], '/top-phrases', 'ab', DEFAULT_LOOKUP_OPTIONS) == ['abc']
+	finally:
+		first_released.set()
+		instance._backend_executor.shutdown(wait=True)
+	assert instance.requested_hostnames == ['first', 'second']
+
+
+def test_error_before_hedge_delay_is_retried_with_second_backend():
+	instance = hedging_frontend({'first': (None, requests.ConnectionError('refused')), 'second': (None, ['abc'])})
+
+	assert top_phrases_backends(instance) == ['abc']
+	assert instance.requested_hostnames == ['first', 'second']
+
+
+def test_error_of_both_backends_is_raised():
+	instance = hedging_frontend({'first': (None, requests.ConnectionError('refused')), 'second': (None, requests.Timeout('timed out'))})
+
+	with pytest.raises(requests.Timeout):
+		top_phrases_backends(instance)
@@ -0,0 +1,38 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import prometheus_client
+
+from frontend import SingleFlight
+
+
+def backend_fetches(result):
+	return prometheus_client.REGISTRY.get_sample_value('frontend_backend_fetches_total', {'result': result}) or 0
+
+
+def test_concurrent_calls_share_one_fetch_and_are_counted():
+	single_flight = SingleFlight()
+	released = threading.Event()
+	calls = []
+
+	def fetch(prefix):
+		calls.append(prefix)
+		released.wait()
+		return [prefix]
+
+	issued, coalesced = backend_fetches('issued'), backend_fetches('coalesced')
+	with ThreadPoolExecutor(max_workers=4) as executor:
+		leader = executor.submit(single_flight.do, 'ab', fetch, 'ab')
+		while (not calls):
+			time.sleep(0.001)
+		followers = [executor.submit(single_flight.do, 'ab', fetch, 'ab') for _ in range(3)]
+		while (backend_fetches('coalesced') - coalesced < 3):
+			time.sleep(0.001)
+		released.set()
+		results = [future.result() for future in [leader] + followers]
+
+	assert results == [['ab']] * 4
+	assert calls == ['ab']
+	assert backend_fetches('issued') - issued == 1
+	assert backend_fetches('coalesced') - coalesced == 3
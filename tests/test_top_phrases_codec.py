@@ -0,0 +1,65 @@
+import pickle
+import random
+
+import pytest
+
+from top_phrases_codec import CodecError, decode_top_phrases, decode_top_phrases_by_prefix, encode_top_phrases, encode_top_phrases_by_prefix
+
+
+def random_string(rng):
+	return ''.join(rng.choice('ab \té中\U0001f600') for _ in range(rng.randint(1, 12)))
+
+
+@pytest.mark.parametrize('top_phrases', [[], ['a'], ['new york', 'new jersey', 'newark'], ['été', '中文', '\U0001f600 ok']])
+def test_top_phrases_round_trip(top_phrases):
+	assert decode_top_phrases(encode_top_phrases(top_phrases)) == top_phrases
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_top_phrases_by_prefix_round_trip(seed):
+	rng = random.Random(seed)
+	top_phrases_by_prefix = {random_string(rng): [random_string(rng) for _ in range(rng.randint(0, 5))] for _ in range(rng.randint(0, 20))}
+
+	encoded = encode_top_phrases_by_prefix(top_phrases_by_prefix)
+
+	assert decode_top_phrases_by_prefix(encoded) == top_phrases_by_prefix
+	assert decode_top_phrases_by_prefix(memoryview(encoded)) == top_phrases_by_prefix
+
+
+@pytest.mark.parametrize('top_phrases', [[''], ['a', ''], ['a\nb'], ['a', 'b\n']])
+def test_empty_phrases_or_phrases_with_newlines_are_not_encoded(top_phrases):
+	with pytest.raises(CodecError):
+		encode_top_phrases(top_phrases)
+	with pytest.raises(CodecError):
+		encode_top_phrases_by_prefix({'a': top_phrases})
+	with pytest.raises(CodecError):
+		encode_top_phrases_by_prefix({top_phrases[-1]: ['a']})
+
+
+def test_too_many_prefixes_are_not_encoded():
+	with pytest.raises(CodecError):
+		encode_top_phrases_by_prefix({f'p{i}': [] for i in range(70000)})
+
+
+@pytest.mark.parametrize('data', [
+	b'',
+	pickle.dumps(['a', 'b']), # Written by older frontends
+	b'{"data": {"top_phrases": []}}',
+	encode_top_phrases_by_prefix({'a': ['ab']}), # The other kind
+	b'\x02' + encode_top_phrases(['a'])[1:], # A later version
+	encode_top_phrases(['é'])[:-1], # Cut in a multi-byte character
+])
+def test_malformed_top_phrases_are_rejected(data):
+	with pytest.raises(CodecError):
+		decode_top_phrases(data)
+
+
+@pytest.mark.parametrize('data', [
+	encode_top_phrases(['a']), # The other kind
+	encode_top_phrases_by_prefix({'a': ['ab', 'ac']})[:4], # Cut in the counts
+	encode_top_phrases_by_prefix({'a': ['ab', 'ac']})[:-3], # Missing a phrase
+	encode_top_phrases_by_prefix({'a': ['ab']}) + b'\nac', # One phrase too many
+])
+def test_malformed_top_phrases_by_prefix_are_rejected(data):
+	with pytest.raises(CodecError):
+		decode_top_phrases_by_prefix(data)
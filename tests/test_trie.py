@@ -0,0 +1,255 @@
+import pickle
+import random
+
+import pytest
+
+from trie import FUZZY_MAX_EDITS, FUZZY_PREFIX_LENGTH_PER_EDIT, TRIE_IMPLEMENTATIONS, CompactTrie, Trie
+from trie import has_infix, merge_infix_top_phrases, token_starts, truncate_infix_keys
+
+K = Trie.TOP_PHRASES_PER_PREFIX
+
+
+def prefixes(phrases):
+	return {phrase[:length] for phrase in phrases for length in range(1, len(phrase) + 1)}
+
+
+def random_weights(rng, number_phrases, alphabet='abc', max_length=6):
+	""" Returns a dict of random phrases to distinct weights, in random order, so that no result depends on how ties are broken """
+	phrases = list({''.join(rng.choice(alphabet) for _ in range(rng.randint(1, max_length))) for _ in range(number_phrases)})
+	rng.shuffle(phrases)
+	return dict(zip(phrases, rng.sample(range(1, 100 * len(phrases)), len(phrases))))
+
+
+def brute_force_top_phrases(weights, prefix):
+	matches = [(phrase, weight) for phrase, weight in weights.items() if (phrase.startswith(prefix))]
+	return sorted(matches, key=lambda match: -match[1])[:K]
+
+
+def built_trie(weights, trie_implementation=Trie):
+	trie = trie_implementation()
+	for phrase, weight in weights.items():
+		trie.add_phrase(phrase, weight)
+	return trie
+
+
+@pytest.mark.parametrize('trie_implementation', TRIE_IMPLEMENTATIONS.values())
+@pytest.mark.parametrize('seed', range(10))
+def test_top_phrases_match_brute_force(trie_implementation, seed):
+	weights = random_weights(random.Random(seed), 300, 'abcd')
+	trie = built_trie(weights, trie_implementation)
+
+	for prefix in prefixes(weights) | {'e', 'ae', 'abcdabcd'}:
+		assert trie.top_phrases_with_weights_for_prefix(prefix) == brute_force_top_phrases(weights, prefix), prefix
+		assert trie.top_phrases_for_prefix(prefix.upper()) == [phrase for phrase, _ in brute_force_top_phrases(weights, prefix)], prefix
+
+
+@pytest.mark.parametrize('trie_implementation', TRIE_IMPLEMENTATIONS.values())
+def test_phrases_without_weight_keep_insertion_order(trie_implementation):
+	trie = trie_implementation()
+	for phrase in ['abc', 'ab', 'abd', 'b', 'abe', 'abf', 'abg']:
+		trie.add_phrase(phrase)
+
+	assert trie.top_phrases_for_prefix('a') == ['abc', 'ab', 'abd', 'abe', 'abf']
+	assert trie.top_phrases_for_prefix('b') == ['b']
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_compact_trie_conversions_keep_top_phrases(seed):
+	weights = random_weights(random.Random(seed), 300, 'abcd')
+	trie = built_trie(weights)
+	compact_trie = CompactTrie.from_trie(trie)
+	pickled_compact_trie = pickle.loads(pickle.dumps(built_trie(weights, CompactTrie)))
+
+	for prefix in prefixes(weights):
+		assert compact_trie.top_phrases_with_weights_for_prefix(prefix) == trie.top_phrases_with_weights_for_prefix(prefix), prefix
+		assert pickled_compact_trie.top_phrases_with_weights_for_prefix(prefix) == trie.top_phrases_with_weights_for_prefix(prefix), prefix
+
+
+@pytest.mark.parametrize('trie_implementation', TRIE_IMPLEMENTATIONS.values())
+def test_compacted_trie_takes_more_phrases(trie_implementation):
+	trie = built_trie({'abc': 3, 'abd': 2}, trie_implementation)
+	assert trie.top_phrases_for_prefix('ab') == ['abc', 'abd']
+
+	trie.add_phrase('abe', 4)
+
+	assert trie.top_phrases_for_prefix('ab') == ['abe', 'abc', 'abd']
+
+
+def test_update_phrase_brings_back_phrase_ending_at_node():
+	weights = {'ab': 1, 'abc': 10, 'abd': 9, 'abe': 8, 'abf': 7, 'abg': 6}
+	trie = built_trie(weights)
+
+	trie.update_phrase('abc', 0)
+
+	assert trie.top_phrases_with_weights_for_prefix('ab') == [('abd', 9), ('abe', 8), ('abf', 7), ('abg', 6), ('ab', 1)]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_update_phrase_matches_rebuild(seed):
+	rng = random.Random(seed)
+	phrases = list({''.join(rng.choice('abc') for _ in range(rng.randint(1, 5))) for _ in range(60)})
+	# Distinct weights, so that the order of ties does not depend on the order phrases were added or updated in
+	distinct_weights = rng.sample(range(10000), 2 * len(phrases) + 100)
+	weights = {phrase: distinct_weights.pop() for phrase in sorted(phrases, key=lambda phrase: rng.random())[:len(phrases) // 2]}
+	trie = built_trie(weights)
+
+	for _ in range(100):
+		phrase = rng.choice(phrases)
+		weights[phrase] = distinct_weights.pop() if (rng.random() < 0.5 or phrase not in weights) else rng.choice([0, 1, 2])
+		if (list(weights.values()).count(weights[phrase]) > 1):
+			weights[phrase] = distinct_weights.pop()
+		trie.update_phrase(phrase, weights[phrase])
+
+	rebuilt_trie = built_trie(weights)
+	for prefix in prefixes(phrases):
+		assert trie.top_phrases_with_weights_for_prefix(prefix) == rebuilt_trie.top_phrases_with_weights_for_prefix(prefix), prefix
+
+
+def test_duplicate_phrases_keep_first_weight_in_every_implementation():
+	for trie_implementation in TRIE_IMPLEMENTATIONS.values():
+		trie = trie_implementation()
+		for phrase, weight in [('beta', 5), ('alpha', 3), ('Beta', 9), ('alpha', 1)]:
+			trie.add_phrase(phrase, weight)
+
+		assert trie.top_phrases_with_weights_for_prefix('b') == [('beta', 5)], trie_implementation
+		assert trie.top_phrases_with_weights_for_prefix('a') == [('alpha', 3)], trie_implementation
+
+
+def optimal_string_alignment_distance(a, b):
+	""" Edit distance with insertions, deletions, substitutions and transpositions of adjacent characters, none edited twice """
+	distances = [[max(i, j) if (i == 0 or j == 0) else 0 for j in range(len(b) + 1)] for i in range(len(a) + 1)]
+	for i in range(1, len(a) + 1):
+		for j in range(1, len(b) + 1):
+			distances[i][j] = min(distances[i - 1][j] + 1, distances[i][j - 1] + 1, distances[i - 1][j - 1] + (a[i - 1] != b[j - 1]))
+			if (i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+				distances[i][j] = min(distances[i][j], distances[i - 2][j - 2] + 1)
+	return distances[len(a)][len(b)]
+
+
+def brute_force_fuzzy_edits(weights, prefix):
+	""" Returns the fewest edits between prefix and a prefix of each phrase starting with the same character """
+	return {phrase: min(optimal_string_alignment_distance(prefix, phrase[:length]) for length in range(1, len(phrase) + 1))
+		for phrase in weights if (phrase[0] == prefix[0])}
+
+
+def brute_force_fuzzy_top_phrases(weights, fuzzy_edits, prefix, max_edits):
+	max_edits = min(max_edits, FUZZY_MAX_EDITS, len(prefix) // FUZZY_PREFIX_LENGTH_PER_EDIT)
+	matches = [(phrase, weights[phrase], edits) for phrase, edits in fuzzy_edits.items() if (edits <= max_edits)]
+	return sorted(matches, key=lambda match: (match[2], -match[1]))[:K]
+
+
+@pytest.mark.parametrize('trie_implementation', TRIE_IMPLEMENTATIONS.values())
+@pytest.mark.parametrize('seed', range(5))
+def test_fuzzy_top_phrases_match_brute_force(trie_implementation, seed):
+	rng = random.Random(seed)
+	weights = random_weights(rng, 300, 'abcd', max_length=8)
+	trie = built_trie(weights, trie_implementation)
+
+	for _ in range(50):
+		prefix = ''.join(rng.choice('abcde') for _ in range(rng.randint(1, 8)))
+		fuzzy_edits = brute_force_fuzzy_edits(weights, prefix)
+		for max_edits in (0, 1, 2, 3):
+			assert trie.fuzzy_top_phrases_with_weights_for_prefix(prefix, max_edits) == brute_force_fuzzy_top_phrases(weights, fuzzy_edits, prefix, max_edits), (prefix, max_edits)
+
+
+@pytest.mark.parametrize('trie_implementation', TRIE_IMPLEMENTATIONS.values())
+def test_fuzzy_top_phrases_tolerate_typos(trie_implementation):
+	trie = built_trie({'new york': 10, 'newark': 8, 'nwe': 1, 'boston': 5}, trie_implementation)
+
+	assert trie.fuzzy_top_phrases_with_weights_for_prefix('new yrok', 2) == [('new york', 10, 1)]
+	assert trie.fuzzy_top_phrases_for_prefix('bostno', 1) == ['boston']
+	assert trie.fuzzy_top_phrases_for_prefix('ne', 2) == ['new york', 'newark'] # Too short for any edit
+	assert trie.fuzzy_top_phrases_for_prefix('xoston', 2) == [] # The first character has to match
+	assert trie.fuzzy_top_phrases_for_prefix('', 2) == []
+
+
+@pytest.mark.parametrize('trie_implementation', TRIE_IMPLEMENTATIONS.values())
+def test_fuzzy_top_phrases_past_deadline_are_matches_found_so_far(trie_implementation):
+	weights = random_weights(random.Random(0), 2000, 'abcd', max_length=10)
+	trie = built_trie(weights, trie_implementation)
+	fuzzy_edits = brute_force_fuzzy_edits(weights, 'abcdab')
+
+	top_phrases = trie.fuzzy_top_phrases_with_weights_for_prefix('abcdab', 2, deadline=0)
+
+	assert len(top_phrases) <= K
+	for phrase, weight, edits in top_phrases:
+		assert weights[phrase] == weight and fuzzy_edits[phrase] <= edits <= 2
+
+
+def random_sentences(rng, number_phrases, words=('new', 'york', 'ne', 'newark', 'yo', 'nyc', 'york city', 'west')):
+	""" Returns random phrases of a few words, with distinct weights, many of them sharing words """
+	phrases = list({' '.join(rng.choice(words) for _ in range(rng.randint(1, 4))) for _ in range(number_phrases)})
+	rng.shuffle(phrases)
+	return dict(zip(phrases, rng.sample(range(1, 100 * len(phrases)), len(phrases))))
+
+
+def infix_prefixes(phrases):
+	return prefixes(phrase[offset:] for phrase in phrases for offset in token_starts(phrase)) | {'x', 'new x', 'york cityx'}
+
+
+def brute_force_infix_top_phrases(weights, prefix):
+	matches = [(phrase, weight) for phrase, weight in weights.items() if (has_infix(phrase, prefix))]
+	return sorted(matches, key=lambda match: -match[1])[:K]
+
+
+def built_infix_trie(weights, trie_implementation=Trie):
+	trie = built_trie(weights, trie_implementation)
+	for phrase, weight in weights.items():
+		trie.add_infix_phrase(phrase, weight, token_starts(phrase))
+	return trie
+
+
+@pytest.mark.parametrize('trie_implementation', TRIE_IMPLEMENTATIONS.values())
+@pytest.mark.parametrize('seed', range(4))
+def test_infix_top_phrases_match_brute_force(trie_implementation, seed):
+	weights = random_sentences(random.Random(seed), 300)
+	trie = built_infix_trie(weights, trie_implementation)
+
+	for prefix in infix_prefixes(weights):
+		assert trie.infix_top_phrases_with_weights_for_prefix(prefix) == brute_force_infix_top_phrases(weights, prefix), prefix
+		assert trie.top_phrases_with_weights_for_prefix(prefix) == brute_force_top_phrases(weights, prefix), prefix
+
+
+@pytest.mark.parametrize('trie_implementation', TRIE_IMPLEMENTATIONS.values())
+def test_phrases_only_in_infix_index_are_not_prefix_matches(trie_implementation):
+	trie = trie_implementation()
+	trie.add_infix_phrase('new york', 3, token_starts('new york'))
+	trie.add_phrase('newark', 2)
+
+	assert trie.top_phrases_for_prefix('ne') == ['newark']
+	assert trie.infix_top_phrases_for_prefix('yo') == ['new york']
+	assert trie.infix_top_phrases_for_prefix('ne') == []
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_truncated_infix_keys_are_shortest_prefixes_shared_by_few_keys(seed):
+	rng = random.Random(seed)
+	keys = sorted((''.join(rng.choice('ab') for _ in range(rng.randint(1, 6))), phrase_id) for phrase_id in range(rng.randint(0, 60)))
+
+	truncated_keys = list(truncate_infix_keys(iter(keys)))
+
+	expected_keys = []
+	for key, phrase_id in keys:
+		length = next((length for length in range(1, len(key) + 1) if (sum(other.startswith(key[:length]) for other, _ in keys) <= K)), len(key))
+		expected_keys.append((key[:length], phrase_id))
+	assert truncated_keys == expected_keys
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_merged_infix_top_phrases_match_brute_force(seed):
+	weights = random_sentences(random.Random(seed), 300)
+	trie = built_infix_trie(weights)
+
+	for prefix in infix_prefixes(weights):
+		top_phrases = [(phrase, weight, 0) for phrase, weight in trie.top_phrases_with_weights_for_prefix(prefix)]
+		matches = {phrase: weight for phrase, weight in weights.items() if (phrase.startswith(prefix) or has_infix(phrase, prefix))}
+		expected_top_phrases = sorted(((phrase, weight, 0) for phrase, weight in matches.items()), key=lambda match: -match[1])[:K]
+		assert merge_infix_top_phrases(top_phrases, trie.infix_top_phrases_with_weights_for_prefix(prefix)) == expected_top_phrases, prefix
+
+
+def test_merged_infix_top_phrases_rank_fuzzy_matches_by_edits():
+	top_phrases = [('new york', 5, 0), ('newark', 9, 1)]
+	infix_top_phrases = [('west new york', 7), ('new york', 5), ('old newark', 3)]
+
+	assert merge_infix_top_phrases(top_phrases, infix_top_phrases) == [
+		('west new york', 7, 0), ('new york', 5, 0), ('old newark', 3, 0), ('newark', 9, 1)]
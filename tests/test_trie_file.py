@@ -0,0 +1,138 @@
+import pickle
+import random
+
+import pytest
+
+from test_trie import brute_force_infix_top_phrases, brute_force_top_phrases, built_infix_trie, built_trie, infix_prefixes, prefixes, random_sentences, random_weights
+from trie import token_starts
+from trie import TRIE_IMPLEMENTATIONS, CompactTrie
+from trie_file import ALIGNMENT, HEADER, MAGIC, SECTION, SECTIONS_BY_VERSION, MappedTrie, TrieFileError, is_trie_file, sorted_on_disk, write_sorted_trie_file, write_trie_file
+
+
+PHRASES = ['bravo', 'alpha', 'alphabet', 'beta', 'al', 'alps', 'alpine', 'alto', 'alder']
+PREFIXES = sorted({phrase[:length] for phrase in PHRASES for length in range(1, len(phrase) + 1)}) + ['x', 'alx']
+
+
+def write_version_file(trie, path, version):
+	""" Writes the sections an older format version has, as the writer of that version did """
+	sections = [bytes(getattr(trie, attribute)) for attribute, _ in SECTIONS_BY_VERSION[version]]
+	offset = HEADER.size + SECTION.size * len(sections)
+	section_table = []
+	for data in sections:
+		offset += -offset % ALIGNMENT
+		section_table.append((offset, len(data)))
+		offset += len(data)
+	with open(path, 'wb') as f:
+		f.write(HEADER.pack(MAGIC, version, trie._root, len(sections), 0))
+		for section_offset, section_length in section_table:
+			f.write(SECTION.pack(section_offset, section_length))
+		for (section_offset, _), data in zip(section_table, sections):
+			f.write(b'\x00' * (section_offset - f.tell()))
+			f.write(data)
+
+
+@pytest.mark.parametrize('trie_implementation', TRIE_IMPLEMENTATIONS.values())
+@pytest.mark.parametrize('seed', range(5))
+def test_mapped_trie_matches_brute_force(tmp_path, trie_implementation, seed):
+	weights = random_weights(random.Random(seed), 300, 'abcd\u00e9\u4e2d')
+	write_trie_file(built_trie(weights, trie_implementation), tmp_path / 'partition.trie')
+
+	mapped_trie = MappedTrie(tmp_path / 'partition.trie')
+
+	assert is_trie_file(tmp_path / 'partition.trie')
+	for prefix in prefixes(weights) | {'e', 'ae'}:
+		assert mapped_trie.top_phrases_with_weights_for_prefix(prefix) == brute_force_top_phrases(weights, prefix), prefix
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_mapped_and_streamed_infix_index_match_brute_force(tmp_path, seed):
+	weights = random_sentences(random.Random(seed), 300)
+	write_trie_file(built_infix_trie(weights, CompactTrie), tmp_path / 'partition.trie')
+	sort_key = lambda entry: entry[0].lower()
+	# Small sort buffers, so that the phrases and the infix keys are spilled to several sorted runs
+	write_sorted_trie_file(
+		sorted_on_disk(weights.items(), tmp_path, sort_key, buffer_items=50),
+		sorted_on_disk(((phrase, weight, token_starts(phrase)) for phrase, weight in weights.items()), tmp_path, sort_key, buffer_items=50),
+		tmp_path / 'streamed.trie', tmp_path, sort_buffer_items=50)
+
+	for mapped_trie in (MappedTrie(tmp_path / 'partition.trie'), MappedTrie(tmp_path / 'streamed.trie')):
+		for prefix in infix_prefixes(weights):
+			assert mapped_trie.infix_top_phrases_with_weights_for_prefix(prefix) == brute_force_infix_top_phrases(weights, prefix), prefix
+			assert mapped_trie.top_phrases_with_weights_for_prefix(prefix) == brute_force_top_phrases(weights, prefix), prefix
+
+
+def test_mapped_trie_is_read_only(tmp_path):
+	write_trie_file(built_trie({'alpha': 1}), tmp_path / 'partition.trie')
+	mapped_trie = MappedTrie(tmp_path / 'partition.trie')
+
+	with pytest.raises(TypeError):
+		mapped_trie.add_phrase('beta', 2)
+	with pytest.raises(TypeError):
+		pickle.dumps(mapped_trie)
+
+
+def test_files_that_are_not_trie_files_are_rejected(tmp_path):
+	with open(tmp_path / 'partition.pickle', 'wb') as f:
+		pickle.dump(built_trie({'alpha': 1}), f)
+	write_trie_file(built_trie({'alpha': 1, 'beta': 2}), tmp_path / 'partition.trie')
+	with open(tmp_path / 'partition.trie', 'rb') as f:
+		data = f.read()
+	with open(tmp_path / 'truncated.trie', 'wb') as f:
+		f.write(data[:-4])
+	with open(tmp_path / 'empty.trie', 'wb') as f:
+		pass
+
+	assert not is_trie_file(tmp_path / 'partition.pickle')
+	for name in ('partition.pickle', 'truncated.trie', 'empty.trie'):
+		with pytest.raises(TrieFileError):
+			MappedTrie(tmp_path / name)
+
+
+def test_version_1_file_is_read_in_insertion_order_with_zero_weights(tmp_path):
+	# Version 1 had no weights: phrase ids, and the top phrases of each prefix, were in insertion order
+	trie = CompactTrie()
+	for phrase in PHRASES:
+		trie.add_phrase(phrase)
+	trie._compact()
+	write_version_file(trie, tmp_path / 'v1.trie', 1)
+
+	mapped_trie = MappedTrie(tmp_path / 'v1.trie')
+
+	for prefix in PREFIXES:
+		assert mapped_trie.top_phrases_with_weights_for_prefix(prefix) == trie.top_phrases_with_weights_for_prefix(prefix)
+	assert mapped_trie.top_phrases_for_prefix('al') == ['alpha', 'alphabet', 'al', 'alps', 'alpine']
+	assert mapped_trie.infix_top_phrases_for_prefix('pha') == []
+
+
+def test_unknown_version_is_rejected(tmp_path):
+	trie = CompactTrie()
+	trie.add_phrase('alpha')
+	trie._compact()
+	write_version_file(trie, tmp_path / 'v1.trie', 1)
+	with open(tmp_path / 'v1.trie', 'r+b') as f:
+		f.write(HEADER.pack(MAGIC, 99, trie._root, len(SECTIONS_BY_VERSION[1]), 0))
+
+	with pytest.raises(TrieFileError):
+		MappedTrie(tmp_path / 'v1.trie')
+
+
+def test_streaming_build_keeps_first_weight_of_duplicates_as_compact_trie(tmp_path):
+	phrases = [('beta', 5), ('alpha', 3), ('Beta', 9), ('alpha', 1), ('gamma', 4)]
+	infix_phrases = [('delta alpha', 2, [6]), ('gamma', 8, [2]), ('delta alpha', 7, [6])]
+	trie = CompactTrie()
+	for phrase, weight in phrases:
+		trie.add_phrase(phrase, weight)
+	for phrase, weight, offsets in infix_phrases:
+		trie.add_infix_phrase(phrase, weight, offsets)
+	sort_key = lambda entry: entry[0].lower()
+
+	write_sorted_trie_file(
+		sorted_on_disk(phrases, tmp_path, sort_key, buffer_items=2), sorted_on_disk(infix_phrases, tmp_path, sort_key, buffer_items=2),
+		tmp_path / 'streamed.trie', tmp_path, sort_buffer_items=2)
+	mapped_trie = MappedTrie(tmp_path / 'streamed.trie')
+
+	for prefix in ('a', 'al', 'b', 'g', 'x'):
+		assert mapped_trie.top_phrases_with_weights_for_prefix(prefix) == trie.top_phrases_with_weights_for_prefix(prefix)
+	for prefix in ('a', 'm', 'x'):
+		assert mapped_trie.infix_top_phrases_with_weights_for_prefix(prefix) == trie.infix_top_phrases_with_weights_for_prefix(prefix)
+	assert mapped_trie.top_phrases_with_weights_for_prefix('b') == [('beta', 5)]
@@ -0,0 +1,125 @@
+import logging
+
+import pytest
+
+import triebuilder
+
+
+def test_streaming_build_mode_requires_binary_trie_files(monkeypatch):
+	monkeypatch.setattr(triebuilder, 'TRIE_BUILD_MODE', 'streaming')
+	monkeypatch.setattr(triebuilder, 'TRIE_FILE_FORMAT', 'pickle')
+
+	with pytest.raises(triebuilder.TrieBuildModeError):
+		triebuilder.TrieBuilder()
+
+
+TARGET_ID = '20200101_0000'
+TARGET_CREATION_MS = 1577836800000
+SINK_PATH = '/phrases/1_sink/phrases'
+
+
+class ZooKeeper:
+	""" The commands of a kazoo client that the weight deltas use, over a dict of node values """
+
+	def __init__(self, paths):
+		self.values = {path: b'' for path in paths}
+
+	def exists(self, path):
+		return True if (path in self.values) else None
+
+	def ensure_path(self, path):
+		self.values.setdefault(path, b'')
+
+	def get(self, path):
+		return self.values[path], None
+
+	def set(self, path, value):
+		self.values[path] = value
+
+	def create(self, path, value, sequence=False):
+		path = f'{path}{len(self.values):010d}' if (sequence) else path
+		self.values[path] = value
+
+
+class Hdfs:
+	""" The sink folders, as a dict from each file path to its (modification time, phrases), and the uploaded deltas """
+
+	def __init__(self, input_files=None):
+		self.sink_files = dict()
+		self.input_files = input_files
+		self.uploads = []
+
+	def list(self, path, status=False):
+		if (path == SINK_PATH):
+			return sorted({file_path.split('/')[-2] for file_path in self.sink_files})
+		return [(file_path.split('/')[-1], {'modificationTime': modification_time_ms})
+			for file_path, (modification_time_ms, _) in self.sink_files.items() if (file_path.startswith(f'{path}/'))]
+
+	def read_avro_records(self, hdfs_path):
+		return [{'phrase': phrase, 'count': 1} for phrase in self.sink_files[hdfs_path][1]]
+
+	def read_lines(self, hdfs_path):
+		assert hdfs_path == f'/phrases/4_with_weight_ordered/{TARGET_ID}/{triebuilder.TARGET_INPUT_FILES_NAME}'
+		return self.input_files
+
+	def upload_to_hdfs(self, local_path, remote_path):
+		with open(local_path, encoding='utf-8') as f:
+			self.uploads.append(sorted(line.rstrip('\n').split('\t')[1] for line in f))
+
+
+def deltas_builder(input_files=None):
+	instance = triebuilder.TrieBuilder.__new__(triebuilder.TrieBuilder)
+	instance._logger = logging.getLogger(__name__)
+	instance._zk = ZooKeeper([f'/phrases/distributor/{TARGET_ID}'])
+	instance._hdfsClient = Hdfs(input_files)
+	return instance
+
+
+def add_sink_file(instance, name, modification_time_s, phrases):
+	instance._hdfsClient.sink_files[f'{SINK_PATH}/partition=0/{name}.avro'] = (TARGET_CREATION_MS + modification_time_s * 1000, phrases)
+
+
+def published_deltas(instance):
+	uploads, instance._hdfsClient.uploads = instance._hdfsClient.uploads, []
+	return uploads
+
+
+def test_files_appearing_after_later_modified_ones_are_included_once():
+	instance = deltas_builder()
+	add_sink_file(instance, 'before', -30, ['old'])
+	add_sink_file(instance, 'first', 60, ['a'])
+	instance._build_target_deltas(TARGET_ID)
+	assert published_deltas(instance) == [['a']]
+
+	# Renamed into place after 'first', but modified before it
+	add_sink_file(instance, 'late', 30, ['b'])
+	add_sink_file(instance, 'next', 90, ['c'])
+	instance._build_target_deltas(TARGET_ID)
+	assert published_deltas(instance) == [['b', 'c']]
+
+	instance._build_target_deltas(TARGET_ID)
+	assert published_deltas(instance) == []
+	assert len([path for path in instance._zk.values if ('/deltas/delta-' in path)]) == 2
+
+
+def test_files_of_the_target_input_are_left_out_whatever_their_modification_time():
+	instance = deltas_builder(input_files=[f'{SINK_PATH}/partition=0/input.avro', f'{SINK_PATH}/partition=0/old input.avro'])
+	add_sink_file(instance, 'old input', -30, ['old'])
+	add_sink_file(instance, 'input', 20, ['a'])
+	add_sink_file(instance, 'missed', -10, ['b']) # Written just before the target was created, after its input was listed
+	add_sink_file(instance, 'after', 40, ['c'])
+
+	instance._build_target_deltas(TARGET_ID)
+
+	assert published_deltas(instance) == [['b', 'c']]
+
+
+def test_watermark_written_before_included_files_were_kept_is_read():
+	instance = deltas_builder()
+	instance._zk.values[f'/phrases/distributor/{TARGET_ID}/deltas'] = str(TARGET_CREATION_MS + 60000).encode()
+	add_sink_file(instance, 'first', 60, ['a'])
+	add_sink_file(instance, 'next', 90, ['b'])
+
+	instance._build_target_deltas(TARGET_ID)
+
+	assert published_deltas(instance) == [['b']]
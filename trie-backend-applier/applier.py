@@ -1,18 +1,33 @@
 import os
 import time
 import logging
+import redis
+import requests
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, wait
+from distutils.util import strtobool
 from kazoo.client import KazooClient, DataWatch
 from apscheduler.schedulers.blocking import BlockingScheduler
 
+import top_phrases_codec
+from distributed_cache import DISTRIBUTED_CACHE_TIME_TO_EXPIRE_S, DISTRIBUTED_CACHE_HOT_PREFIXES_KEY, top_phrases_cache_key, encode_cached_top_phrases
+
 ZK_CURRENT_TARGET = '/phrases/distributor/current_target'
 ZK_NEXT_TARGET = '/phrases/distributor/next_target'
 NUMBER_NODES_PER_PARTITION = int(os.getenv("NUMBER_NODES_PER_PARTITION"))
+PREWARM_PREFIXES = int(os.getenv("PREWARM_PREFIXES", 1000)) # Number of hot prefixes to pre-warm before switching targets, 0 disables it
+PREWARM_BATCH_SIZE = int(os.getenv("PREWARM_BATCH_SIZE", 100)) # At most the backends' MAX_BATCH_PREFIXES
+PREWARM_TIMEOUT_S = float(os.getenv("PREWARM_TIMEOUT_S", 5))
+PREWARM_MAX_THREADS = int(os.getenv("PREWARM_MAX_THREADS", 16)) # Batches pre-warmed at once, across all the partitions
+PREWARM_MAX_DURATION_S = float(os.getenv("PREWARM_MAX_DURATION_S", 30)) # The switch goes ahead once pre-warming takes this long
 
 
 class Applier:
 
 	def __init__(self):
 		self._zk = KazooClient(hosts=f'{os.getenv("ZOOKEEPER_HOST")}:2181')
+		self._distributed_cache = redis.Redis(host=os.getenv("DISTRIBUTED_CACHE_HOST"), port=6379, db=0)
+		self._distributed_cache_enabled = bool(strtobool(os.getenv('DISTRIBUTED_CACHE_ENABLED', 'true')))
 		self._logger = logging.getLogger(__name__)
 		self._logger.setLevel(logging.getLevelName(os.getenv("LOG_LEVEL", "INFO")))
 		ch = logging.StreamHandler()
@@ -42,6 +57,7 @@ class Applier:
 		self._logger.info("Applying next target")
 		self._zk.ensure_path(ZK_CURRENT_TARGET)
 		next_target_id = self._zk.get(ZK_NEXT_TARGET)[0]
+		self._prewarm(next_target_id.decode())
 
 		tx = self._zk.transaction()
 		tx.set_data(ZK_NEXT_TARGET, b'')
@@ -49,6 +65,94 @@ class Applier:
 		tx.commit()
 
 
+	def _prewarm(self, target_id):
+		"""
+		Asks every backend node of the target for the top phrases of the hottest prefixes, so their tries have the pages
+		of those prefixes in memory, and stores them in the distributed cache under the target's keys. Once the switch is
+		committed, the frontends find the hot prefixes already cached. Pre-warming is best effort, and never blocks the switch:
+		the batches of all the partitions are sent concurrently, and the ones still pending after PREWARM_MAX_DURATION_S are dropped.
+		"""
+		if (PREWARM_PREFIXES <= 0 or not self._distributed_cache_enabled):
+			return
+
+		try:
+			start_time = time.monotonic()
+			prefixes = [prefix.decode() for prefix in self._distributed_cache.zrevrange(DISTRIBUTED_CACHE_HOT_PREFIXES_KEY, 0, PREWARM_PREFIXES - 1)]
+			partitions = self._get_partitions(target_id)
+			starts = [start for start, _, _ in partitions]
+			prefixes_by_partition = dict()
+			for prefix in prefixes:
+				i = bisect_right(starts, prefix) - 1
+				if (i >= 0 and (not partitions[i][1] or prefix < partitions[i][1])):
+					prefixes_by_partition.setdefault(i, []).append(prefix)
+
+			executor = ThreadPoolExecutor(max_workers=PREWARM_MAX_THREADS)
+			futures = []
+			try:
+				futures = [executor.submit(self._prewarm_batch, target_id, partitions[i][2], partition_prefixes[batch_start:batch_start + PREWARM_BATCH_SIZE])
+					for i, partition_prefixes in prefixes_by_partition.items()
+					for batch_start in range(0, len(partition_prefixes), PREWARM_BATCH_SIZE)]
+				done, not_done = wait(futures, timeout=PREWARM_MAX_DURATION_S)
+			finally:
+				# Batches in flight finish on their own, within their requests' timeout
+				for future in futures:
+					future.cancel()
+				executor.shutdown(wait=False)
+
+			number_prewarmed = 0
+			for future in done:
+				if (future.exception() is None):
+					number_prewarmed += future.result()
+				else:
+					self._logger.warning(f'Could not pre-warm a batch of target {target_id} ({future.exception()})')
+			if (not_done):
+				self._logger.warning(f'Stopped pre-warming target {target_id} after {PREWARM_MAX_DURATION_S}s, with {len(not_done)} of {len(futures)} batches pending')
+			self._logger.info(f'Pre-warmed {number_prewarmed} of {len(prefixes)} hot prefixes for target {target_id} in {time.monotonic() - start_time:.1f}s')
+		except Exception as e:
+			self._logger.error(f'Could not pre-warm target {target_id}', exc_info=e)
+
+	def _prewarm_batch(self, target_id, hostnames, prefixes):
+		""" Stores the top phrases of the prefixes in the distributed cache, returning how many were stored """
+		top_phrases_by_prefix = self._prewarm_backends(hostnames, prefixes)
+		if (top_phrases_by_prefix is None):
+			return 0
+		number_prewarmed = 0
+		pipeline = self._distributed_cache.pipeline(transaction=False)
+		for prefix, top_phrases in top_phrases_by_prefix.items():
+			value = encode_cached_top_phrases(top_phrases)
+			if (value is not None):
+				pipeline.set(top_phrases_cache_key(target_id, prefix), value, ex=DISTRIBUTED_CACHE_TIME_TO_EXPIRE_S)
+				number_prewarmed += 1
+		pipeline.execute()
+		return number_prewarmed
+
+	def _prewarm_backends(self, hostnames, prefixes):
+		""" Returns the top phrases of the prefixes from the first node that answers, after asking all of them """
+		top_phrases_by_prefix = None
+		for hostname in hostnames:
+			try:
+				r = requests.get(f'http://{hostname}:8001/top-phrases/batch', params={'prefix': prefixes},
+					headers={'Accept': top_phrases_codec.MEDIA_TYPE}, timeout=PREWARM_TIMEOUT_S)
+				r.raise_for_status()
+				if (top_phrases_by_prefix is None):
+					if (r.headers.get('Content-Type', '').startswith(top_phrases_codec.MEDIA_TYPE)):
+						top_phrases_by_prefix = top_phrases_codec.decode_top_phrases_by_prefix(r.content)
+					else:
+						top_phrases_by_prefix = r.json()["data"]["top_phrases"]
+			except requests.RequestException as e:
+				self._logger.warning(f'Could not pre-warm backend {hostname} ({e})')
+		return top_phrases_by_prefix
+
+	def _get_partitions(self, target_id):
+		""" Returns the target's (start, end, hostnames) partitions, sorted by their start """
+		partitions = []
+		for partition in self._zk.get_children(f'/phrases/distributor/{target_id}/partitions'):
+			start, end = partition.split('|')
+			nodes_path = f'/phrases/distributor/{target_id}/partitions/{partition}/nodes'
+			hostnames = [self._zk.get(f'{nodes_path}/{node}')[0].decode() for node in self._zk.get_children(nodes_path)]
+			partitions.append((start, end, [hostname for hostname in hostnames if hostname]))
+		return sorted(partitions)
+
 	def _is_next_target_ready(self):
 		if (self._zk.exists(ZK_NEXT_TARGET) is None):
 			return False